@@ -0,0 +1,89 @@
+# agendador.py
+"""
+Agendador do loop principal: decide quanto esperar entre os ciclos e espera de forma
+interrompível (pedido de "Verificar agora" ou "Sair" valem na hora).
+"""
+import logging
+import threading
+from datetime import datetime, timedelta, time as dtime
+from typing import Optional, Set, Tuple
+
+from config import (INTERVALO, INTERVALO_MINIMO, INTERVALO_MAXIMO, INTERVALO_FORA_EXPEDIENTE,
+                    HORARIO_EXPEDIENTE, DIAS_EXPEDIENTE)
+
+logger = logging.getLogger("bot.agendador")
+
+# Com e-mails novos o intervalo cai pela metade; com a caixa parada sobe 50%
+FATOR_ACELERAR = 0.5
+FATOR_DESACELERAR = 1.5
+
+def _ler_expediente(horario: str, dias: str) -> Optional[Tuple[dtime, dtime, Set[int]]]:
+    """'08:00-18:00' + '0,1,2,3,4' -> (início, fim, dias da semana). None = sem janela."""
+    if not horario.strip():
+        return None
+    try:
+        inicio, fim = (datetime.strptime(p.strip(), "%H:%M").time() for p in horario.split("-"))
+        dias_semana = {int(d) for d in dias.split(",") if d.strip()}
+    except ValueError:
+        logger.warning("⚠️ HORARIO_EXPEDIENTE inválido (%r); verificando sem janela de expediente.", horario)
+        return None
+    return inicio, fim, dias_semana
+
+class Agendador:
+    """
+    Intervalo adaptativo: diminui enquanto os ciclos recentes encontram mensagens e
+    aumenta com a caixa parada, entre `minimo` e `maximo`. Fora da janela de
+    expediente espera `fora_expediente`, sem passar do início do próximo expediente.
+    """
+
+    def __init__(self, intervalo: float = INTERVALO, minimo: float = INTERVALO_MINIMO,
+                 maximo: float = INTERVALO_MAXIMO, fora_expediente: float = INTERVALO_FORA_EXPEDIENTE,
+                 horario: str = HORARIO_EXPEDIENTE, dias: str = DIAS_EXPEDIENTE):
+        self.minimo = min(minimo, maximo)
+        self.maximo = maximo
+        self.fora_expediente = fora_expediente
+        self.intervalo = max(self.minimo, min(self.maximo, intervalo))
+        self.expediente = _ler_expediente(horario, dias)
+        self._acordar = threading.Event()
+
+    def registrar_ciclo(self, encontradas: int):
+        """Ajusta o intervalo pelo resultado do ciclo (nº de mensagens novas)."""
+        fator = FATOR_ACELERAR if encontradas else FATOR_DESACELERAR
+        self.intervalo = max(self.minimo, min(self.maximo, self.intervalo * fator))
+
+    def em_expediente(self, agora: Optional[datetime] = None) -> bool:
+        if self.expediente is None:
+            return True
+        agora = agora or datetime.now()
+        inicio, fim, dias = self.expediente
+        return agora.weekday() in dias and inicio <= agora.time() < fim
+
+    def _segundos_ate_expediente(self, agora: datetime) -> float:
+        inicio, _, dias = self.expediente
+        for delta in range(8):
+            dia = agora.date() + timedelta(days=delta)
+            abertura = datetime.combine(dia, inicio)
+            if dia.weekday() in dias and abertura > agora:
+                return (abertura - agora).total_seconds()
+        return self.fora_expediente
+
+    def proximo_intervalo(self, agora: Optional[datetime] = None) -> float:
+        agora = agora or datetime.now()
+        if self.em_expediente(agora):
+            return self.intervalo
+        return max(1.0, min(self.fora_expediente, self._segundos_ate_expediente(agora)))
+
+    def esperar(self, stop_event: threading.Event, segundos: float) -> bool:
+        """
+        Espera até `segundos`, interrompível por acordar(). Retorna True se o
+        stop_event foi setado (o loop deve parar).
+        """
+        if stop_event.is_set():
+            return True
+        self._acordar.wait(segundos)
+        self._acordar.clear()
+        return stop_event.is_set()
+
+    def acordar(self):
+        """Interrompe a espera atual: "Verificar agora" no tray, ou "Sair" (após setar o stop_event)."""
+        self._acordar.set()
@@ -0,0 +1 @@
+"""Benchmark do ciclo do bot com Gmail e Sheets falsos (ver bench/executar.py)."""
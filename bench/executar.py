@@ -0,0 +1,243 @@
+# bench/executar.py
+"""
+Benchmark ponta a ponta do ciclo do bot (processar_emails_enviados) sobre caixas
+sintéticas, com Gmail e Sheets falsos em processo — sem contas Google reais.
+
+A cada ciclo chegam `--threads` e-mails novos por conta, cada um com `--anexos` XMLs
+de `--parcelas` parcelas. O 1º ciclo usa a busca completa e os seguintes a
+sincronização incremental, como no bot. Ledger, log de eventos e estado de
+sincronização ficam numa pasta temporária.
+
+Mede tempo de parede dos ciclos, chamadas à API por NF e pico de memória de um ciclo
+(tracemalloc, só do processo principal — o pool de processos do XML fica de fora)
+e compara com o baseline salvo em bench/baseline.json.
+
+Uso (na raiz do projeto):
+    python -m bench.executar [--threads 50] [--anexos 2] [--parcelas 3] [--ciclos 3]
+                             [--latencia-gmail 0.05] [--latencia-sheets 0.2] [--taxa-429 0.01]
+                             [--salvar-baseline] [--tolerancia 0.2]
+Sai com código 1 se houver regressão em relação ao baseline e 2 se alguma parcela
+não chegou às planilhas.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PADRAO = os.path.join(BENCH_DIR, "baseline.json")
+
+CNPJ_MVA_BENCH = "11111111000191"
+CNPJ_EH_BENCH = "22222222000191"
+PLANILHA_BENCH = "bench-mva-2026"
+ABA_MODELO_BENCH = "Modelo"
+
+# Folga para cima (fração) antes de acusar regressão nas chamadas por NF
+TOLERANCIA_CHAMADAS = 0.05
+
+def _preparar_ambiente(contas: int):
+    """Variáveis lidas pelo config.py; precisa rodar antes de importar os módulos do bot."""
+    os.environ.update({
+        "GOOGLE_CREDENTIALS_GMAIL": "bench_gmail_1.json",
+        "GOOGLE_CREDENTIALS_GMAIL_CONTAS": ",".join(f"bench_gmail_{i}.json" for i in range(1, contas + 1)),
+        "GOOGLE_CREDENTIALS_SHEETS": "bench_sheets.json",
+        "CNPJ_MVA": CNPJ_MVA_BENCH,
+        "CNPJ_EH": CNPJ_EH_BENCH,
+        "SHEET_MVA_2026": PLANILHA_BENCH,
+        "GMAIL_PUSH_TOPICO": "",
+        "METRICAS_PORTA": "0",
+    })
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+def _isolar_estado(pasta: str):
+    """Aponta ledger, log de eventos, relatórios e estado de sincronização para a pasta temporária."""
+    import ledger, reporter, gmail_service
+    ledger.LEDGER_DB = os.path.join(pasta, "ledger.sqlite3")
+    reporter._log.caminho = os.path.join(pasta, "eventos.sqlite3")
+    reporter.relatorioDir = pasta
+    gmail_service.SYNC_STATE_FILE = os.path.join(pasta, "gmail_sync_state.json")
+
+def _cenario(args) -> str:
+    return (f"t{args.threads}-a{args.anexos}-p{args.parcelas}-c{args.ciclos}-k{args.contas}"
+            f"-lg{args.latencia_gmail}-ls{args.latencia_sheets}-e{args.taxa_429}")
+
+def executar(args) -> Dict[str, Any]:
+    pasta = tempfile.mkdtemp(prefix="botana_bench_")
+    _preparar_ambiente(args.contas)
+
+    import main
+    import gmail_service
+    import sheets_writer
+    from reporter import descarregarEventos
+    from metricas import metricas
+    from bench.fakes import Perturbacao, GmailFalso, SheetsFalso, ClienteSheetsFalso, CredenciaisSheetsFalsas
+    from bench.sintetico import anexos_da_thread
+
+    logging.getLogger().setLevel(logging.DEBUG if args.verboso else logging.WARNING)
+    _isolar_estado(pasta)
+    random.seed(args.semente)
+    if args.backoff_base is not None:
+        gmail_service.politica_gmail.base = sheets_writer.politica_sheets.base = args.backoff_base
+    if args.cota_gmail:
+        gmail_service.GMAIL_QUOTA_UNIDADES_POR_SEGUNDO = args.cota_gmail
+
+    # Gmail: um serviço falso por conta, no cache de getGmailService
+    caixas: List[GmailFalso] = []
+    for i, cred in enumerate(main.CONTAS_GMAIL, start=1):
+        caixa = GmailFalso(os.path.basename(cred), f"bench{i}@exemplo.com.br",
+                           Perturbacao(args.latencia_gmail, args.taxa_429, args.semente + i))
+        gmail_service._servicos[cred] = caixa
+        caixas.append(caixa)
+
+    # Sheets: planilha com as abas do ano já existentes (com linhas antigas, para o índice de duplicados)
+    sheets = SheetsFalso(Perturbacao(args.latencia_sheets, args.taxa_429, args.semente))
+    abas = {ABA_MODELO_BENCH: [list(sheets_writer.CABECALHO_ABA)]}
+    if args.linhas_existentes:
+        for mes in range(1, 13):
+            aba = main.datetime(2026, mes, 1).strftime("%b/%Y").capitalize()
+            abas[aba] = [list(sheets_writer.CABECALHO_ABA)] + [
+                ["10/%02d/2025" % mes, f"ANTIGA {n} (Bot)", str(n), "R$ 1.00", "1", "1ª Parcela", "R$ 1.00", "", ""]
+                for n in range(args.linhas_existentes)
+            ]
+    sheets.criar_planilha(PLANILHA_BENCH, "Contas a Receber MVA 2026", abas)
+    linhas_iniciais = sheets.total_linhas()
+    sessao = sheets_writer.SheetsSession("bench_sheets.json")
+    sessao._client = ClienteSheetsFalso(sheets)
+    sessao._creds = CredenciaisSheetsFalsas()
+    sheets_writer._sessao = sessao
+
+    metricas.limpar()
+    numero = 1
+    tempos_ciclo, encontradas, pico = [], 0, 0
+    tracemalloc.start()
+    try:
+        for _ in range(args.ciclos):
+            for caixa in caixas:
+                for _ in range(args.threads):
+                    caixa.adicionar_thread(f"t{numero}", anexos_da_thread(
+                        numero, CNPJ_MVA_BENCH, args.anexos, args.parcelas, args.itens))
+                    numero += args.anexos
+            # tempo e memória só do ciclo, sem a caixa sintética montada acima
+            tracemalloc.reset_peak()
+            memoria_antes = tracemalloc.get_traced_memory()[0]
+            inicio_ciclo = time.perf_counter()
+            encontradas += main.processar_emails_enviados()
+            tempos_ciclo.append(time.perf_counter() - inicio_ciclo)
+            pico = max(pico, tracemalloc.get_traced_memory()[1] - memoria_antes)
+    finally:
+        tracemalloc.stop()
+        descarregarEventos()
+    segundos = sum(tempos_ciclo)
+
+    if args.metricas:
+        with open(args.metricas, "w", encoding="utf-8") as fh:
+            fh.write(metricas.prometheus())
+
+    nfs = numero - 1
+    chamadas_gmail = Counter()
+    erros_429 = Counter()
+    requisicoes_gmail = 0
+    for caixa in caixas:
+        chamadas_gmail.update(caixa.contador.por_endpoint)
+        erros_429.update(caixa.contador.erros_429)
+        requisicoes_gmail += caixa.contador.requisicoes_http
+    erros_429.update(sheets.contador.erros_429)
+    chamadas = sum(chamadas_gmail.values()) + sheets.contador.total
+    # as abas criadas no ciclo começam com o cabeçalho, que não é parcela
+    linhas_gravadas = sheets.total_linhas() - linhas_iniciais - len(set(sheets.abas(PLANILHA_BENCH)) - set(abas))
+
+    shutil.rmtree(pasta, ignore_errors=True)
+    return {
+        "cenario": _cenario(args),
+        "segundos": round(segundos, 3),
+        "segundos_por_ciclo": [round(t, 3) for t in tempos_ciclo],
+        "mensagens": encontradas,
+        "nfs": nfs,
+        "linhas_esperadas": nfs * args.parcelas,
+        "linhas_gravadas": linhas_gravadas,
+        "nfs_por_segundo": round(nfs / segundos, 2) if segundos else None,
+        "chamadas_por_nf": round(chamadas / nfs, 3) if nfs else None,
+        "requisicoes_http_por_nf": round((requisicoes_gmail + sheets.contador.requisicoes_http) / nfs, 3) if nfs else None,
+        "pico_memoria_mb": round(pico / 1024 / 1024, 2),
+        "chamadas_gmail": dict(sorted(chamadas_gmail.items())),
+        "chamadas_sheets": dict(sorted(sheets.contador.por_endpoint.items())),
+        "erros_429": dict(sorted(erros_429.items())),
+    }
+
+def _comparar(resultado: Dict[str, Any], baseline: Dict[str, Any], tolerancia: float) -> List[str]:
+    """Descrição de cada métrica que piorou além da folga (tempo e memória: `tolerancia`)."""
+    regressoes = []
+    for chave, folga in (("segundos", tolerancia), ("pico_memoria_mb", tolerancia),
+                         ("chamadas_por_nf", TOLERANCIA_CHAMADAS)):
+        antes, agora = baseline.get(chave), resultado.get(chave)
+        if antes and agora is not None and agora > antes * (1 + folga):
+            regressoes.append(f"{chave}: {antes} -> {agora} (+{(agora / antes - 1) * 100:.0f}%, limite +{folga * 100:.0f}%)")
+    return regressoes
+
+def _ler_baseline(caminho: str) -> Dict[str, Any]:
+    try:
+        with open(caminho, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark do ciclo do Botana com Gmail e Sheets falsos.")
+    parser.add_argument("--threads", type=int, default=50, help="e-mails novos por conta a cada ciclo")
+    parser.add_argument("--anexos", type=int, default=2, help="XMLs por e-mail")
+    parser.add_argument("--parcelas", type=int, default=3, help="parcelas por NF")
+    parser.add_argument("--itens", type=int, default=20, help="itens <det> por NF (tamanho do XML)")
+    parser.add_argument("--ciclos", type=int, default=3)
+    parser.add_argument("--contas", type=int, default=1, help="contas do Gmail processadas em paralelo")
+    parser.add_argument("--linhas-existentes", type=int, default=500, help="linhas já presentes em cada aba do ano")
+    parser.add_argument("--latencia-gmail", type=float, default=0.05, help="segundos por requisição HTTP ao Gmail")
+    parser.add_argument("--latencia-sheets", type=float, default=0.2, help="segundos por requisição HTTP ao Sheets")
+    parser.add_argument("--taxa-429", type=float, default=0.0, help="probabilidade de cada chamada receber 429")
+    parser.add_argument("--backoff-base", type=float, default=None, help="base do backoff das políticas de retry (padrão: a do bot)")
+    parser.add_argument("--cota-gmail", type=float, default=None, help="unidades/s do limitador do Gmail (padrão: a do bot)")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--baseline", default=BASELINE_PADRAO)
+    parser.add_argument("--salvar-baseline", action="store_true", help="grava o resultado como baseline do cenário")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="folga para tempo e memória antes de acusar regressão")
+    parser.add_argument("--metricas", help="grava as métricas do bot (formato Prometheus) neste arquivo")
+    parser.add_argument("--verboso", action="store_true", help="mantém os logs do bot")
+    args = parser.parse_args(argv)
+    if args.threads <= 0:
+        parser.error("--threads deve ser positivo")
+
+    resultado = executar(args)
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+
+    codigo = 0
+    if resultado["linhas_gravadas"] != resultado["linhas_esperadas"]:
+        print(f"❌ {resultado['linhas_gravadas']} linhas gravadas, {resultado['linhas_esperadas']} esperadas.")
+        codigo = 2
+
+    baselines = _ler_baseline(args.baseline)
+    if args.salvar_baseline:
+        baselines[resultado["cenario"]] = {k: resultado[k] for k in ("segundos", "chamadas_por_nf", "pico_memoria_mb")}
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(baselines, fh, indent=2, sort_keys=True)
+        print(f"💾 Baseline do cenário {resultado['cenario']} salvo em {args.baseline}")
+    elif resultado["cenario"] in baselines:
+        regressoes = _comparar(resultado, baselines[resultado["cenario"]], args.tolerancia)
+        for r in regressoes:
+            print(f"⚠️ Regressão em {r}")
+        if regressoes and not codigo:
+            codigo = 1
+        if not regressoes:
+            print("✅ Sem regressões em relação ao baseline.")
+    else:
+        print(f"ℹ️ Sem baseline para o cenário {resultado['cenario']} (use --salvar-baseline).")
+    return codigo
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+# bench/fakes.py
+"""
+Serviços falsos, em processo, do Gmail (recursos usados pelo gmail_service) e do
+Google Sheets (camada HTTP do gspread), com latência configurável e injeção de 429.
+As planilhas usam os objetos reais do gspread (Spreadsheet/Worksheet) sobre um
+HTTPClient falso, então o caminho do sheets_writer é exercitado por inteiro.
+"""
+import json
+import time
+import base64
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httplib2
+import requests
+import gspread
+from gspread.http_client import HTTPClient
+from googleapiclient.errors import HttpError
+
+class Perturbacao:
+    """
+    Latência fixa por requisição HTTP, probabilidade de responder 429 e falhas
+    programadas por endpoint (ex.: as próximas 2 chamadas a threads.get da thread t5 dão 503).
+    """
+
+    def __init__(self, latencia: float = 0.0, taxa_429: float = 0.0, semente: Optional[int] = None):
+        self.latencia = latencia
+        self.taxa_429 = taxa_429
+        self._aleatorio = random.Random(semente)
+        self._lock = threading.Lock()
+        self._falhas: Dict[str, List[Dict[str, Any]]] = {}
+
+    def esperar(self):
+        if self.latencia > 0:
+            time.sleep(self.latencia)
+
+    def sortear_429(self) -> bool:
+        if self.taxa_429 <= 0:
+            return False
+        with self._lock:
+            return self._aleatorio.random() < self.taxa_429
+
+    def programar_falha(self, endpoint: str, status: int = 503, vezes: int = 1, depois: bool = False,
+                        **parametros):
+        """
+        As próximas `vezes` chamadas a `endpoint` (só as com os `parametros` informados,
+        ex.: messageId="mt4") respondem `status`. Com `depois`, a chamada tem efeito
+        antes do erro (ex.: append gravado e resposta 502 perdida).
+        """
+        with self._lock:
+            self._falhas.setdefault(endpoint, []).append(
+                {"status": status, "vezes": vezes, "depois": depois, "parametros": parametros})
+
+    def sortear_erro(self, endpoint: str, parametros: Optional[Dict[str, Any]] = None) -> Tuple[Optional[int], bool]:
+        """(status do erro desta chamada ou None, erro só depois do efeito)."""
+        parametros = parametros or {}
+        with self._lock:
+            programadas = self._falhas.get(endpoint, [])
+            for falha in programadas:
+                if all(parametros.get(k) == v for k, v in falha["parametros"].items()):
+                    falha["vezes"] -= 1
+                    if falha["vezes"] <= 0:
+                        programadas.remove(falha)
+                    return falha["status"], falha["depois"]
+        return (429, False) if self.sortear_429() else (None, False)
+
+class ContadorChamadas:
+    """Chamadas por endpoint e requisições HTTP (um lote HTTP é uma requisição só)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.por_endpoint: Counter = Counter()
+        self.erros_429: Counter = Counter()
+        self.requisicoes_http = 0
+
+    def registrar(self, endpoint: str, http: bool = True, erro_429: bool = False):
+        with self._lock:
+            self.por_endpoint[endpoint] += 1
+            if erro_429:
+                self.erros_429[endpoint] += 1
+            if http:
+                self.requisicoes_http += 1
+
+    def requisicao_http(self):
+        with self._lock:
+            self.requisicoes_http += 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.por_endpoint.values())
+
+# =========================
+# GMAIL
+# =========================
+
+_MENSAGENS_ERRO = {429: "Rate Limit Exceeded", 500: "Internal Error", 502: "Bad Gateway",
+                   503: "Service Unavailable", 504: "Gateway Timeout"}
+
+def _erro_gmail(status: int) -> HttpError:
+    corpo = {"error": {"code": status, "message": _MENSAGENS_ERRO.get(status, "Erro simulado")}}
+    return HttpError(httplib2.Response({"status": status}), json.dumps(corpo).encode())
+
+class _Requisicao:
+    """Equivalente ao HttpRequest do googleapiclient: methodId + execute(http=...)."""
+
+    def __init__(self, gmail: "GmailFalso", method_id: str, resolver: Callable[[], Any],
+                 parametros: Optional[Dict[str, Any]] = None):
+        self.gmail = gmail
+        self.methodId = method_id
+        self._resolver = resolver
+        self._parametros = parametros or {}
+
+    def _resolver_item(self, http: bool = False):
+        """Resposta dentro de um lote: conta a chamada, sem latência própria."""
+        status, depois = self.gmail.perturbacao.sortear_erro(self.methodId, self._parametros)
+        self.gmail.contador.registrar(self.methodId, http=http, erro_429=status == 429)
+        if status and not depois:
+            raise _erro_gmail(status)
+        resposta = self._resolver()
+        if status:
+            raise _erro_gmail(status)
+        return resposta
+
+    def execute(self, http=None, num_retries: int = 0):
+        self.gmail.perturbacao.esperar()
+        return self._resolver_item(http=True)
+
+class _Lote:
+    """Equivalente ao BatchHttpRequest: uma requisição HTTP com várias chamadas dentro."""
+
+    def __init__(self, gmail: "GmailFalso", callback):
+        self.gmail = gmail
+        self.callback = callback
+        self._itens: List[tuple] = []
+
+    def add(self, requisicao: _Requisicao, request_id: str):
+        self._itens.append((request_id, requisicao))
+
+    def execute(self, http=None):
+        self.gmail.perturbacao.esperar()
+        self.gmail.contador.requisicao_http()
+        for request_id, requisicao in self._itens:
+            try:
+                resposta, erro = requisicao._resolver_item(), None
+            except Exception as e:
+                resposta, erro = None, e
+            self.callback(request_id, resposta, erro)
+
+class _Recurso:
+    """Resolve users().threads().get(...) etc. para métodos do GmailFalso."""
+
+    def __init__(self, gmail: "GmailFalso", caminho: str):
+        self._gmail = gmail
+        self._caminho = caminho
+
+    def __getattr__(self, nome):
+        caminho = f"{self._caminho}.{nome}"
+        metodo = getattr(self._gmail, "_" + caminho.replace(".", "_"), None)
+        if metodo is not None:
+            return lambda **kw: _Requisicao(self._gmail, "gmail." + caminho, lambda: metodo(**kw), kw)
+        return lambda: _Recurso(self._gmail, caminho)
+
+class GmailFalso:
+    """
+    Caixa sintética com a mesma superfície do serviço do googleapiclient usada pelo bot:
+    threads.list/get, history.list, messages.attachments.get, messages.modify/batchModify,
+    labels.list/create e getProfile. `adicionar_thread` simula o envio de um e-mail novo.
+    """
+
+    PAGINA_HISTORICO = 100
+
+    def __init__(self, conta: str, email: str, perturbacao: Optional[Perturbacao] = None):
+        self._botana_conta = conta
+        # getGmailService só reaproveita serviços com credencial válida
+        self._botana_creds = type("CredenciaisFalsas", (), {"valid": True, "refresh_token": None})()
+        self._botana_email = email
+        self.perturbacao = perturbacao or Perturbacao()
+        self.contador = ContadorChamadas()
+        self._lock = threading.Lock()
+        self._threads: Dict[str, Dict[str, Any]] = {}
+        self._anexos: Dict[tuple, str] = {}
+        self._labels: Dict[str, str] = {"SENT": "SENT"}
+        self._historico: List[tuple] = []   # (historyId, msg_id, thread_id)
+        self._history_id = 1000
+
+    # ---------- montagem da caixa ----------
+    def adicionar_thread(self, thread_id: str, anexos: List[tuple]):
+        """Cria uma thread com uma mensagem enviada contendo os anexos [(nome, mime, bytes)]."""
+        with self._lock:
+            self._threads[thread_id] = {"id": thread_id, "historyId": "", "messages": []}
+        self._enviar_mensagem(thread_id, f"m{thread_id}", anexos)
+
+    def responder_thread(self, thread_id: str, anexos: List[tuple]) -> str:
+        """Acrescenta uma mensagem enviada a uma thread existente; retorna o id da mensagem."""
+        msg_id = f"m{thread_id}_{len(self._threads[thread_id]['messages']) + 1}"
+        self._enviar_mensagem(thread_id, msg_id, anexos)
+        return msg_id
+
+    def _enviar_mensagem(self, thread_id: str, msg_id: str, anexos: List[tuple]):
+        partes = []
+        for i, (nome, mime, dados) in enumerate(anexos, start=1):
+            att_id = f"att{msg_id}_{i}"
+            self._anexos[(msg_id, att_id)] = base64.urlsafe_b64encode(dados).decode()
+            partes.append({"partId": str(i), "filename": nome, "mimeType": mime,
+                           "body": {"attachmentId": att_id, "size": len(dados)}})
+        with self._lock:
+            self._history_id += 1
+            thread = self._threads[thread_id]
+            thread["historyId"] = str(self._history_id)
+            thread["messages"].append({
+                "id": msg_id, "threadId": thread_id, "labelIds": ["SENT"], "snippet": "",
+                "payload": {"mimeType": "multipart/mixed", "parts": [{"mimeType": "text/plain", "filename": "", "body": {"size": 0}}] + partes},
+            })
+            self._historico.append((self._history_id, msg_id, thread_id))
+
+    def new_batch_http_request(self, callback=None):
+        return _Lote(self, callback)
+
+    def users(self):
+        return _Recurso(self, "users")
+
+    # ---------- métodos (users.<recurso>.<método>) ----------
+    def _users_getProfile(self, userId):
+        with self._lock:
+            return {"emailAddress": self._botana_email, "historyId": str(self._history_id)}
+
+    def _users_threads_list(self, userId, q="", maxResults=100, pageToken=None):
+        # A busca do bot exclui as threads que já têm o rótulo de processado
+        with self._lock:
+            rotulados = {i for n, i in self._labels.items() if n != "SENT"}
+            ids = [t for t, th in self._threads.items()
+                   if not any(rotulados & set(m["labelIds"]) for m in th["messages"])]
+        inicio = int(pageToken or 0)
+        resposta = {"threads": [{"id": t} for t in ids[inicio:inicio + maxResults]], "resultSizeEstimate": len(ids)}
+        if inicio + maxResults < len(ids):
+            resposta["nextPageToken"] = str(inicio + maxResults)
+        return resposta
+
+    def _users_threads_get(self, userId, id, format="full"):
+        with self._lock:
+            return json.loads(json.dumps(self._threads[id]))
+
+    def _users_history_list(self, userId, startHistoryId, historyTypes=None, labelId=None, pageToken=None):
+        inicio = int(pageToken or 0)
+        with self._lock:
+            novos = [h for h in self._historico if h[0] > int(startHistoryId)]
+            pagina = novos[inicio:inicio + self.PAGINA_HISTORICO]
+            resposta = {"historyId": str(self._history_id), "history": [
+                {"id": str(hid), "messagesAdded": [{"message": {"id": mid, "threadId": tid, "labelIds": ["SENT"]}}]}
+                for hid, mid, tid in pagina
+            ]}
+        if inicio + self.PAGINA_HISTORICO < len(novos):
+            resposta["nextPageToken"] = str(inicio + self.PAGINA_HISTORICO)
+        return resposta
+
+    def _users_messages_attachments_get(self, userId, messageId, id):
+        dados = self._anexos[(messageId, id)]
+        return {"attachmentId": id, "size": len(dados), "data": dados}
+
+    def _rotular(self, ids, body):
+        with self._lock:
+            for th in self._threads.values():
+                for m in th["messages"]:
+                    if m["id"] in ids:
+                        m["labelIds"] = sorted(set(m["labelIds"]) | set(body.get("addLabelIds", []))
+                                               - set(body.get("removeLabelIds", [])))
+
+    def _users_messages_modify(self, userId, id, body):
+        self._rotular({id}, body)
+        return {"id": id}
+
+    def _users_messages_batchModify(self, userId, body):
+        self._rotular(set(body.get("ids", [])), body)
+        return ""
+
+    def _users_labels_list(self, userId):
+        with self._lock:
+            return {"labels": [{"id": i, "name": n} for n, i in self._labels.items()]}
+
+    def _users_labels_create(self, userId, body):
+        with self._lock:
+            label_id = self._labels.setdefault(body["name"], f"Label_{len(self._labels)}")
+        return {"id": label_id, "name": body["name"]}
+
+    def _users_watch(self, userId, body):
+        with self._lock:
+            return {"historyId": str(self._history_id),
+                    "expiration": str(int((time.time() + 7 * 86400) * 1000))}
+
+# =========================
+# SHEETS
+# =========================
+
+def _erro_sheets(status: int) -> gspread.exceptions.APIError:
+    resposta = requests.Response()
+    resposta.status_code = status
+    if status == 429:
+        erro = {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                "message": "Quota exceeded for quota metric 'Write requests' (bench)"}
+    else:
+        erro = {"code": status, "status": "UNAVAILABLE", "message": _MENSAGENS_ERRO.get(status, "Erro simulado")}
+    resposta._content = json.dumps({"error": erro}).encode()
+    return gspread.exceptions.APIError(resposta)
+
+def _titulo_do_intervalo(intervalo: str) -> str:
+    return intervalo.split("!")[0].strip("'")
+
+class SheetsFalso(HTTPClient):
+    """
+    HTTPClient do gspread que guarda as planilhas em memória. Atende as chamadas que
+    Spreadsheet/Worksheet fazem no bot: metadados, leitura de valores, append e batchUpdate.
+    """
+
+    def __init__(self, perturbacao: Optional[Perturbacao] = None):
+        # sem sessão autenticada: nenhuma chamada sai do processo
+        self.timeout = None
+        self.perturbacao = perturbacao or Perturbacao()
+        self.contador = ContadorChamadas()
+        self._lock = threading.Lock()
+        self._planilhas: Dict[str, Dict[str, Any]] = {}
+
+    def criar_planilha(self, planilha_id: str, titulo: str, abas: Dict[str, List[List[str]]]):
+        self._planilhas[planilha_id] = {"titulo": titulo, "abas": {}}
+        for nome, linhas in abas.items():
+            self._nova_aba(planilha_id, nome, [list(l) for l in linhas])
+
+    def _nova_aba(self, planilha_id: str, titulo: str, linhas: List[List[str]], sheet_id: Optional[int] = None):
+        abas = self._planilhas[planilha_id]["abas"]
+        abas[titulo] = {"id": sheet_id or len(abas) + 1, "indice": len(abas), "linhas": linhas}
+        return abas[titulo]
+
+    def abas(self, planilha_id: str) -> List[str]:
+        return list(self._planilhas[planilha_id]["abas"])
+
+    def linhas(self, planilha_id: str, aba: str) -> List[List[str]]:
+        return self._planilhas[planilha_id]["abas"][aba]["linhas"]
+
+    def total_linhas(self) -> int:
+        return sum(len(a["linhas"]) for p in self._planilhas.values() for a in p["abas"].values())
+
+    def _chamada(self, endpoint: str) -> Optional[int]:
+        """Conta a chamada e lança o erro sorteado; devolve o status de um erro que vem só depois do efeito."""
+        self.perturbacao.esperar()
+        status, depois = self.perturbacao.sortear_erro(endpoint)
+        self.contador.registrar(endpoint, erro_429=status == 429)
+        if status and not depois:
+            raise _erro_sheets(status)
+        return status
+
+    @staticmethod
+    def _propriedades(titulo: str, aba: Dict[str, Any]) -> Dict[str, Any]:
+        return {"sheetId": aba["id"], "title": titulo, "index": aba["indice"], "sheetType": "GRID",
+                "gridProperties": {"rowCount": max(100, len(aba["linhas"])), "columnCount": 9}}
+
+    def fetch_sheet_metadata(self, id: str, params=None) -> Dict[str, Any]:
+        self._chamada("spreadsheets.get")
+        with self._lock:
+            planilha = self._planilhas[id]
+            return {"spreadsheetId": id, "properties": {"title": planilha["titulo"], "locale": "pt_BR"},
+                    "sheets": [{"properties": self._propriedades(t, a)} for t, a in planilha["abas"].items()]}
+
+    def values_get(self, id: str, range: str, params=None) -> Dict[str, Any]:
+        self._chamada("spreadsheets.values.get")
+        titulo = _titulo_do_intervalo(range)
+        with self._lock:
+            linhas = [list(l) for l in self._planilhas[id]["abas"][titulo]["linhas"]]
+        return {"range": f"'{titulo}'!A1:I{max(1, len(linhas))}", "majorDimension": "ROWS", "values": linhas}
+
+    def values_append(self, id: str, range: str, params, body) -> Dict[str, Any]:
+        erro_depois = self._chamada("spreadsheets.values.append")
+        titulo = _titulo_do_intervalo(range)
+        novas = [[str(v) for v in l] for l in body.get("values", [])]
+        with self._lock:
+            linhas = self._planilhas[id]["abas"][titulo]["linhas"]
+            inicio = len(linhas) + 1
+            linhas.extend(novas)
+        if erro_depois:
+            raise _erro_sheets(erro_depois)
+        return {"spreadsheetId": id, "updates": {
+            "updatedRange": f"'{titulo}'!A{inicio}:I{inicio + len(novas) - 1}", "updatedRows": len(novas)}}
+
+    def batch_update(self, id: str, body) -> Dict[str, Any]:
+        self._chamada("spreadsheets.batchUpdate")
+        respostas = []
+        with self._lock:
+            por_id = {}
+            for req in body.get("requests", []):
+                if "addSheet" in req:
+                    props = req["addSheet"]["properties"]
+                    aba = self._nova_aba(id, props["title"], [], props.get("sheetId"))
+                    por_id[aba["id"]] = aba
+                    respostas.append({"addSheet": {"properties": self._propriedades(props["title"], aba)}})
+                elif "appendCells" in req:
+                    aba = por_id.get(req["appendCells"]["sheetId"])
+                    if aba is not None:
+                        for linha in req["appendCells"]["rows"]:
+                            aba["linhas"].append([c["userEnteredValue"]["stringValue"] for c in linha["values"]])
+                    respostas.append({})
+                else:
+                    respostas.append({})
+        return {"spreadsheetId": id, "replies": respostas}
+
+class ClienteSheetsFalso:
+    """No lugar do gspread.Client: open_by_key devolve um gspread.Spreadsheet real sobre o SheetsFalso."""
+
+    def __init__(self, http: SheetsFalso):
+        self.http_client = http
+
+    def open_by_key(self, key: str) -> gspread.Spreadsheet:
+        return gspread.Spreadsheet(self.http_client, {"id": key})
+
+class CredenciaisSheetsFalsas:
+    """Token sempre válido, para a SheetsSession não tentar renovar."""
+    valid = True
+
+    def __init__(self):
+        self.expiry = datetime.utcnow() + timedelta(days=1)
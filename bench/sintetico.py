@@ -0,0 +1,51 @@
+# bench/sintetico.py
+"""
+Geração de NF-e sintéticas (leiaute nfeProc 4.00 reduzido ao que o bot lê, mais os
+itens <det> para o tamanho do XML ficar realista) e das caixas de e-mail do benchmark.
+"""
+from datetime import date
+from typing import List, Tuple
+
+NS = "http://www.portalfiscal.inf.br/nfe"
+
+def _chave_acesso(numero: int, cnpj: str) -> str:
+    base = f"35{2601}{cnpj:0>14}55001{numero:09d}1{numero % 10**8:08d}"
+    return (base + "0" * 44)[:44]
+
+def gerar_nfe(numero: int, cnpj_emitente: str, parcelas: int, itens: int = 20, ano: int = 2026) -> bytes:
+    """NF-e com `parcelas` duplicatas mensais (vencimentos em `ano`) e `itens` produtos."""
+    valor_parcela = 100.0 + numero % 900
+    total = valor_parcela * max(1, parcelas)
+    dets = "".join(
+        f'<det nItem="{i}"><prod><cProd>{i:05d}</cProd><xProd>PRODUTO SINTETICO {i}</xProd>'
+        f"<NCM>84713012</NCM><CFOP>5102</CFOP><uCom>UN</uCom><qCom>1.0000</qCom>"
+        f"<vUnCom>{total / max(1, itens):.2f}</vUnCom><vProd>{total / max(1, itens):.2f}</vProd></prod>"
+        f"<imposto><ICMS><ICMS00><orig>0</orig><CST>00</CST><vBC>0.00</vBC></ICMS00></ICMS></imposto></det>"
+        for i in range(1, itens + 1)
+    )
+    dups = "".join(
+        f"<dup><nDup>{p:03d}</nDup><dVenc>{date(ano, (numero + p - 1) % 12 + 1, 10).isoformat()}</dVenc>"
+        f"<vDup>{valor_parcela:.2f}</vDup></dup>"
+        for p in range(1, parcelas + 1)
+    )
+    cobr = f"<cobr><fat><nFat>{numero}</nFat><vLiq>{total:.2f}</vLiq></fat>{dups}</cobr>" if parcelas else ""
+    xml = (
+        f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NS}" versao="4.00">'
+        f'<NFe><infNFe Id="NFe{_chave_acesso(numero, cnpj_emitente)}" versao="4.00">'
+        f"<ide><cUF>35</cUF><natOp>VENDA DE MERCADORIA</natOp><mod>55</mod><serie>1</serie>"
+        f"<nNF>{numero}</nNF><dhEmi>{ano}-01-05T10:00:00-03:00</dhEmi></ide>"
+        f"<emit><CNPJ>{cnpj_emitente}</CNPJ><xNome>EMITENTE BENCH LTDA</xNome></emit>"
+        f"<dest><CNPJ>{numero:014d}</CNPJ><xNome>CLIENTE {numero}</xNome></dest>"
+        f"{dets}<total><ICMSTot><vProd>{total:.2f}</vProd><vNF>{total:.2f}</vNF></ICMSTot></total>"
+        f"{cobr}</infNFe></NFe></nfeProc>"
+    )
+    return xml.encode("utf-8")
+
+def anexos_da_thread(primeiro_numero: int, cnpj_emitente: str, anexos: int, parcelas: int,
+                     itens: int) -> List[Tuple[str, str, bytes]]:
+    """Os `anexos` XMLs de uma mensagem: [(nome, mime, conteúdo)], NFs numeradas a partir de `primeiro_numero`."""
+    return [
+        (f"NFe{primeiro_numero + i}.xml", "application/xml",
+         gerar_nfe(primeiro_numero + i, cnpj_emitente, parcelas, itens))
+        for i in range(anexos)
+    ]
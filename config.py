@@ -18,6 +18,14 @@ os.makedirs(RELATORIO_DIR, exist_ok=True)
 GOOGLE_CREDENTIALS_GMAIL = os.path.join(SECRETS_DIR, os.getenv("GOOGLE_CREDENTIALS_GMAIL"))
 GOOGLE_CREDENTIALS_SHEETS = os.path.join(SECRETS_DIR, os.getenv("GOOGLE_CREDENTIALS_SHEETS"))
 
+# Caixas do Gmail verificadas em paralelo (uma credencial por conta, separadas por vírgula).
+# Ex.: GOOGLE_CREDENTIALS_GMAIL_CONTAS=gmail_mva.json,gmail_eh.json — sem ela, só a conta acima.
+CONTAS_GMAIL = [
+    os.path.join(SECRETS_DIR, nome.strip())
+    for nome in (os.getenv("GOOGLE_CREDENTIALS_GMAIL_CONTAS") or "").split(",")
+    if nome.strip()
+] or [GOOGLE_CREDENTIALS_GMAIL]
+
 # Planilhas
 PLANILHAS = {
     "MVA": {
@@ -36,3 +44,38 @@ CNPJ_EH = os.getenv("CNPJ_EH")
 
 # Intervalo
 INTERVALO = int(os.getenv("INTERVALO", "600"))
+
+# Agendador adaptativo: o intervalo cai até o mínimo enquanto chegam e-mails novos
+# e sobe até o máximo com a caixa parada. Fora do expediente (ex.: "08:00-18:00",
+# dias 0=segunda ... 6=domingo) usa INTERVALO_FORA_EXPEDIENTE; vazio = sempre expediente.
+INTERVALO_MINIMO = int(os.getenv("INTERVALO_MINIMO", "60"))
+INTERVALO_MAXIMO = int(os.getenv("INTERVALO_MAXIMO", "1800"))
+INTERVALO_FORA_EXPEDIENTE = int(os.getenv("INTERVALO_FORA_EXPEDIENTE", "3600"))
+HORARIO_EXPEDIENTE = os.getenv("HORARIO_EXPEDIENTE", "")
+DIAS_EXPEDIENTE = os.getenv("DIAS_EXPEDIENTE", "0,1,2,3,4")
+
+# Gmail: downloads de anexos em paralelo, limitados pela cota por usuário
+# (250 unidades/s; attachments.get custa 5 unidades)
+GMAIL_DOWNLOAD_WORKERS = int(os.getenv("GMAIL_DOWNLOAD_WORKERS", "4"))
+GMAIL_QUOTA_UNIDADES_POR_SEGUNDO = int(os.getenv("GMAIL_QUOTA_UNIDADES_POR_SEGUNDO", "250"))
+
+# Sheets: orçamento de requisições por minuto, leituras e escritas somadas
+# (a cota por usuário da API é de 60 leituras + 60 escritas por minuto)
+SHEETS_REQ_POR_MINUTO = int(os.getenv("SHEETS_REQ_POR_MINUTO", "100"))
+
+# XML: processos usados para analisar lotes grandes (reprocessamentos de backlog)
+XML_PROCESSOS = int(os.getenv("XML_PROCESSOS", str(os.cpu_count() or 1)))
+
+# Modo push (opcional): com um tópico Pub/Sub configurado, o bot registra users.watch
+# em cada conta e recebe as notificações num servidor HTTP local (a assinatura push do
+# Pub/Sub deve apontar para ele, ex.: via túnel HTTPS, com ?token=GMAIL_PUSH_TOKEN).
+# O polling continua como rede de segurança a cada INTERVALO_SEGURANCA_PUSH segundos.
+GMAIL_PUSH_TOPICO = os.getenv("GMAIL_PUSH_TOPICO", "")
+GMAIL_PUSH_HOST = os.getenv("GMAIL_PUSH_HOST", "127.0.0.1")
+GMAIL_PUSH_PORTA = int(os.getenv("GMAIL_PUSH_PORTA", "8085"))
+GMAIL_PUSH_TOKEN = os.getenv("GMAIL_PUSH_TOKEN", "")
+INTERVALO_SEGURANCA_PUSH = int(os.getenv("INTERVALO_SEGURANCA_PUSH", "3600"))
+
+# Métricas (formato Prometheus) em http://METRICAS_HOST:METRICAS_PORTA/metrics; 0 desliga
+METRICAS_HOST = os.getenv("METRICAS_HOST", "127.0.0.1")
+METRICAS_PORTA = int(os.getenv("METRICAS_PORTA", "9108"))
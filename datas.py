@@ -0,0 +1,54 @@
+# datas.py
+"""
+Leitura de datas compartilhada pelo parser de XML e pela escrita nas planilhas.
+Os vencimentos se repetem muito entre notas, então o resultado fica num cache LRU.
+"""
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+
+# Quantidade de textos de data lembrados (vencimentos e emissões repetem bastante)
+TAMANHO_CACHE_DATAS = 4096
+
+# ISO do XML: dVenc "2025-11-10" e dhEmi "2025-10-01T10:00:00-03:00" (ou com Z)
+_RE_ISO = re.compile(r"\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?")
+# Brasileiro: 10/11/2025, 10-11-2025, 10.11.2025
+_RE_DMY = re.compile(r"(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})")
+
+# Formatos tentados quando o texto não tem nenhum dos formatos acima
+_FORMATOS = ("%d/%m/%Y", "%Y-%m-%d", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M:%S", "%d-%m-%Y", "%d.%m.%Y")
+
+def _parse_lento(texto: str) -> Optional[datetime]:
+    for fmt in _FORMATOS:
+        try:
+            return datetime.strptime(texto, fmt)
+        except ValueError:
+            continue
+    try:
+        return datetime.fromisoformat(texto.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=TAMANHO_CACHE_DATAS)
+def parse_data(texto: Optional[str]) -> Optional[datetime]:
+    """Converte o texto em datetime (ISO ou DD/MM/YYYY). Retorna None se não reconhecer."""
+    if not texto:
+        return None
+    texto = texto.strip()
+    try:
+        if _RE_ISO.fullmatch(texto):
+            return datetime.fromisoformat(texto.replace("Z", "+00:00"))
+        m = _RE_DMY.fullmatch(texto)
+        if m:
+            dia, mes, ano = m.groups()
+            return datetime(int(ano), int(mes), int(dia))
+    except ValueError:
+        return None  # formato reconhecido, mas data impossível (ex.: 31/02)
+    return _parse_lento(texto)
+
+@lru_cache(maxsize=TAMANHO_CACHE_DATAS)
+def data_ddmmyyyy(texto: Optional[str]) -> str:
+    """Normaliza o texto para 'DD/MM/YYYY'. Retorna '' se falhar."""
+    dt = parse_data(texto)
+    return dt.strftime("%d/%m/%Y") if dt else ""
@@ -1,14 +1,25 @@
 # gmail_service.py
 import os
+import json
+import io
 import base64
 import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from typing import List, Dict, Any
+import threading
+from typing import List, Dict, Any, Optional, Tuple, Hashable, BinaryIO
+import httplib2
+import google_auth_httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from config import GOOGLE_CREDENTIALS_GMAIL, DOWNLOAD_DIR
+from config import GOOGLE_CREDENTIALS_GMAIL, BASE_DIR, GMAIL_DOWNLOAD_WORKERS, GMAIL_QUOTA_UNIDADES_POR_SEGUNDO
+from rate_limit import TokenBucket, PoliticaRetry, status_http
+from metricas import metricas
+from ledger import obterWatermark, mensagensJaProcessadas, registrarProcessadas
 
 
 # Scopes: precisamos de modify para acrescentar labels (e opcionalmente marcar como lido)
@@ -16,90 +27,497 @@ SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 
 logger = logging.getLogger("bot.gmail_service")
 LABEL_NAME = "XML Processado Botana"
+QUERY_ENVIADOS = "in:sent has:attachment filename:xml"
+
+# Limites recomendados pela API: até 50 chamadas por lote HTTP, até 1000 ids por batchModify
+TAMANHO_LOTE = 50
+TAMANHO_BATCH_MODIFY = 1000
+
+# Custo (unidades de cota) de cada método usado, conforme a documentação da Gmail API
+CUSTO_THREADS_GET = 10
+CUSTO_MESSAGES_GET = 5
+CUSTO_ATTACHMENTS_GET = 5
+CUSTO_MESSAGES_MODIFY = 5
+
+# Retry/backoff compartilhado por todas as chamadas ao Gmail (a cota por segundo fica no TokenBucket)
+politica_gmail = PoliticaRetry("Gmail")
+
+# PDFs acima deste tamanho saem da memória para um arquivo temporário
+LIMITE_PDF_EM_MEMORIA = 2 * 1024 * 1024
+
+# Estado da sincronização incremental (último historyId confirmado por conta)
+SYNC_STATE_FILE = os.path.join(BASE_DIR, "gmail_sync_state.json")
+_sync_lock = threading.Lock()
+_history_pendente: Dict[str, str] = {}
+# Contas cuja última busca ficou incompleta (motivo): o historyId não avança
+_sync_incompleta: Dict[str, str] = {}
 
 def _get_token_path(cred_path: str) -> str:
     return cred_path.replace(".json", "_token.json")
 
+# Serviço por arquivo de credencial, reaproveitado entre ciclos
+_servicos: Dict[str, Any] = {}
+# A autorização no navegador (primeira execução) é feita uma conta por vez
+_auth_lock = threading.Lock()
+
 def getGmailService(cred_file: str = GOOGLE_CREDENTIALS_GMAIL):
     """
     Autentica e retorna um serviço Gmail (v1). Salva token em cred_file_token.json.
+    O serviço de cada conta é criado uma vez e reaproveitado enquanto o token for renovável.
     """
-    token_path = _get_token_path(cred_file)
-    creds = None
-    if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(cred_file, SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open(token_path, "w", encoding="utf-8") as fh:
-            fh.write(creds.to_json())
-
-    service = build("gmail", "v1", credentials=creds)
-    return service
-
-def ensure_label(service, label_name: str = LABEL_NAME) -> str:
-    """Retorna o id do rótulo, criando se necessário."""
-    labels = service.users().labels().list(userId="me").execute().get("labels", [])
+    with _auth_lock:
+        service = _servicos.get(cred_file)
+        if service is not None:
+            creds = service._botana_creds
+            if creds.valid or creds.refresh_token:
+                return service
+
+        token_path = _get_token_path(cred_file)
+        creds = None
+        if os.path.exists(token_path):
+            creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(cred_file, SCOPES)
+                creds = flow.run_local_server(port=0)
+            with open(token_path, "w", encoding="utf-8") as fh:
+                fh.write(creds.to_json())
+
+        service = build("gmail", "v1", credentials=creds)
+        service._botana_conta = os.path.basename(cred_file)
+        service._botana_creds = creds
+        _servicos[cred_file] = service
+        return service
+
+def conta_do_servico(service) -> str:
+    """Identifica a conta (arquivo de credencial) de um serviço criado por getGmailService."""
+    return getattr(service, "_botana_conta", None) or os.path.basename(GOOGLE_CREDENTIALS_GMAIL)
+
+# =========================
+# COTA E CONEXÕES POR THREAD
+# =========================
+
+# Um balde de fichas por conta, dimensionado pela cota por usuário da Gmail API
+_limitadores: Dict[str, TokenBucket] = {}
+_limitadores_lock = threading.Lock()
+_http_local = threading.local()
+
+def limitador_da_conta(service) -> TokenBucket:
+    conta = conta_do_servico(service)
+    with _limitadores_lock:
+        if conta not in _limitadores:
+            _limitadores[conta] = TokenBucket(GMAIL_QUOTA_UNIDADES_POR_SEGUNDO)
+        return _limitadores[conta]
+
+def _http_da_thread(service):
+    """
+    httplib2 não é thread-safe: cada thread (downloads e etapas do pipeline) usa
+    sua própria conexão autorizada com as credenciais do serviço.
+    """
+    creds = getattr(service, "_botana_creds", None)
+    if creds is None:
+        return None
+    conexoes = getattr(_http_local, "conexoes", None)
+    if conexoes is None:
+        conexoes = _http_local.conexoes = {}
+    conta = conta_do_servico(service)
+    if conta not in conexoes:
+        conexoes[conta] = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+    return conexoes[conta]
+
+# =========================
+# LOTES (batch HTTP)
+# =========================
+
+def executar_em_lote(service, requisicoes: List[Tuple[Hashable, Any]],
+                     custo_por_item: int = CUSTO_MESSAGES_GET) -> Dict[Hashable, Tuple[Any, Optional[Exception]]]:
+    """
+    Executa várias requisições da API em lotes HTTP (new_batch_http_request).
+    Recebe pares (chave, requisição) e devolve {chave: (resposta, erro)} — o erro
+    de um item não interrompe os demais do lote. Cada lote consome do limitador
+    da conta o custo de cota dos seus itens. Itens que falham com erro retentável
+    (429/5xx) são reenviados num novo lote, com o backoff de politica_gmail.
+    """
+    resultados: Dict[Hashable, Tuple[Any, Optional[Exception]]] = {}
+
+    def _callback(request_id, response, exception):
+        resultados[chaves[request_id]] = (response, exception)
+
+    pendentes = list(requisicoes)
+    tentativa = 0
+    while pendentes:
+        for inicio in range(0, len(pendentes), TAMANHO_LOTE):
+            grupo = pendentes[inicio:inicio + TAMANHO_LOTE]
+            chaves = {str(i): chave for i, (chave, _) in enumerate(grupo)}
+            limitador_da_conta(service).consumir(custo_por_item * len(grupo))
+            batch = service.new_batch_http_request(callback=_callback)
+            for i, (_, req) in enumerate(grupo):
+                batch.add(req, request_id=str(i))
+            try:
+                politica_gmail.executar(batch.execute, http=_http_da_thread(service))
+            except Exception as e:
+                # Falha do lote inteiro (rede/autenticação): registra o erro em cada item sem resposta
+                logger.warning("Falha ao executar lote de %d requisições: %s", len(grupo), e)
+                for chave in chaves.values():
+                    if chave not in resultados or resultados[chave][1] is not None:
+                        resultados[chave] = (None, e)
+
+        for chave, req in pendentes:
+            erro = resultados.get(chave, (None, None))[1]
+            resultado = "ok" if erro is None else ("429" if status_http(erro) == 429 else "erro")
+            metricas.contar("botana_gmail_itens_lote_total", endpoint=getattr(req, "methodId", "desconhecido"), resultado=resultado)
+
+        falhas = [(chave, req) for chave, req in pendentes
+                  if resultados.get(chave, (None, None))[1] is not None
+                  and politica_gmail.retentavel(resultados[chave][1])]
+        if not falhas or not politica_gmail.registrar_falha(tentativa, resultados[falhas[0][0]][1], "BatchHttpRequest"):
+            break
+        pendentes = falhas
+        tentativa += 1
+    return resultados
+
+# Registro de rótulos por conta: (conta, nome do rótulo em minúsculas) -> id
+_label_ids: Dict[Tuple[str, str], str] = {}
+_label_lock = threading.Lock()
+
+def _resolver_label(service, label_name: str) -> str:
+    labels = politica_gmail.executar(service.users().labels().list(userId="me").execute, http=_http_da_thread(service)).get("labels", [])
     for l in labels:
         if l.get("name", "").lower() == label_name.lower():
             return l["id"]
 
     body = {"name": label_name, "labelListVisibility": "labelShow", "messageListVisibility": "show"}
-    created = service.users().labels().create(userId="me", body=body).execute()
+    created = politica_gmail.executar(service.users().labels().create(userId="me", body=body).execute, http=_http_da_thread(service))
     logger.info("Rótulo criado: %s (%s)", label_name, created.get("id"))
     return created.get("id")
 
-def buscarMessagesEnviados(service, max_results: int = 15) -> List[Dict[str, Any]]:
+def ensure_label(service, label_name: str = LABEL_NAME) -> str:
     """
-    Busca threads com mensagens enviadas contendo anexos XML
-    e retorna todas as mensagens (enviadas e recebidas) dentro dessas threads.
+    Retorna o id do rótulo, criando se necessário. O id fica guardado por conta
+    durante todo o processo; só é buscado de novo após invalidar_label().
     """
-    q = "in:sent has:attachment filename:xml"
-
+    chave = (conta_do_servico(service), label_name.lower())
+    with _label_lock:
+        label_id = _label_ids.get(chave)
+        if label_id:
+            return label_id
+        label_id = _resolver_label(service, label_name)
+        _label_ids[chave] = label_id
+        return label_id
+
+def invalidar_label(service, label_name: str = LABEL_NAME):
+    """Descarta o id guardado (ex.: rótulo apagado ou recriado no Gmail)."""
+    with _label_lock:
+        _label_ids.pop((conta_do_servico(service), label_name.lower()), None)
+
+def _erro_label_invalido(e: Exception) -> bool:
+    """Erro de modify causado por id de rótulo inexistente/inválido."""
+    if not isinstance(e, HttpError) or getattr(e, "resp", None) is None:
+        return False
+    return e.resp.status in (400, 404) and "label" in str(e).lower()
+
+def _mensagens_das_threads(service, thread_ids: List[str]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Obtém as threads informadas e retorna (mensagens, ids das threads que falharam).
+    As mensagens (enviadas e recebidas) são as que têm anexos PDF/XML, já com os
+    descritores dos anexos em "anexos". Mensagens que já têm o rótulo de processado
+    ficam de fora (uma thread rotulada volta inteira quando recebe mensagem nova) e
+    entram no ledger, caso ele ainda não as conheça.
+    """
+    results = []
+    falhas = []
+    rotuladas = []
     try:
-        resp = service.users().threads().list(userId="me", q=q, maxResults=max_results).execute()
-        threads = resp.get("threads", []) or []
-        results = []
+        label_processado = ensure_label(service)
+    except Exception as e:
+        logger.warning("Rótulo %s indisponível; mensagens rotuladas não serão filtradas: %s", LABEL_NAME, e)
+        label_processado = None
+    respostas = executar_em_lote(
+        service, [(t, service.users().threads().get(userId="me", id=t)) for t in thread_ids],
+        custo_por_item=CUSTO_THREADS_GET,
+    )
+    for thread_id in thread_ids:
+        try:
+            thread, erro = respostas.get(thread_id, (None, None))
+            if erro is not None:
+                raise erro
+            msgs = (thread or {}).get("messages", [])
+
+            for msg in msgs:
+                # Reaproveita o payload já baixado: descreve os anexos PDF/XML aqui mesmo,
+                # sem precisar de um messages.get por mensagem na etapa de download
+                anexos = _descritores_anexos(msg["id"], msg.get("payload", {}) or {})
+                if not anexos:
+                    continue
+                if label_processado and label_processado in msg.get("labelIds", []):
+                    rotuladas.append(msg)
+                    continue
 
-        logger.info("Buscar: %d threads encontradas", len(threads))
+                results.append({
+                    "id": msg["id"],
+                    "threadId": msg["threadId"],
+                    "labelIds": msg.get("labelIds", []),
+                    "snippet": msg.get("snippet", ""),
+                    "temXml": any(a["filename"].lower().endswith(".xml") for a in anexos),
+                    "anexos": anexos,
+                })
 
-        for t in threads:
-            thread_id = t.get("id")
-            try:
-                thread = service.users().threads().get(userId="me", id=thread_id).execute()
-                msgs = thread.get("messages", [])
-                
-                for msg in msgs:
-                    payload = msg.get("payload", {})
-                    parts = payload.get("parts", []) or []
-
-                    # Verifica anexos dentro das partes aninhadas (caso Gmail codifique assim)
-                    for part in parts:
-                        if "parts" in part:
-                            for sub in part["parts"]:
-                                if sub.get("filename", "").lower().endswith(".xml"):
-                                    break
-
-                    results.append({
-                        "id": msg["id"],
-                        "threadId": msg["threadId"],
-                        "labelIds": msg.get("labelIds", []),
-                        "snippet": msg.get("snippet", ""),
-                    })
+        except Exception as e:
+            logger.warning("Falha ao obter thread %s: %s", thread_id, e)
+            falhas.append(thread_id)
+            continue
+    if rotuladas:
+        registrarProcessadas(conta_do_servico(service), rotuladas)
+    return results, falhas
 
-            except Exception as e:
-                logger.warning("Falha ao obter thread %s: %s", thread_id, e)
-                continue
-        return results
+def _montar_query(service, label_name: str = LABEL_NAME) -> str:
+    """
+    Query de busca: exclui mensagens que já receberam o rótulo de processado
+    e limita pela marca d'água "after:" gravada no registro local.
+    """
+    # No operador label: do Gmail, espaços do nome viram hífens
+    q = f"{QUERY_ENVIADOS} -label:{label_name.lower().replace(' ', '-')}"
+    watermark = obterWatermark(conta_do_servico(service))
+    if watermark:
+        q += f" after:{watermark}"
+    return q
+
+def _threads_da_busca(service, max_results: int, todas_as_paginas: bool = False) -> List[str]:
+    """
+    Ids das threads da busca. Com `todas_as_paginas`, percorre todas as páginas de
+    `max_results` antes de devolver (nada é rotulado enquanto a lista é montada).
+    """
+    q = _montar_query(service)
+    ids: List[str] = []
+    page_token = None
+    while True:
+        resp = politica_gmail.executar(service.users().threads().list(
+            userId="me", q=q, maxResults=max_results, pageToken=page_token
+        ).execute, http=_http_da_thread(service))
+        ids.extend(t.get("id") for t in resp.get("threads", []) or [])
+        page_token = resp.get("nextPageToken")
+        if not todas_as_paginas or not page_token:
+            break
+    logger.info("Buscar: %d threads encontradas", len(ids))
+    return ids
+
+def buscarMessagesEnviados(service, max_results: int = 15) -> List[Dict[str, Any]]:
+    """
+    Busca threads com mensagens enviadas contendo anexos XML (ainda sem o rótulo
+    de processado) e retorna todas as mensagens (enviadas e recebidas) dentro dessas threads.
+    """
+    try:
+        return _mensagens_das_threads(service, _threads_da_busca(service, max_results))[0]
 
     except Exception as e:
         logger.exception("Erro ao listar threads: %s", e)
         return []
 
+# =========================
+# SINCRONIZAÇÃO INCREMENTAL (historyId)
+# =========================
+
+def _carregar_sync_state() -> Dict[str, Any]:
+    try:
+        with open(SYNC_STATE_FILE, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning("Estado de sincronização ilegível (%s); será feita busca completa.", e)
+        return {}
+
+def _salvar_sync_state(state: Dict[str, Any]):
+    tmp_path = SYNC_STATE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(state, fh, indent=2)
+    os.replace(tmp_path, SYNC_STATE_FILE)
+
+def _history_id_atual(service) -> Optional[str]:
+    try:
+        return str(politica_gmail.executar(service.users().getProfile(userId="me").execute, http=_http_da_thread(service)).get("historyId") or "") or None
+    except Exception as e:
+        logger.warning("Falha ao obter historyId atual: %s", e)
+        return None
+
+def _threads_alteradas_desde(service, start_history_id: str):
+    """
+    Percorre users.history.list a partir de start_history_id e retorna
+    (ids de threads com mensagens enviadas novas, historyId mais recente).
+    Lança HttpError 404 quando o histórico expirou.
+    """
+    msgs_por_thread: Dict[str, List[str]] = {}
+    ultimo_history_id = start_history_id
+    page_token = None
+
+    while True:
+        resp = politica_gmail.executar(service.users().history().list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            labelId="SENT",
+            pageToken=page_token,
+        ).execute, http=_http_da_thread(service))
+
+        for h in resp.get("history", []) or []:
+            for added in h.get("messagesAdded", []) or []:
+                message = added.get("message") or {}
+                if message.get("threadId") and message.get("id"):
+                    msgs_por_thread.setdefault(message["threadId"], []).append(message["id"])
+
+        ultimo_history_id = str(resp.get("historyId") or ultimo_history_id)
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            break
+
+    # Threads cujas mensagens novas já constam no registro local não precisam ser baixadas
+    feitas = mensagensJaProcessadas(
+        conta_do_servico(service), [mid for ids in msgs_por_thread.values() for mid in ids]
+    )
+    thread_ids = [t for t, ids in msgs_por_thread.items() if any(mid not in feitas for mid in ids)]
+    return thread_ids, ultimo_history_id
+
+def _thread_tem_xml(mensagens_por_thread: List[Dict[str, Any]]) -> bool:
+    return any(m.get("temXml") for m in mensagens_por_thread)
+
+def _mensagens_em_lotes(service, thread_ids: List[str], threads_por_lote: int, so_threads_com_xml: bool,
+                       falhas: List[str]):
+    """
+    Obtém as threads em grupos e gera as mensagens de cada grupo assim que chegam.
+    Os ids das threads que não puderam ser obtidas são acumulados em `falhas`.
+    """
+    for inicio in range(0, len(thread_ids), threads_por_lote):
+        msgs, falhas_lote = _mensagens_das_threads(service, thread_ids[inicio:inicio + threads_por_lote])
+        falhas.extend(falhas_lote)
+        if so_threads_com_xml:
+            # history.list não aplica a busca por anexo; descarta threads sem XML
+            por_thread: Dict[str, List[Dict[str, Any]]] = {}
+            for m in msgs:
+                por_thread.setdefault(m["threadId"], []).append(m)
+            msgs = [m for m in msgs if _thread_tem_xml(por_thread[m["threadId"]])]
+        if msgs:
+            yield msgs
+
+def iterarMessagesIncremental(service, max_results: int = 100, threads_por_lote: int = TAMANHO_LOTE):
+    """
+    Versão incremental de buscarMessagesEnviados, em lotes: usa o último historyId salvo
+    para buscar apenas threads com mensagens enviadas desde o ciclo anterior e gera as
+    mensagens a cada `threads_por_lote` threads obtidas (para o pipeline já começar a baixar).
+    Sem historyId salvo (primeira execução) ou com o histórico expirado (404),
+    cai na busca completa, paginada de `max_results` em `max_results` threads.
+    Todas as threads alteradas são percorridas; o novo historyId só é gravado em
+    confirmarSincronizacao(), e não é gravado se alguma thread não pôde ser obtida.
+    """
+    conta = conta_do_servico(service)
+    falhas: List[str] = []
+    with _sync_lock:
+        start_history_id = _carregar_sync_state().get(conta, {}).get("historyId")
+        _history_pendente.pop(conta, None)
+        _sync_incompleta.pop(conta, None)
+
+    if start_history_id:
+        try:
+            thread_ids, novo_history_id = _threads_alteradas_desde(service, start_history_id)
+            with _sync_lock:
+                _history_pendente[conta] = novo_history_id
+        except HttpError as e:
+            if getattr(e, "resp", None) is not None and e.resp.status == 404:
+                logger.warning("historyId %s expirou; refazendo busca completa.", start_history_id)
+            else:
+                logger.exception("Erro na sincronização incremental: %s", e)
+                _marcar_sync_incompleta(conta, f"falha no history.list ({e})")
+                return
+        except Exception as e:
+            logger.exception("Erro na sincronização incremental: %s", e)
+            _marcar_sync_incompleta(conta, f"falha no history.list ({e})")
+            return
+        else:
+            if not thread_ids:
+                logger.info("Sync incremental: nenhuma mensagem enviada nova desde historyId %s", start_history_id)
+                return
+            logger.info("Sync incremental: %d threads alteradas desde historyId %s", len(thread_ids), start_history_id)
+            yield from _mensagens_em_lotes(service, thread_ids, threads_por_lote, True, falhas)
+            _registrar_falhas_sync(conta, falhas)
+            return
+
+    # Busca completa — o historyId é lido antes para não perder mensagens enviadas durante a busca
+    novo_history_id = _history_id_atual(service)
+    try:
+        thread_ids = _threads_da_busca(service, max_results, todas_as_paginas=True)
+    except Exception as e:
+        logger.exception("Erro ao listar threads: %s", e)
+        _marcar_sync_incompleta(conta, f"falha ao listar threads ({e})")
+        return
+    if novo_history_id:
+        with _sync_lock:
+            _history_pendente[conta] = novo_history_id
+    yield from _mensagens_em_lotes(service, thread_ids, threads_por_lote, False, falhas)
+    _registrar_falhas_sync(conta, falhas)
+
+def _marcar_sync_incompleta(conta: str, motivo: str):
+    with _sync_lock:
+        _sync_incompleta[conta] = motivo
+
+def _registrar_falhas_sync(conta: str, falhas: List[str]):
+    if falhas:
+        logger.warning("%d thread(s) não puderam ser obtidas; serão buscadas de novo no próximo ciclo.", len(falhas))
+        _marcar_sync_incompleta(conta, f"{len(falhas)} thread(s) não obtidas: {', '.join(falhas[:5])}")
+
+def buscarMessagesIncremental(service, max_results: int = 100) -> List[Dict[str, Any]]:
+    """Como iterarMessagesIncremental, mas devolve todas as mensagens numa lista só."""
+    return [m for lote in iterarMessagesIncremental(service, max_results) for m in lote]
+
+def confirmarSincronizacao(service) -> bool:
+    """
+    Grava o historyId obtido na última busca, após o ciclo ter sido processado.
+    Retorna False, sem gravar, se a busca ficou incompleta (ex.: threads que não
+    puderam ser obtidas); o próximo ciclo parte do historyId anterior.
+    """
+    conta = conta_do_servico(service)
+    with _sync_lock:
+        novo_history_id = _history_pendente.pop(conta, None)
+        motivo = _sync_incompleta.pop(conta, None)
+        if motivo:
+            logger.warning("historyId mantido para %s: %s", conta, motivo)
+            return False
+        if not novo_history_id:
+            return True
+        state = _carregar_sync_state()
+        state[conta] = {"historyId": novo_history_id, "atualizadoEm": int(time.time())}
+        try:
+            _salvar_sync_state(state)
+        except Exception as e:
+            logger.warning("Falha ao salvar historyId %s: %s", novo_history_id, e)
+        return True
+
+def historyIdConfirmado(service) -> Optional[str]:
+    """historyId gravado pelo último ciclo concluído da conta (None na primeira execução)."""
+    with _sync_lock:
+        return _carregar_sync_state().get(conta_do_servico(service), {}).get("historyId")
+
+# =========================
+# PUSH (users.watch)
+# =========================
+
+def emailDaConta(service) -> str:
+    """Endereço da caixa (getProfile), guardado no serviço após a primeira consulta."""
+    email = getattr(service, "_botana_email", None)
+    if not email:
+        perfil = politica_gmail.executar(service.users().getProfile(userId="me").execute, http=_http_da_thread(service))
+        email = service._botana_email = perfil.get("emailAddress", "")
+    return email
+
+def registrarWatch(service, topico: str) -> Dict[str, Any]:
+    """
+    Pede ao Gmail notificações de mensagens enviadas no tópico Pub/Sub informado.
+    Retorna {"historyId", "expiration" (ms)}; o watch vale 7 dias e deve ser renovado antes.
+    """
+    body = {"topicName": topico, "labelIds": ["SENT"], "labelFilterBehavior": "INCLUDE"}
+    return politica_gmail.executar(service.users().watch(userId="me", body=body).execute, http=_http_da_thread(service))
+
 def _flatten_parts(parts):
     """
     Retorna lista plana de partes que representam anexos (ou potenciais anexos) — contempla recursion.
@@ -126,30 +544,16 @@ def _guess_extension_from_mime(mime: str):
         return ".png"
     return ""
 
-def baixar_anexos_de_mensagem(service, msg_id: str) -> List[str]:
+def _descritores_anexos(msg_id: str, payload: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
-    Baixa todos os anexos "reais" de uma mensagem (arquivos com filename ou attachmentId)
-    e salva no DOWNLOAD_DIR. Retorna lista de caminhos salvos.
-    Antes: apenas baixava XMLs/partes com xml. Agora baixa PDFs também (ex: boleto, DANFE).
+    Monta os descritores dos anexos PDF/XML a partir do payload da mensagem
+    (filename, mimeType, attachmentId, dados inline e nome único do anexo).
     """
-    saved = []
-    try:
-        message = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
-    except Exception as e:
-        logger.exception("Erro ao obter mensagem %s: %s", msg_id, e)
-        return saved
-
-    payload = message.get("payload", {}) or {}
     parts = payload.get("parts", []) or []
     # Caso mensagem não seja multipart, considere payload como uma única parte
     all_parts = _flatten_parts(parts) if parts else [payload]
 
-    if not all_parts:
-        logger.debug("Nenhuma parte encontrada na mensagem %s", msg_id)
-        return saved
-
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-
+    descritores = []
     for idx, part in enumerate(all_parts, start=1):
         filename = part.get("filename") or ""
         mime = (part.get("mimeType") or "").lower()
@@ -161,64 +565,220 @@ def baixar_anexos_de_mensagem(service, msg_id: str) -> List[str]:
             if "pdf" not in mime and "xml" not in mime:
                 continue
 
+        # partes sem conteúdo nem attachmentId não têm o que baixar
+        if not body.get("data") and not body.get("attachmentId"):
+            continue
+
         # garante extensão
         if not filename:
             ext = ".pdf" if "pdf" in mime else ".xml" if "xml" in mime else ".bin"
             filename = f"{msg_id}_{idx}{ext}"
 
-        # evita sobrescrever
-        file_path = os.path.join(DOWNLOAD_DIR, f"{msg_id}_{idx}_{filename}")
+        descritores.append({
+            "filename": filename,
+            "mimeType": mime,
+            "attachmentId": body.get("attachmentId"),
+            "tamanho": body.get("size"),
+            # partes pequenas inline (às vezes XML simples)
+            "data": body.get("data"),
+            # nome único (mesmo formato dos antigos arquivos em DOWNLOAD_DIR)
+            "nome": f"{msg_id}_{idx}_{filename}",
+        })
+    return descritores
+
+class Anexo:
+    """
+    Anexo baixado mantido em memória. XMLs ficam como bytes; PDFs acima de
+    LIMITE_PDF_EM_MEMORIA são despejados num arquivo temporário (SpooledTemporaryFile).
+    """
 
+    def __init__(self, nome: str, mime_type: str, dados: bytes):
+        self.nome = nome
+        self.mime_type = mime_type
+        self.tamanho = len(dados)
+        self._dados: Optional[bytes] = dados
+        self._spool = None
+        if self.eh_pdf and self.tamanho > LIMITE_PDF_EM_MEMORIA:
+            self._spool = tempfile.SpooledTemporaryFile(max_size=LIMITE_PDF_EM_MEMORIA)
+            self._spool.write(dados)
+            self._dados = None
+
+    @property
+    def eh_xml(self) -> bool:
+        return self.nome.lower().endswith(".xml")
+
+    @property
+    def eh_pdf(self) -> bool:
+        return self.nome.lower().endswith(".pdf")
+
+    def abrir(self) -> BinaryIO:
+        """Retorna um buffer binário posicionado no início do conteúdo."""
+        if self._spool is not None:
+            self._spool.seek(0)
+            return self._spool
+        return io.BytesIO(self._dados or b"")
+
+    def conteudo(self) -> bytes:
+        if self._spool is not None:
+            self._spool.seek(0)
+            return self._spool.read()
+        return self._dados or b""
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self._dados = None
+
+    def __repr__(self):
+        return f"Anexo({self.nome!r}, {self.tamanho} bytes)"
+
+def baixar_anexos_de_mensagens(service, mensagens: List[Any]) -> Tuple[Dict[str, List[Anexo]], set]:
+    """
+    Baixa os anexos PDF/XML de várias mensagens, sem gravar em disco. Usa os
+    descritores em "anexos" produzidos pela busca; só mensagens sem descritores
+    (ou ids soltos) passam por messages.get. Os attachments.get rodam num pool de
+    GMAIL_DOWNLOAD_WORKERS threads, limitado pela cota da conta (TokenBucket).
+    Retorna ({msg_id: [Anexo]}, ids das mensagens com alguma falha), os anexos na
+    ordem das partes de cada mensagem. Uma falha não interrompe os demais downloads,
+    mas a mensagem afetada fica incompleta e não deve ser dada como processada.
+    """
+    mensagens = [{"id": m} if isinstance(m, str) else m for m in mensagens]
+    saved: Dict[str, List[Anexo]] = {m["id"]: [] for m in mensagens}
+    falhas = set()
+
+    sem_descritor = [m["id"] for m in mensagens if "anexos" not in m]
+    obtidas = executar_em_lote(
+        service, [(m, service.users().messages().get(userId="me", id=m, format="full")) for m in sem_descritor]
+    )
+
+    # (msg_id, descritor)
+    pendentes = []
+    for m in mensagens:
+        msg_id = m["id"]
+        if "anexos" in m:
+            anexos_msg = m["anexos"]
+        else:
+            message, erro = obtidas.get(msg_id, (None, None))
+            if erro is not None or message is None:
+                logger.error("Erro ao obter mensagem %s: %s", msg_id, erro)
+                falhas.add(msg_id)
+                continue
+            anexos_msg = _descritores_anexos(msg_id, message.get("payload", {}) or {})
+        if not anexos_msg:
+            logger.debug("Nenhuma parte encontrada na mensagem %s", msg_id)
+        pendentes.extend((msg_id, d) for d in anexos_msg)
+
+    def _baixar(item) -> Tuple[Optional[Anexo], bool]:
+        """(anexo ou None se vazio, houve falha)."""
+        msg_id, d = item
         try:
-            data_b = None
-            if body.get("data"):
-                # partes pequenas inline (às vezes XML simples)
-                data_b = _decode_base64_fixed(body.get("data", ""))
-            elif body.get("attachmentId"):
-                attach_id = body["attachmentId"]
-                attach = service.users().messages().attachments().get(
-                    userId="me", messageId=msg_id, id=attach_id
-                ).execute()
-                raw = attach.get("data")
-                if not raw:
-                    continue
-                data_b = _decode_base64_fixed(raw or "")
+            if d.get("data"):
+                raw = d["data"]
             else:
-                continue
-
-            # grava o arquivo
-            with open(file_path, "wb") as fh:
-                fh.write(data_b)
-            saved.append(file_path)
-            time.sleep(0.1)
-
+                limitador_da_conta(service).consumir(CUSTO_ATTACHMENTS_GET)
+                attach = politica_gmail.executar(service.users().messages().attachments().get(
+                    userId="me", messageId=msg_id, id=d["attachmentId"]
+                ).execute, http=_http_da_thread(service))
+                raw = (attach or {}).get("data")
+                if not raw:
+                    return None, False
+            dados = _decode_base64_fixed(raw)
+            metricas.contar("botana_gmail_bytes_baixados_total", len(dados))
+            return Anexo(d["nome"], d["mimeType"], dados), False
         except Exception as e:
-            logger.exception("Erro ao baixar anexo (%s): %s", filename, e)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            continue
-
-
-    logger.debug("Baixados %d anexos para mensagem %s", len(saved), msg_id)
-    return saved
+            logger.exception("Erro ao baixar anexo (%s): %s", d["filename"], e)
+            return None, True
+
+    # Downloads em paralelo; map() devolve na ordem de entrada, então a ordem
+    # dos anexos de cada mensagem (e o mapeamento boleto → parcela) é preservada
+    if pendentes:
+        with ThreadPoolExecutor(max_workers=max(1, GMAIL_DOWNLOAD_WORKERS), thread_name_prefix="gmail-anexo") as pool:
+            for (msg_id, _), (anexo, falhou) in zip(pendentes, pool.map(_baixar, pendentes)):
+                if falhou:
+                    falhas.add(msg_id)
+                elif anexo is not None:
+                    saved[msg_id].append(anexo)
+
+    for msg_id, anexos in saved.items():
+        logger.debug("Baixados %d anexos para mensagem %s", len(anexos), msg_id)
+    return saved, falhas
+
+def baixar_anexos_de_mensagem(service, msg_id: str) -> List[Anexo]:
+    """
+    Baixa todos os anexos "reais" de uma mensagem (arquivos com filename ou attachmentId).
+    Retorna lista de Anexo em memória (sem os anexos cujo download falhou).
+    Antes: apenas baixava XMLs/partes com xml. Agora baixa PDFs também (ex: boleto, DANFE).
+    """
+    return baixar_anexos_de_mensagens(service, [msg_id])[0].get(msg_id, [])
 
 def _decode_base64_fixed(data: str) -> bytes:
-    """Decodifica base64 corrigindo padding e caracteres urlsafe."""
+    """Decodifica base64 urlsafe (formato do Gmail), completando o padding ausente."""
     if not data:
         return b""
-    data = data.strip()
-    # Corrige caracteres urlsafe (- e _)
-    data = data.replace("-", "+").replace("_", "/")
-    # Corrige padding ausente
-    missing_padding = len(data) % 4
-    if missing_padding:
-        data += "=" * (4 - missing_padding)
-    return base64.b64decode(data, validate=False)
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
 
 def marcar_mensagem_com_label(service, msg_id: str, label_name: str = LABEL_NAME):
     try:
-        label_id = ensure_label(service, label_name)
-        body = {"addLabelIds": [label_id]}
-        service.users().messages().modify(userId="me", id=msg_id, body=body).execute()
+        for tentativa in range(2):
+            label_id = ensure_label(service, label_name)
+            body = {"addLabelIds": [label_id]}
+            try:
+                politica_gmail.executar(service.users().messages().modify(userId="me", id=msg_id, body=body).execute, http=_http_da_thread(service))
+                break
+            except HttpError as e:
+                if tentativa == 0 and _erro_label_invalido(e):
+                    invalidar_label(service, label_name)
+                    continue
+                raise
     except Exception as e:
         logger.exception("Falha ao marcar mensagem %s com label: %s", msg_id, e)
+
+def marcar_mensagens_com_label(service, msg_ids: List[str], label_name: str = LABEL_NAME) -> Dict[str, Optional[Exception]]:
+    """
+    Aplica o rótulo a várias mensagens com messages.batchModify (até 1000 ids por chamada).
+    Se um batchModify falhar, refaz aquele grupo com modify individual em lote HTTP,
+    para que uma mensagem inválida não impeça a marcação das demais.
+    Retorna {msg_id: erro ou None}.
+    """
+    ids = list(dict.fromkeys(m for m in msg_ids if m))
+    resultado: Dict[str, Optional[Exception]] = {}
+    if not ids:
+        return resultado
+
+    try:
+        label_id = ensure_label(service, label_name)
+    except Exception as e:
+        logger.exception("Falha ao obter rótulo %s: %s", label_name, e)
+        return {m: e for m in ids}
+
+    body = {"addLabelIds": [label_id]}
+    for inicio in range(0, len(ids), TAMANHO_BATCH_MODIFY):
+        grupo = ids[inicio:inicio + TAMANHO_BATCH_MODIFY]
+        try:
+            try:
+                politica_gmail.executar(service.users().messages().batchModify(userId="me", body={"ids": grupo, **body}).execute, http=_http_da_thread(service))
+            except HttpError as e:
+                if not _erro_label_invalido(e):
+                    raise
+                # id guardado ficou obsoleto: resolve de novo e repete uma vez
+                logger.warning("Rótulo %s inválido (%s); atualizando id.", label_id, e)
+                invalidar_label(service, label_name)
+                label_id = ensure_label(service, label_name)
+                body = {"addLabelIds": [label_id]}
+                politica_gmail.executar(service.users().messages().batchModify(userId="me", body={"ids": grupo, **body}).execute, http=_http_da_thread(service))
+            resultado.update({m: None for m in grupo})
+            continue
+        except Exception as e:
+            logger.warning("batchModify falhou para %d mensagens (%s); marcando individualmente.", len(grupo), e)
+
+        respostas = executar_em_lote(
+            service, [(m, service.users().messages().modify(userId="me", id=m, body=body)) for m in grupo],
+            custo_por_item=CUSTO_MESSAGES_MODIFY,
+        )
+        for m in grupo:
+            erro = respostas.get(m, (None, None))[1]
+            if erro is not None:
+                logger.error("Falha ao marcar mensagem %s com label: %s", m, erro)
+            resultado[m] = erro
+    return resultado
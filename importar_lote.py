@@ -0,0 +1,149 @@
+# importar_lote.py
+"""
+Importação offline de NF-e: lê os XMLs de uma pasta ou de um ZIP (sem extrair
+nada para o disco), analisa em paralelo e grava as parcelas nas planilhas em lote.
+
+A importação pode ser retomada: cada lote concluído fica registrado no ledger
+e uma execução interrompida continua de onde parou.
+
+Uso:
+    python importar_lote.py <pasta ou arquivo.zip> [--lote 500] [--do-zero]
+"""
+import os
+import sys
+import zipfile
+import argparse
+import logging
+import multiprocessing
+from collections import Counter
+from datetime import datetime
+from typing import Iterator, List, Tuple
+
+from ledger import itensImportados, registrarImportados, cache_anexos, cache_nfes, chaveConteudo
+from reporter import escreverRelatorio
+from roteamento import escolher_planilha_por_cnpj_e_ano, planejar_parcelas
+from sheets_writer import PlanoEscrita, obterSessaoSheets
+from xml_parser import extrairDadosXMLBatch
+
+logger = logging.getLogger("bot.importar_lote")
+
+# XMLs por lote: uma análise em paralelo, um append por aba e um ponto de retomada
+TAMANHO_LOTE_IMPORTACAO = 500
+
+def _iterar_xmls(caminho: str, pular: set) -> Iterator[Tuple[str, bytes]]:
+    """Gera (item, conteúdo) de cada XML da pasta (recursiva) ou do ZIP, em ordem estável."""
+    if os.path.isdir(caminho):
+        for raiz, pastas, arquivos in os.walk(caminho):
+            pastas.sort()
+            for nome in sorted(arquivos):
+                if not nome.lower().endswith(".xml"):
+                    continue
+                completo = os.path.join(raiz, nome)
+                item = os.path.relpath(completo, caminho).replace(os.sep, "/")
+                if item in pular:
+                    continue
+                with open(completo, "rb") as f:
+                    yield item, f.read()
+    else:
+        with zipfile.ZipFile(caminho) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(".xml"):
+                    continue
+                if info.filename in pular:
+                    continue
+                yield info.filename, zf.read(info)
+
+def _em_lotes(itens: Iterator[Tuple[str, bytes]], tamanho: int) -> Iterator[List[Tuple[str, bytes]]]:
+    lote = []
+    for item in itens:
+        lote.append(item)
+        if len(lote) >= tamanho:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+def _importar_lote(lote: List[Tuple[str, bytes]], sessao) -> List[Tuple[str, str]]:
+    """
+    Analisa e grava um lote. Retorna [(item, situação)] dos itens concluídos;
+    itens cujas linhas falharam na gravação ficam de fora e são tentados de novo na retomada.
+    """
+    concluidos = []
+    a_analisar = []
+    for item, conteudo in lote:
+        chave_conteudo = chaveConteudo(conteudo)
+        if cache_anexos.contem(chave_conteudo):
+            concluidos.append((item, "repetida"))
+        else:
+            a_analisar.append((item, conteudo, chave_conteudo))
+
+    resultados = extrairDadosXMLBatch([conteudo for _, conteudo, _ in a_analisar])
+    plano = PlanoEscrita(sessao)
+    pendentes = []
+    for (item, _, chave_conteudo), (dados, erro) in zip(a_analisar, resultados):
+        if erro:
+            logger.warning("❌ Erro extraindo XML %s: %s", item, erro)
+            concluidos.append((item, "erro"))
+            continue
+        if cache_nfes.contem(dados.get("chaveAcesso")):
+            cache_anexos.adicionar([chave_conteudo])
+            concluidos.append((item, "repetida"))
+            continue
+
+        planilha_id = escolher_planilha_por_cnpj_e_ano(dados.get("cnpjEmitente"), dados.get("anoVencimento"))
+        if not dados.get("parcelas") or not planilha_id:
+            # à vista, destinatário nosso ou sem planilha configurada: nada a gravar
+            cache_anexos.adicionar([chave_conteudo])
+            cache_nfes.adicionar([dados.get("chaveAcesso")])
+            concluidos.append((item, "sem_parcelas" if not dados.get("parcelas") else "sem_planilha"))
+            continue
+        pendentes.append((item, chave_conteudo, dados, planejar_parcelas(dados, planilha_id, [], plano)))
+
+    resultados_plano = plano.executar()
+    for item, chave_conteudo, dados, linhas in pendentes:
+        if all(resultados_plano[n].ok for n in linhas):
+            cache_anexos.adicionar([chave_conteudo])
+            cache_nfes.adicionar([dados.get("chaveAcesso")])
+            concluidos.append((item, "gravada"))
+    return concluidos
+
+def importar(caminho: str, tamanho_lote: int = TAMANHO_LOTE_IMPORTACAO, do_zero: bool = False) -> Counter:
+    """Importa todos os XMLs de `caminho` (pasta ou ZIP). Retorna a contagem por situação."""
+    if not os.path.isdir(caminho) and not zipfile.is_zipfile(caminho):
+        raise ValueError(f"{caminho} não é uma pasta nem um arquivo ZIP")
+
+    origem = os.path.abspath(caminho)
+    pular = set() if do_zero else itensImportados(origem)
+    if pular:
+        logger.info("⏩ Retomando importação de %s: %d XMLs já concluídos serão pulados.", origem, len(pular))
+
+    sessao = obterSessaoSheets()
+    totais = Counter()
+    for lote in _em_lotes(_iterar_xmls(caminho, pular), tamanho_lote):
+        concluidos = _importar_lote(lote, sessao)
+        registrarImportados(origem, concluidos)
+        situacoes = Counter(situacao for _, situacao in concluidos)
+        situacoes["falha_gravacao"] = len(lote) - len(concluidos)
+        totais.update(situacoes)
+        logger.info("📦 Lote de %d XMLs: %s | acumulado: %s", len(lote), dict(+situacoes), dict(+totais))
+    return totais
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Importa NF-e (XML) de uma pasta ou ZIP para as planilhas.")
+    parser.add_argument("caminho", help="pasta com XMLs ou arquivo .zip")
+    parser.add_argument("--lote", type=int, default=TAMANHO_LOTE_IMPORTACAO, help="XMLs por lote")
+    parser.add_argument("--do-zero", action="store_true", help="ignora os pontos de retomada e reimporta tudo")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    totais = importar(args.caminho, args.lote, args.do_zero)
+    resumo = ", ".join(f"{k}: {v}" for k, v in sorted((+totais).items())) or "nenhum XML novo"
+    escreverRelatorio(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - 📦 Importação de {args.caminho} concluída ({resumo}).",
+                      tipo="importacao")
+    logger.info("✅ Importação concluída (%s).", resumo)
+    return 1 if totais["falha_gravacao"] else 0
+
+if __name__ == "__main__":
+    # Necessário no executável do PyInstaller para o pool de processos do XML
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,242 @@
+# ledger.py
+"""
+Registro local (SQLite) das mensagens já processadas pelo bot.
+Substitui o rótulo do Gmail como única fonte de "já feito": uma mensagem
+presente aqui não é baixada, analisada nem comparada com as planilhas de novo.
+Guarda também os caches de deduplicação de anexos (conteúdo) e de NF-e (chave de acesso)
+e os pontos de retomada da importação offline (importar_lote.py).
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Iterable, List, Dict, Any, Optional, Tuple
+
+from config import BASE_DIR
+
+logger = logging.getLogger("bot.ledger")
+
+LEDGER_DB = os.path.join(BASE_DIR, "botana_ledger.sqlite3")
+
+# Margem de segurança (dias) aplicada à marca d'água "after:" da busca do Gmail
+WATERMARK_MARGEM_DIAS = 3
+
+# Máximo de chaves em cada cache de deduplicação (as mais antigas são descartadas)
+LIMITE_CACHE_DEDUPE = 50000
+LIMITE_CACHE_DEDUPE_MEMORIA = 5000
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+
+def _conexao() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(LEDGER_DB, check_same_thread=False, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.executescript("""
+            CREATE TABLE IF NOT EXISTS mensagens_processadas (
+                conta TEXT NOT NULL,
+                msg_id TEXT NOT NULL,
+                thread_id TEXT NOT NULL,
+                processado_em TEXT NOT NULL,
+                PRIMARY KEY (conta, msg_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_mensagens_thread
+                ON mensagens_processadas (conta, thread_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                chave TEXT PRIMARY KEY,
+                valor TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS anexos_vistos (
+                chave TEXT PRIMARY KEY,
+                visto_em REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_anexos_vistos_em ON anexos_vistos (visto_em);
+            CREATE TABLE IF NOT EXISTS nfes_vistas (
+                chave TEXT PRIMARY KEY,
+                visto_em REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_nfes_vistas_em ON nfes_vistas (visto_em);
+            CREATE TABLE IF NOT EXISTS importacoes (
+                origem TEXT NOT NULL,
+                item TEXT NOT NULL,
+                situacao TEXT NOT NULL,
+                importado_em TEXT NOT NULL,
+                PRIMARY KEY (origem, item)
+            );
+        """)
+    return _conn
+
+def mensagensJaProcessadas(conta: str, msg_ids: Iterable[str]) -> set:
+    """Retorna o subconjunto de msg_ids que já consta no registro."""
+    ids = [m for m in msg_ids if m]
+    if not ids:
+        return set()
+    encontrados = set()
+    with _lock:
+        conn = _conexao()
+        # SQLite limita a quantidade de parâmetros por consulta
+        for i in range(0, len(ids), 500):
+            lote = ids[i:i + 500]
+            marcadores = ",".join("?" * len(lote))
+            rows = conn.execute(
+                f"SELECT msg_id FROM mensagens_processadas WHERE conta = ? AND msg_id IN ({marcadores})",
+                [conta, *lote],
+            ).fetchall()
+            encontrados.update(r[0] for r in rows)
+    return encontrados
+
+def filtrarNaoProcessadas(conta: str, msgs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Remove da lista as mensagens já registradas como processadas."""
+    feitas = mensagensJaProcessadas(conta, [m.get("id") for m in msgs])
+    if feitas:
+        logger.info("Registro local: %d mensagens já processadas foram puladas.", len(feitas))
+    return [m for m in msgs if m.get("id") not in feitas]
+
+def registrarProcessadas(conta: str, msgs: Iterable[Dict[str, Any]]):
+    """Grava as mensagens (dicts com id/threadId) como processadas."""
+    agora = datetime.now().isoformat(timespec="seconds")
+    linhas = [(conta, m["id"], m.get("threadId", ""), agora) for m in msgs if m.get("id")]
+    if not linhas:
+        return
+    with _lock:
+        conn = _conexao()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT OR IGNORE INTO mensagens_processadas (conta, msg_id, thread_id, processado_em) VALUES (?, ?, ?, ?)",
+            linhas,
+        )
+        conn.execute("COMMIT")
+
+def _ler_meta(chave: str) -> Optional[str]:
+    with _lock:
+        row = _conexao().execute("SELECT valor FROM meta WHERE chave = ?", (chave,)).fetchone()
+    return row[0] if row else None
+
+def _gravar_meta(chave: str, valor: str):
+    with _lock:
+        _conexao().execute(
+            "INSERT INTO meta (chave, valor) VALUES (?, ?) ON CONFLICT(chave) DO UPDATE SET valor = excluded.valor",
+            (chave, valor),
+        )
+
+def obterWatermark(conta: str) -> Optional[str]:
+    """Data (YYYY/MM/DD) para o filtro "after:" da busca, ou None na primeira execução."""
+    return _ler_meta(f"watermark:{conta}")
+
+def avancarWatermark(conta: str, inicio_ciclo: datetime):
+    """
+    Avança a marca d'água para o início do ciclo concluído, menos a margem de segurança
+    (o filtro "after:" do Gmail tem granularidade de dia e usa o fuso da conta).
+    """
+    data = (inicio_ciclo - timedelta(days=WATERMARK_MARGEM_DIAS)).strftime("%Y/%m/%d")
+    atual = obterWatermark(conta)
+    if atual is None or data > atual:
+        _gravar_meta(f"watermark:{conta}", data)
+
+# =========================
+# IMPORTAÇÃO OFFLINE (pontos de retomada)
+# =========================
+
+def itensImportados(origem: str) -> set:
+    """Itens (arquivos ou membros do ZIP) da origem já concluídos em importações anteriores."""
+    with _lock:
+        rows = _conexao().execute("SELECT item FROM importacoes WHERE origem = ?", (origem,)).fetchall()
+    return {r[0] for r in rows}
+
+def registrarImportados(origem: str, itens: Iterable[Tuple[str, str]]):
+    """Grava os itens concluídos como pares (item, situação)."""
+    agora = datetime.now().isoformat(timespec="seconds")
+    linhas = [(origem, item, situacao, agora) for item, situacao in itens]
+    if not linhas:
+        return
+    with _lock:
+        conn = _conexao()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO importacoes (origem, item, situacao, importado_em) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(origem, item) DO UPDATE SET situacao = excluded.situacao, importado_em = excluded.importado_em",
+            linhas,
+        )
+        conn.execute("COMMIT")
+
+# =========================
+# CACHES DE DEDUPLICAÇÃO
+# =========================
+
+class CacheDedupe:
+    """
+    Conjunto limitado e persistente de chaves já processadas: LRU em memória
+    na frente de uma tabela SQLite, podada para manter no máximo `limite` chaves.
+    """
+
+    def __init__(self, tabela: str, limite: int = LIMITE_CACHE_DEDUPE,
+                 limite_memoria: int = LIMITE_CACHE_DEDUPE_MEMORIA):
+        self.tabela = tabela
+        self.limite = limite
+        self.limite_memoria = limite_memoria
+        self._memoria: "OrderedDict[str, None]" = OrderedDict()
+
+    def _lembrar(self, chave: str):
+        self._memoria[chave] = None
+        self._memoria.move_to_end(chave)
+        while len(self._memoria) > self.limite_memoria:
+            self._memoria.popitem(last=False)
+
+    def contem(self, chave: Optional[str]) -> bool:
+        if not chave:
+            return False
+        with _lock:
+            if chave in self._memoria:
+                self._memoria.move_to_end(chave)
+                return True
+            row = _conexao().execute(f"SELECT 1 FROM {self.tabela} WHERE chave = ?", (chave,)).fetchone()
+            if row:
+                self._lembrar(chave)
+            return row is not None
+
+    def adicionar(self, chaves: Iterable[Optional[str]]):
+        chaves = [c for c in chaves if c]
+        if not chaves:
+            return
+        agora = time.time()
+        with _lock:
+            conn = _conexao()
+            conn.execute("BEGIN")
+            conn.executemany(
+                f"INSERT INTO {self.tabela} (chave, visto_em) VALUES (?, ?) "
+                f"ON CONFLICT(chave) DO UPDATE SET visto_em = excluded.visto_em",
+                [(c, agora) for c in chaves],
+            )
+            excedente = conn.execute(f"SELECT COUNT(*) FROM {self.tabela}").fetchone()[0] - self.limite
+            if excedente > 0:
+                conn.execute(
+                    f"DELETE FROM {self.tabela} WHERE chave IN "
+                    f"(SELECT chave FROM {self.tabela} ORDER BY visto_em ASC LIMIT ?)",
+                    (excedente,),
+                )
+            conn.execute("COMMIT")
+            for c in chaves:
+                self._lembrar(c)
+
+# Nível 1: conteúdo do anexo (hash dos bytes, attachmentId ou nome+tamanho dentro da thread)
+cache_anexos = CacheDedupe("anexos_vistos")
+# Nível 2: chave de acesso da NF-e (atributo Id de infNFe)
+cache_nfes = CacheDedupe("nfes_vistas")
+
+def chavePreviaAnexo(thread_id: str, descritor: Dict[str, Any]) -> Optional[str]:
+    """
+    Chave conhecida antes do download: o mesmo arquivo (nome + tamanho) repetido
+    na mesma thread é tratado como cópia (respostas e encaminhamentos).
+    """
+    if descritor.get("tamanho") is None:
+        return None
+    return f"thread:{thread_id}:{descritor.get('filename', '').lower()}:{descritor['tamanho']}"
+
+def chaveConteudo(conteudo: bytes) -> str:
+    return "sha256:" + hashlib.sha256(conteudo).hexdigest()
@@ -1,17 +1,25 @@
-import os, re, time, gspread, threading
+import os, re, time, threading, multiprocessing
 from tray_icon import *
 from datetime import datetime
-from google.oauth2.service_account import Credentials
-from config import PLANILHAS, CNPJ_MVA, CNPJ_EH, INTERVALO, DOWNLOAD_DIR, GOOGLE_CREDENTIALS_SHEETS
-from gmail_service import getGmailService, buscarMessagesEnviados, baixar_anexos_de_mensagem
-from reporter import escreverRelatorio, registrarEvento, consolidarRelatorioTMP
-from xml_parser import extrairDadosXML
-from sheets_writer import atualizarPlanilha
-from gmail_service import marcar_mensagem_com_label
+from concurrent.futures import ThreadPoolExecutor
+from config import CNPJ_MVA, CNPJ_EH, DOWNLOAD_DIR, CONTAS_GMAIL, GMAIL_PUSH_TOPICO, INTERVALO_SEGURANCA_PUSH
+from gmail_service import getGmailService, iterarMessagesIncremental, confirmarSincronizacao, baixar_anexos_de_mensagens, conta_do_servico
+from ledger import filtrarNaoProcessadas, registrarProcessadas, avancarWatermark
+from ledger import cache_anexos, cache_nfes, chavePreviaAnexo, chaveConteudo
+from reporter import escreverRelatorio, registrarEvento, nfJaRelatada
+from xml_parser import extrairDadosXMLBatch
+from sheets_writer import PlanoEscrita, obterSessaoSheets
+from roteamento import escolher_planilha_por_cnpj_e_ano, planejar_parcelas
+from pipeline import Pipeline, EtapaCompartilhada, CAPACIDADE_FILA_PIPELINE
+from agendador import Agendador
+from push_gmail import PushGmail
+from metricas import metricas, iniciarServidorMetricas
+from gmail_service import marcar_mensagens_com_label
 import colorlog, logging
 from colorlog.escape_codes import escape_codes
 
 stop_event = threading.Event()  # usado para parar o loop com segurança
+agendador = Agendador()  # intervalo adaptativo e espera interrompível entre os ciclos
 running = False # indica se o loop principal está ativo
 
 handler = colorlog.StreamHandler()
@@ -32,84 +40,162 @@ logger = logging.getLogger("bot.main")
 cor_ciano = escape_codes['cyan']   # ou 'purple', 'bold_red', etc.
 reset = escape_codes['reset']
 
-def escolher_planilha_por_cnpj_e_ano(cnpj: str, ano: str):
-    if cnpj == CNPJ_MVA:
-        return PLANILHAS["MVA"].get(ano)
-    if cnpj == CNPJ_EH:
-        return PLANILHAS["EH"].get(ano)
-    return None
-
 def _now():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-def processar_emails_enviados():
-    service = getGmailService()
-    msgs = buscarMessagesEnviados(service, max_results=100)
-    if not msgs:
-        logger.info("Nenhuma mensagem enviada com XML encontrada.")
-        return
-
-    total_processados = 0
-
-    for m in msgs:   
-        msg_id = m.get("id")
-        logger.info("📧 Abrindo mensagem ID: %s", msg_id)
-
-        arquivos = baixar_anexos_de_mensagem(service, msg_id)
-        if not arquivos:
-            logger.info("Nenhum anexo salvo para mensagem %s", msg_id)
+def _descartar_anexos_repetidos(msgs, vistos_ciclo=None):
+    """
+    Deduplicação antes do download: XMLs cuja chave prévia (nome + tamanho na thread)
+    já foi processada, ou que se repetem dentro do ciclo, não são baixados. Se todos
+    os XMLs de uma mensagem forem repetidos, os PDFs dela também são descartados.
+    `vistos_ciclo` acumula as chaves entre os lotes de um mesmo ciclo.
+    """
+    vistos_ciclo = set() if vistos_ciclo is None else vistos_ciclo
+    for m in msgs:
+        anexos = m.get("anexos")
+        if not anexos:
             continue
+        repetidos = []
+        for d in anexos:
+            if not d["filename"].lower().endswith(".xml"):
+                continue
+            chave = chavePreviaAnexo(m.get("threadId", ""), d)
+            if chave and (chave in vistos_ciclo or cache_anexos.contem(chave)):
+                repetidos.append(d)
+            elif chave:
+                vistos_ciclo.add(chave)
+        if not repetidos:
+            continue
+        xmls = [d for d in anexos if d["filename"].lower().endswith(".xml")]
+        if len(repetidos) == len(xmls):
+            logger.info("♻️ Mensagem %s só tem XMLs já processados; anexos não serão baixados.", m.get("id"))
+            m["anexos"] = []
+        else:
+            m["anexos"] = [d for d in anexos if d not in repetidos]
+
+def _chaves_previas(m):
+    return [chavePreviaAnexo(m.get("threadId", ""), d) for d in (m.get("anexos") or [])
+            if d["filename"].lower().endswith(".xml")]
+
+def _analisar_xmls(anexos_por_msg):
+    """
+    Analisa de uma vez todos os XMLs baixados no ciclo (em vários processos quando são muitos).
+    Retorna {nome do anexo: (chave do conteúdo, dados, erro)}; dados e erro ficam None
+    quando o mesmo conteúdo já foi processado antes e o XML nem chega a ser analisado.
+    """
+    analises, a_analisar = {}, []
+    for anexos in anexos_por_msg.values():
+        for anexo in anexos:
+            if not anexo.eh_xml:
+                continue
+            chave_conteudo = chaveConteudo(anexo.conteudo())
+            analises[anexo.nome] = (chave_conteudo, None, None)
+            if not cache_anexos.contem(chave_conteudo):
+                a_analisar.append(anexo)
+
+    resultados = extrairDadosXMLBatch([a.conteudo() for a in a_analisar])
+    for anexo, (dados, erro) in zip(a_analisar, resultados):
+        analises[anexo.nome] = (analises[anexo.nome][0], dados, erro)
+    return analises
+
+def _processar_mensagem(m, anexos, plano, analises):
+    """
+    Interpreta os anexos já baixados de uma mensagem e planeja as linhas das parcelas no `plano`.
+    Os XMLs já chegam analisados em `analises` (ver _analisar_xmls).
+    Retorna [(chave do conteúdo, dados da NF, nºs das linhas no plano)] para conferência após a gravação.
+    """
+    pendentes = []
+    msg_id = m.get("id")
+    logger.info("📧 Abrindo mensagem ID: %s", msg_id)
+
+    if not anexos:
+        logger.info("Nenhum anexo salvo para mensagem %s", msg_id)
+        return pendentes
+
+    dados_xmls = []
+    boletos = []
+
+    # 🔁 Processa todos os anexos baixados (em memória)
+    for anexo in anexos:
+        nome_arquivo = anexo.nome
 
-        dados_xmls = []
-        boletos = []
-
-        # 🔁 Processa todos os anexos baixados
-        for arquivo in arquivos:
-            nome_arquivo = os.path.basename(arquivo)
-
-            try:
-                # =============================
-                # 📄 XML → extrai dados
-                # =============================
-                if arquivo.lower().endswith(".xml"):
-                    try:
-                        dados = extrairDadosXML(arquivo)
-                        # 🔍 Ignora vendas à vista
-                        nat_op = dados.get("naturezaOperacao", "").strip().upper()
-                        dest = dados.get("destinatario", "")
-                        if ( "VISTA" in nat_op or "VENDA A VISTA" in nat_op):
-                            # Checa se a mensagem ja foi processada no relatorio atual:
-                            if dados.get('nf') not in consolidarRelatorioTMP(): 
-                                escreverRelatorio(f"{_now()} - 💰 NF {dados.get('nf')} ignorada (venda à vista).")
-                                continue
-                            else: logger.info(f"{cor_ciano}NF {dados['nf']} já registrada no relatório, não duplicando a mensagem de ignorada.{reset}") 
-                            continue
-                        if ( CNPJ_MVA.replace(".", "").replace("/", "").replace("-", "") in dest or
-                             CNPJ_EH.replace(".", "").replace("/", "").replace("-", "") in dest ):
-                            logger.info(f"[DEBUG IGNORE RESULT] NF {dados['nf']} ignorada (destinatário é o nosso: {dest})")
-                            escreverRelatorio(f"{_now()} - 💰 NF {dados.get('nf')} ignorada (destinatário é o nosso).")
-                            continue
-                        if not dados:
-                            motivo = dados.get("motivo_ignoracao", "Desconhecido") if isinstance(dados, dict) else "Desconhecido"
-                            logger.info(f"Ignorado XML (motivo: {motivo}).")
-                            escreverRelatorio(f"{_now()} - ⚠️ XML {nome_arquivo} ignorado (motivo: {motivo})")
+        try:
+            # =============================
+            # 📄 XML → extrai dados
+            # =============================
+            if anexo.eh_xml:
+                try:
+                    chave_conteudo, dados, erro = analises[nome_arquivo]
+                    # ♻️ Mesmo conteúdo já analisado (outra mensagem/ciclo) → não foi analisado de novo
+                    if dados is None and erro is None:
+                        logger.info("♻️ XML %s idêntico a um já processado; ignorado.", nome_arquivo)
+                        continue
+                    if erro:
+                        escreverRelatorio(f"{_now()} - ❌ Erro extraindo XML {nome_arquivo}: {erro}", tipo="erro_xml")
+                        logger.error("Erro extraindo XML %s: %s", nome_arquivo, erro)
+                        continue
+
+                    # ♻️ Mesma NF-e em arquivo diferente → não consulta as planilhas de novo
+                    if cache_nfes.contem(dados.get("chaveAcesso")):
+                        logger.info("♻️ NF %s (chave %s) já processada; ignorada.", dados.get("nf"), dados.get("chaveAcesso"))
+                        cache_anexos.adicionar([chave_conteudo])
+                        continue
+
+                    # 🔍 Ignora vendas à vista
+                    nat_op = dados.get("naturezaOperacao", "").strip().upper()
+                    dest = dados.get("destinatario", "")
+                    if ( "VISTA" in nat_op or "VENDA A VISTA" in nat_op):
+                        _registrar_xml_visto(chave_conteudo, dados)
+                        # Checa se a mensagem ja foi processada no relatorio atual:
+                        if not nfJaRelatada(dados.get('nf')): 
+                            escreverRelatorio(f"{_now()} - 💰 NF {dados.get('nf')} ignorada (venda à vista).",
+                                              tipo="ignorada_vista", nf=dados.get('nf'), cnpj=dados.get('cnpjEmitente'))
                             continue
+                        else: logger.info(f"{cor_ciano}NF {dados['nf']} já registrada no relatório, não duplicando a mensagem de ignorada.{reset}") 
+                        continue
+                    if ( CNPJ_MVA.replace(".", "").replace("/", "").replace("-", "") in dest or
+                         CNPJ_EH.replace(".", "").replace("/", "").replace("-", "") in dest ):
+                        _registrar_xml_visto(chave_conteudo, dados)
+                        logger.info(f"[DEBUG IGNORE RESULT] NF {dados['nf']} ignorada (destinatário é o nosso: {dest})")
+                        escreverRelatorio(f"{_now()} - 💰 NF {dados.get('nf')} ignorada (destinatário é o nosso).",
+                                          tipo="ignorada_destinatario", nf=dados.get('nf'), cnpj=dados.get('cnpjEmitente'))
+                        continue
+                    if not dados:
+                        motivo = dados.get("motivo_ignoracao", "Desconhecido") if isinstance(dados, dict) else "Desconhecido"
+                        logger.info(f"Ignorado XML (motivo: {motivo}).")
+                        escreverRelatorio(f"{_now()} - ⚠️ XML {nome_arquivo} ignorado (motivo: {motivo})", tipo="xml_ignorado")
+                        continue
+
+                    dados_xmls.append((dados, chave_conteudo))
 
-                        dados_xmls.append(dados)
-
-                    except Exception as e:
-                        escreverRelatorio(f"{_now()} - ❌ Erro extraindo XML {nome_arquivo}: {e}")
-                        logger.exception("Erro extraindo XML %s: %s", arquivo, e)
-
-                # =============================
-                # 📑 PDF → tenta identificar boleto
-                # =============================
-                elif arquivo.lower().endswith(".pdf"): # mudar pra elif se o bloco de cima for realmente necessário
+                except Exception as e:
+                    escreverRelatorio(f"{_now()} - ❌ Erro extraindo XML {nome_arquivo}: {e}", tipo="erro_xml")
+                    logger.exception("Erro extraindo XML %s: %s", nome_arquivo, e)
+
+            # =============================
+            # 📑 PDF → tenta identificar boleto
+            # =============================
+            elif anexo.eh_pdf: # mudar pra elif se o bloco de cima for realmente necessário
+                nome_upper = nome_arquivo.upper()
+
+                # 🔍 Trata nomes parecidos com BOLETO (erros comuns tipo BOLTO, BOLETA, BOLETT, etc)
+                padrao_boleto = r"[_\s-]?(BLT|BOLET[OA]?|BOLTO|BOLETOO|BOLETT?)"
+
+                if re.search(padrao_boleto, nome_upper):
+                    match = re.findall(r"([0-9]{2,}-?[0-9]+)", nome_upper)
+                    if match:
+                        num_boleto = match[-1]
+                        boletos.append(num_boleto)
+                        logger.info("🔢 Boleto identificado no nome: %s (BLT %s)", nome_arquivo, num_boleto)
+                    else:
+                        logger.info("Nenhum número de boleto encontrado no nome: %s", nome_arquivo)
+                elif anexo.eh_pdf:
                     nome_upper = nome_arquivo.upper()
 
-                    # 🔍 Trata nomes parecidos com BOLETO (erros comuns tipo BOLTO, BOLETA, BOLETT, etc)
-                    padrao_boleto = r"[_\s-]?(BLT|BOLET[OA]?|BOLTO|BOLETOO|BOLETT?)"
+                    # 🔍 Palavras que indicam boleto (considera erros comuns)
+                    padrao_boleto = r"\b(BOLET[OA]?|BOLTO|BOLETOO|BOLETT?|BLT)\b"
 
+                    # Só tenta identificar número se o nome realmente tiver algo próximo de "boleto"
                     if re.search(padrao_boleto, nome_upper):
                         match = re.findall(r"([0-9]{2,}-?[0-9]+)", nome_upper)
                         if match:
@@ -117,163 +203,296 @@ def processar_emails_enviados():
                             boletos.append(num_boleto)
                             logger.info("🔢 Boleto identificado no nome: %s (BLT %s)", nome_arquivo, num_boleto)
                         else:
-                            logger.info("Nenhum número de boleto encontrado no nome: %s", nome_arquivo)
-                    elif arquivo.lower().endswith(".pdf"):
-                        nome_upper = nome_arquivo.upper()
-
-                        # 🔍 Palavras que indicam boleto (considera erros comuns)
-                        padrao_boleto = r"\b(BOLET[OA]?|BOLTO|BOLETOO|BOLETT?|BLT)\b"
-
-                        # Só tenta identificar número se o nome realmente tiver algo próximo de "boleto"
-                        if re.search(padrao_boleto, nome_upper):
-                            match = re.findall(r"([0-9]{2,}-?[0-9]+)", nome_upper)
-                            if match:
-                                num_boleto = match[-1]
-                                boletos.append(num_boleto)
-                                logger.info("🔢 Boleto identificado no nome: %s (BLT %s)", nome_arquivo, num_boleto)
-                            else:
-                                logger.info("📎 Possível boleto sem número identificado: %s", nome_arquivo)
-                        else:
-                            logger.info("📄 PDF ignorado (não parece boleto): %s", nome_arquivo)
+                            logger.info("📎 Possível boleto sem número identificado: %s", nome_arquivo)
+                    else:
+                        logger.info("📄 PDF ignorado (não parece boleto): %s", nome_arquivo)
 
-                else:
-                    logger.info("Arquivo não identificado como boleto: %s", nome_arquivo)
+            else:
+                logger.info("Arquivo não identificado como boleto: %s", nome_arquivo)
+
+        finally:
+            # 🧹 Libera sempre o anexo (memória ou arquivo temporário do PDF)
+            anexo.close()
+
+    # ⚠️ Nenhum XML → pula este e-mail
+    if not dados_xmls:
+        logger.info("Nenhum XML válido encontrado neste e-mail.")
+        return pendentes
+
+    # =============================
+    # 🧾 Planeja as linhas das planilhas
+    # =============================
+    for dados_xml, chave_conteudo in dados_xmls:
+        cnpj_emit = dados_xml.get("cnpjEmitente")
+        ano = dados_xml.get("anoVencimento")
+        planilha_id = escolher_planilha_por_cnpj_e_ano(cnpj_emit, ano)
+
+        if not planilha_id:
+            logger.warning("CNPJ %s ou ano %s sem planilha configurada.", cnpj_emit, ano)
+            _registrar_xml_visto(chave_conteudo, dados_xml)
+            continue
 
-            finally:
-                # 🧹 Remove sempre o anexo local (independente do tipo)
+        # Sem parcelas (à vista, destinatário nosso...) não há linha a gravar
+        if not dados_xml.get("parcelas"):
+            _registrar_xml_visto(chave_conteudo, dados_xml)
+            continue  # nada a fazer
+
+        linhas_planejadas = planejar_parcelas(dados_xml, planilha_id, boletos, plano)
+        pendentes.append((chave_conteudo, dados_xml, linhas_planejadas))
+    return pendentes
+
+def _registrar_xml_visto(chave_conteudo, dados):
+    cache_anexos.adicionar([chave_conteudo])
+    cache_nfes.adicionar([dados.get("chaveAcesso")])
+
+def _gravar_lote(lote):
+    """
+    Etapa compartilhada por todas as contas: grava no Sheets, registra e rotula o lote.
+    Só as mensagens concluídas (anexos baixados e todas as linhas tratadas) são
+    registradas e rotuladas; se sobrar alguma, o lote é dado como falho, para o ciclo
+    não confirmar a sincronização e buscá-la de novo.
+    """
+    service, conta, totais, msgs, plano, pendentes, falhas = lote
+    falhas = set(falhas)
+    # =============================
+    # 🧾 Atualiza planilhas (um append por aba)
+    # =============================
+    resultados = plano.executar()
+    concluidas = []
+    for m in msgs:
+        msg_id = m.get("id")
+        if msg_id in falhas:
+            continue
+        for chave_conteudo, dados_xml, linhas in pendentes.get(msg_id, []):
+            ok = [n for n in linhas if resultados[n].ok]
+            totais["linhas"] += len(ok)
+            # Só marca a NF como vista se todas as parcelas foram tratadas (gravadas ou já existentes)
+            if len(ok) == len(linhas):
+                _registrar_xml_visto(chave_conteudo, dados_xml)
+            else:
+                falhas.add(msg_id)
+        if msg_id not in falhas:
+            concluidas.append(m)
+
+    for m in concluidas:
+        cache_anexos.adicionar(_chaves_previas(m))
+    registrarProcessadas(conta, concluidas)
+
+    # =============================
+    # 🏷️ Marca os e-mails do lote como processados (um batchModify)
+    # =============================
+    resultado_rotulos = marcar_mensagens_com_label(service, [m.get("id") for m in concluidas])
+    rotulados = [msg_id for msg_id, erro in resultado_rotulos.items() if erro is None]
+    logger.info("🏷️ [%s] %d e-mails marcados com 'XML Processado Botana'", conta, len(rotulados))
+
+    if falhas:
+        raise RuntimeError(f"{len(falhas)} mensagem(ns) não concluídas (anexos não baixados ou linhas não gravadas) "
+                           f"ficaram para o próximo ciclo: {', '.join(sorted(falhas)[:5])}")
+
+def _processar_conta(cred_file, sessao, gravador):
+    """
+    Pipeline de uma conta: listar → baixar → analisar → planejar, um lote de threads por vez;
+    os lotes planejados vão para a etapa de gravação compartilhada (`gravador`).
+    Retorna (service, conta, totais, erros do pipeline).
+    """
+    service = getGmailService(cred_file)
+    conta = conta_do_servico(service)
+    vistos_ciclo = set()
+    totais = {"mensagens": 0, "linhas": 0}
+
+    def listar():
+        for msgs in iterarMessagesIncremental(service, max_results=100):
+            msgs = filtrarNaoProcessadas(conta, msgs)
+            if msgs:
+                # 📥 Sem os XMLs repetidos (já processados ou repetidos no ciclo)
+                _descartar_anexos_repetidos(msgs, vistos_ciclo)
+                totais["mensagens"] += len(msgs)
+                yield msgs
+
+    def baixar(msgs):
+        anexos_por_msg, falhas = baixar_anexos_de_mensagens(service, msgs)
+        # Mensagem com algum anexo não baixado volta inteira no próximo ciclo
+        for msg_id in falhas:
+            for anexo in anexos_por_msg.pop(msg_id, []):
+                anexo.close()
+        return msgs, anexos_por_msg, falhas
+
+    def analisar(lote):
+        msgs, anexos_por_msg, falhas = lote
+        return msgs, anexos_por_msg, falhas, _analisar_xmls(anexos_por_msg)
+
+    def planejar(lote):
+        msgs, anexos_por_msg, falhas, analises = lote
+        plano = PlanoEscrita(sessao)
+        # msg_id -> [(chave do conteúdo, dados da NF, nºs das linhas no plano)]
+        pendentes = {}
+        for m in msgs:
+            if m.get("id") in falhas:
+                continue
+            pendentes[m.get("id")] = _processar_mensagem(m, anexos_por_msg.get(m.get("id"), []), plano, analises)
+        return msgs, plano, pendentes, falhas
+
+    def enviar(lote):
+        msgs, plano, pendentes, falhas = lote
+        gravador.enviar((service, conta, totais, msgs, plano, pendentes, falhas))
+
+    erros = Pipeline([
+        ("baixar", baixar),
+        ("analisar", analisar),
+        ("planejar", planejar),
+        ("enviar", enviar),
+    ]).executar(listar(), nome_fonte="listar")
+    return service, conta, totais, erros
+
+def processar_emails_enviados(contas_ciclo=None):
+    """
+    Ciclo do bot: cada conta de `contas_ciclo` (padrão: CONTAS_GMAIL) roda seu pipeline numa thread própria e
+    todas alimentam uma única etapa de gravação no Sheets, que compartilha a sessão
+    (planilhas abertas, índices de duplicados e orçamento de cota). Enquanto um lote é
+    gravado, os seguintes já estão sendo baixados. Cada lote é registrado e rotulado
+    logo após a sua gravação. Retorna o nº de mensagens novas (usado pelo agendador).
+    """
+    contas_ciclo = contas_ciclo or CONTAS_GMAIL
+    inicio_ciclo = datetime.now()
+    inicio_medicao = time.perf_counter()
+    sessao = obterSessaoSheets()
+    gravador = EtapaCompartilhada("gravar", _gravar_lote, origem=lambda lote: lote[1],
+                                  capacidade=CAPACIDADE_FILA_PIPELINE * len(contas_ciclo))
+    try:
+        with ThreadPoolExecutor(max_workers=len(contas_ciclo), thread_name_prefix="conta-gmail") as pool:
+            futuros = {pool.submit(_processar_conta, cred, sessao, gravador): cred for cred in contas_ciclo}
+            contas = []
+            for futuro, cred in futuros.items():
                 try:
-                    os.remove(arquivo)
-                    logger.debug(f"🧹 Anexo removido: {arquivo}")
-                except FileNotFoundError:
-                    pass
+                    contas.append(futuro.result())
                 except Exception as e:
-                    logger.warning(f"⚠️ Falha ao remover {arquivo}: {e}")
-
-        # =============================
-        # 🏷️ Marca o e-mail como processado
-        # =============================
-        try:
-            marcar_mensagem_com_label(service, msg_id)
-            logger.info("🏷️ E-mail %s marcado com 'XML Processado Botana'", msg_id)
-        except Exception as e:
-            logger.exception("Falha ao aplicar rótulo: %s", e)
-            
-        # ⚠️ Nenhum XML → pula este e-mail
-        if not dados_xmls:
-            logger.info("Nenhum XML válido encontrado neste e-mail.")
+                    logger.exception("Erro no ciclo da conta %s: %s", os.path.basename(cred), e)
+    finally:
+        erros_gravacao = gravador.encerrar()
+
+    falhas = len(contas_ciclo) - len(contas)
+    for service, conta, totais, erros in contas:
+        erros = erros + [("gravar", e) for e in erros_gravacao.get(conta, [])]
+        if erros:
+            # Algum lote ficou pelo caminho: não avança historyId nem marca d'água, para buscá-lo de novo
+            etapa, erro = erros[0]
+            logger.error("[%s] %d lote(s) falharam no ciclo (primeiro na etapa %s: %s)", conta, len(erros), etapa, erro)
+            falhas += 1
             continue
-
-        # =============================
-        # 🧾 Atualiza planilhas
-        # =============================
-        for dados_xml in dados_xmls:
-            cnpj_emit = dados_xml.get("cnpjEmitente")
-            ano = dados_xml.get("anoVencimento")
-            planilha_id = escolher_planilha_por_cnpj_e_ano(cnpj_emit, ano)
-
-            if not planilha_id:
-                logger.warning("CNPJ %s ou ano %s sem planilha configurada.", cnpj_emit, ano)
-                continue
-
-            # Itera sobre todas as parcelas — MAPEAMENTO correto de boletos → parcelas
-            parcelas = dados_xml.get("parcelas", [])
-            n_parcelas = len(parcelas)
-            n_boletos = len(boletos)
-
-            # monta lista de boletos por parcela (mesmo tamanho de parcelas)
-            if n_parcelas == 0:
-                continue  # nada a fazer
-
-            if n_boletos == 0:
-                boletos_map = [None] * n_parcelas
-            else:
-                # Se tiver igual, mapeia 1:1; se menor, preenche em ordem; se maior, usa só os primeiros N
-                boletos_map = [boletos[i] if i < n_boletos else None for i in range(n_parcelas)]
-                if n_boletos > n_parcelas:
-                    logger.info("⚠️ Mais boletos (%d) que parcelas (%d). Sobraram: %s", n_boletos, n_parcelas, boletos[n_parcelas:])
-
-            # Agora processa 1 vez por parcela, usando o boleto mapeado (ou None)
-            for idx, parcela in enumerate(parcelas):
-                num_boleto = boletos_map[idx]
-                dados_parcela = dados_xml.copy()
-                dados_parcela.update({
-                    "vencimento": parcela["vencimento"],
-                    "numParcela": parcela["numParcela"],
-                    "valorParcela": parcela["valor"],
-                    "boleto": num_boleto  # adiciona campo explícito (opcional)
-                })
-
-                # Ajusta descrição com o boleto mapeado (se houver)
-                if num_boleto:
-                    dados_parcela["descricao"] = f"{dados_parcela['destinatario']} BLT {num_boleto} (Bot)"
-                else:
-                    if "18471209000107" in cnpj_emit.upper():
-                        dados_parcela["descricao"] = f"{dados_parcela['destinatario']} DEP BR (Bot)"
-                    else:
-                        dados_parcela["descricao"] = f"{dados_parcela['destinatario']} DEP CX (Bot)"
-
-                # Tenta atualizar planilha com retry
-                for tentativa in range(5):
-                    try:
-                        creds = Credentials.from_service_account_file(
-                            GOOGLE_CREDENTIALS_SHEETS,
-                            scopes=["https://www.googleapis.com/auth/spreadsheets"]
-                        )
-                        gc = gspread.authorize(creds)
-
-                        if not hasattr(processar_emails_enviados, "_cache"):
-                            processar_emails_enviados._cache = {}
-
-                        cache = processar_emails_enviados._cache
-
-                        if planilha_id not in cache:
-                            cache[planilha_id] = gc.open_by_key(planilha_id)
-
-                        planilha = cache[planilha_id]
-                        atualizarPlanilha(planilha, dados_parcela)
-                        total_processados += 1
-                        break         
-                    except gspread.exceptions.APIError as e:
-                        if "429" in str(e):
-                            from sheets_writer import apiCooldown
-                            apiCooldown()
-                            continue
-                        else:
-                            logger.exception("Erro ao atualizar planilha: %s", e)
-                            break
-                    except Exception as e:
-                        logger.exception("Falha inesperada ao atualizar planilha: %s", e)
-                        break
-    logger.info("Ciclo finalizado. Total processado: %d", total_processados)
+        if not totais["mensagens"]:
+            logger.info("[%s] Nenhuma mensagem enviada com XML encontrada.", conta)
+        # Busca incompleta (threads que não puderam ser obtidas): o próximo ciclo refaz o mesmo trecho
+        if confirmarSincronizacao(service):
+            avancarWatermark(conta, inicio_ciclo)
+        logger.info("[%s] Ciclo finalizado. Total processado: %d", conta, totais["linhas"])
+
+    encontradas = sum(totais["mensagens"] for _, _, totais, _ in contas)
+    _registrar_metricas_ciclo(time.perf_counter() - inicio_medicao, contas, falhas)
+    if falhas:
+        raise RuntimeError(f"{falhas} conta(s) com falhas no ciclo")
+    return encontradas
+
+def _registrar_metricas_ciclo(segundos, contas, falhas):
+    """Duração e itens do ciclo: histogramas/contadores acumulados e o retrato do último ciclo."""
+    mensagens = linhas = 0
+    for _, conta, totais, _ in contas:
+        metricas.contar("botana_mensagens_total", totais["mensagens"], conta=conta)
+        metricas.contar("botana_linhas_total", totais["linhas"], conta=conta)
+        mensagens += totais["mensagens"]
+        linhas += totais["linhas"]
+    metricas.observar("botana_ciclo_segundos", segundos)
+    metricas.contar("botana_ciclos_total", resultado="falha" if falhas else "ok")
+    metricas.definir("botana_ultimo_ciclo_segundos", segundos)
+    metricas.definir("botana_ultimo_ciclo_mensagens", mensagens)
+    metricas.definir("botana_ultimo_ciclo_linhas", linhas)
+    metricas.definir("botana_ultimo_ciclo_timestamp_segundos", time.time())
+
+def _iniciar_push():
+    """Modo push (GMAIL_PUSH_TOPICO): o polling passa a ser só a rede de segurança."""
+    global agendador
+    if not GMAIL_PUSH_TOPICO:
+        return None
+    push = None
+    try:
+        push = PushGmail(CONTAS_GMAIL, acordar=lambda: agendador.acordar())
+        if not push.iniciar():
+            push.parar()
+            return None
+    except OSError as e:
+        logger.error("❌ Não foi possível abrir o receptor de push: %s; seguindo só com polling.", e)
+        if push is not None:
+            push.parar()
+        return None
+    agendador = Agendador(intervalo=INTERVALO_SEGURANCA_PUSH, minimo=INTERVALO_SEGURANCA_PUSH,
+                          maximo=INTERVALO_SEGURANCA_PUSH)
+    return push
+
+def _aguardar_proximo_ciclo(push):
+    """
+    Espera o próximo ciclo. Retorna as contas a verificar (None = todas: rede de
+    segurança ou "Verificar agora") ou False se o loop deve parar.
+    """
+    while True:
+        espera = agendador.proximo_intervalo()
+        logger.info("⏳ Aguardando %d segundos para próxima verificação...", espera)
+        if agendador.esperar(stop_event, espera):
+            return False
+        if push is None:
+            return None
+        push.renovar_watches()
+        houve_notificacao, contas = push.retirar_pendentes()
+        if not houve_notificacao:
+            return None
+        if contas:
+            logger.info("📨 Push recebido: verificando %d conta(s).", len(contas))
+            return contas
+        logger.debug("Push sem histórico novo; nada a buscar.")
 
 def main():
+    global running
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-
-    while True:
-        try:
-            processar_emails_enviados()
-        except Exception as e:
-            logger.exception("Erro no ciclo principal: %s", e)
-        logger.info("⏳ Aguardando %d segundos para próxima verificação...", INTERVALO)
-        time.sleep(INTERVALO)
+    running = True
+    push = None
+
+    try:
+        iniciarServidorMetricas()
+        push = _iniciar_push()
+        contas = None
+        while not stop_event.is_set():
+            encontradas = 0
+            try:
+                encontradas = processar_emails_enviados(contas)
+            except Exception as e:
+                logger.exception("Erro no ciclo principal: %s", e)
+            agendador.registrar_ciclo(encontradas)
+            contas = _aguardar_proximo_ciclo(push)
+            if contas is False:
+                break
+    finally:
+        if push is not None:
+            push.parar()
+        running = False
 
 def iniciar_verificacao():
-    """Inicia o loop principal em thread separada (chamado pelo tray)."""
+    """Inicia o loop principal em thread separada (chamado pelo tray); se já estiver rodando, antecipa o próximo ciclo."""
     global running
     if not running:
         stop_event.clear()
+        running = True
         t = threading.Thread(target=main, daemon=True)
         t.start()
     else:
-        print("[Main] Loop já está em execução.")
+        print("[Main] Loop já está em execução; verificando agora.")
+        agendador.acordar()
 
 
 def parar_verificacao():
-    """Interrompe o loop principal."""
+    """Interrompe o loop principal (inclusive no meio da espera)."""
     global running
     if running:
         print("[Main] Parando loop principal...")
         stop_event.set()
+        agendador.acordar()
         running = False
     else:
         print("[Main] Nenhum loop ativo para encerrar.")
@@ -289,5 +508,7 @@ def on_quit():
 # EXECUÇÃO PRINCIPAL
 # =========================
 if __name__ == "__main__":
+    # Necessário no executável do PyInstaller para o pool de processos do XML
+    multiprocessing.freeze_support()
     # Passa callbacks para o tray (para permitir controle)
     run_tray(on_quit_callback=on_quit, start_callback=iniciar_verificacao)
@@ -0,0 +1,196 @@
+# metricas.py
+"""
+Métricas do bot em memória: contadores, valores instantâneos e histogramas de tempo,
+com rótulos. Expostas no formato texto do Prometheus por um servidor HTTP local
+(GET /metrics) e resumidas no tooltip do ícone da bandeja.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from config import METRICAS_HOST, METRICAS_PORTA
+
+logger = logging.getLogger("bot.metricas")
+
+# Limites (em segundos) dos histogramas de tempo: de uma chamada à API até um ciclo longo
+BUCKETS_SEGUNDOS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800)
+
+# O tooltip da bandeja no Windows corta em 127 caracteres
+TAMANHO_MAXIMO_TOOLTIP = 127
+
+Rotulos = Tuple[Tuple[str, str], ...]
+
+def _rotulos(rotulos: Dict[str, object]) -> Rotulos:
+    return tuple(sorted((k, str(v)) for k, v in rotulos.items()))
+
+def _formatar_rotulos(rotulos: Rotulos, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pares = rotulos + extra
+    if not pares:
+        return ""
+    escapar = lambda v: v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{escapar(v)}"' for k, v in pares) + "}"
+
+def _formatar_valor(valor: float) -> str:
+    return str(int(valor)) if float(valor).is_integer() else repr(float(valor))
+
+class _Histograma:
+    def __init__(self, limites: Tuple[float, ...]):
+        self.limites = limites
+        self.contagens = [0] * len(limites)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor: float):
+        for i, limite in enumerate(self.limites):
+            if valor <= limite:
+                self.contagens[i] += 1
+        self.soma += valor
+        self.total += 1
+
+class Metricas:
+    """
+    Registro de métricas seguro entre threads. Os nomes seguem o Prometheus
+    (contadores terminam em _total); os rótulos vêm como kwargs:
+        metricas.contar("botana_api_chamadas_total", api="Gmail", endpoint="gmail.users.threads.get")
+        with metricas.medir("botana_etapa_segundos", etapa="baixar"): ...
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores: Dict[str, Dict[Rotulos, float]] = {}
+        self._valores: Dict[str, Dict[Rotulos, float]] = {}
+        self._histogramas: Dict[str, Dict[Rotulos, _Histograma]] = {}
+
+    def contar(self, nome: str, valor: float = 1, **rotulos):
+        chave = _rotulos(rotulos)
+        with self._lock:
+            serie = self._contadores.setdefault(nome, {})
+            serie[chave] = serie.get(chave, 0) + valor
+
+    def definir(self, nome: str, valor: float, **rotulos):
+        """Valor instantâneo (gauge), ex.: mensagens do último ciclo."""
+        with self._lock:
+            self._valores.setdefault(nome, {})[_rotulos(rotulos)] = valor
+
+    def observar(self, nome: str, valor: float, **rotulos):
+        chave = _rotulos(rotulos)
+        with self._lock:
+            serie = self._histogramas.setdefault(nome, {})
+            if chave not in serie:
+                serie[chave] = _Histograma(BUCKETS_SEGUNDOS)
+            serie[chave].observar(valor)
+
+    @contextmanager
+    def medir(self, nome: str, **rotulos):
+        """Observa no histograma `nome` o tempo do bloco (mesmo se ele lançar exceção)."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **rotulos)
+
+    def valor(self, nome: str, **filtro) -> float:
+        """Soma das séries de um contador ou gauge cujos rótulos contêm `filtro`."""
+        esperado = set(_rotulos(filtro))
+        with self._lock:
+            serie = self._contadores.get(nome) or self._valores.get(nome) or {}
+            return sum(v for chave, v in serie.items() if esperado <= set(chave))
+
+    def prometheus(self) -> str:
+        """Todas as métricas no formato texto de exposição do Prometheus (0.0.4)."""
+        linhas: List[str] = []
+        with self._lock:
+            for tipo, series in (("counter", self._contadores), ("gauge", self._valores)):
+                for nome in sorted(series):
+                    linhas.append(f"# TYPE {nome} {tipo}")
+                    for chave, valor in sorted(series[nome].items()):
+                        linhas.append(f"{nome}{_formatar_rotulos(chave)} {_formatar_valor(valor)}")
+            for nome in sorted(self._histogramas):
+                linhas.append(f"# TYPE {nome} histogram")
+                for chave, h in sorted(self._histogramas[nome].items()):
+                    for limite, contagem in zip(h.limites, h.contagens):
+                        linhas.append(f"{nome}_bucket{_formatar_rotulos(chave, (('le', _formatar_valor(limite)),))} {contagem}")
+                    linhas.append(f"{nome}_bucket{_formatar_rotulos(chave, (('le', '+Inf'),))} {h.total}")
+                    linhas.append(f"{nome}_sum{_formatar_rotulos(chave)} {_formatar_valor(h.soma)}")
+                    linhas.append(f"{nome}_count{_formatar_rotulos(chave)} {h.total}")
+        return "\n".join(linhas) + "\n"
+
+    def limpar(self):
+        with self._lock:
+            self._contadores.clear()
+            self._valores.clear()
+            self._histogramas.clear()
+
+metricas = Metricas()
+
+def resumo_tooltip() -> str:
+    """Resumo curto do último ciclo e das chamadas à API, para o tooltip da bandeja."""
+    if not metricas.valor("botana_ciclos_total"):
+        return "Botana - aguardando o primeiro ciclo"
+    resumo = (f"Botana - último ciclo: {int(metricas.valor('botana_ultimo_ciclo_mensagens'))} msgs, "
+              f"{int(metricas.valor('botana_ultimo_ciclo_linhas'))} linhas em "
+              f"{metricas.valor('botana_ultimo_ciclo_segundos'):.0f}s")
+    for api in ("Gmail", "Sheets"):
+        chamadas = int(metricas.valor("botana_api_chamadas_total", api=api))
+        erros_429 = int(metricas.valor("botana_api_erros_429_total", api=api))
+        resumo += f"\n{api}: {chamadas} chamadas" + (f", {erros_429}x 429" if erros_429 else "")
+    return resumo[:TAMANHO_MAXIMO_TOOLTIP]
+
+# =========================
+# SERVIDOR /metrics
+# =========================
+
+class ServidorMetricas:
+    """Servidor HTTP local que responde GET /metrics com metricas.prometheus()."""
+
+    def __init__(self, host: str = METRICAS_HOST, porta: int = METRICAS_PORTA, registro: Metricas = metricas):
+        registro_metricas = registro
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                corpo = registro_metricas.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def log_message(self, fmt, *args):
+                logger.debug("metrics %s - " + fmt, self.client_address[0], *args)
+
+        self._servidor = ThreadingHTTPServer((host, porta), _Handler)
+        self._servidor.daemon_threads = True
+
+    @property
+    def porta(self) -> int:
+        return self._servidor.server_address[1]
+
+    def iniciar(self):
+        threading.Thread(target=self._servidor.serve_forever, name="metricas-http", daemon=True).start()
+        logger.info("📊 Métricas em http://%s:%d/metrics", *self._servidor.server_address[:2])
+
+    def parar(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+_servidor: Optional[ServidorMetricas] = None
+_servidor_lock = threading.Lock()
+
+def iniciarServidorMetricas() -> Optional[ServidorMetricas]:
+    """Sobe o endpoint /metrics uma única vez por processo (METRICAS_PORTA=0 desliga)."""
+    global _servidor
+    with _servidor_lock:
+        if _servidor is None and METRICAS_PORTA:
+            try:
+                _servidor = ServidorMetricas()
+                _servidor.iniciar()
+            except OSError as e:
+                logger.warning("⚠️ Não foi possível abrir o endpoint de métricas na porta %d: %s", METRICAS_PORTA, e)
+        return _servidor
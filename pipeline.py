@@ -0,0 +1,124 @@
+# pipeline.py
+"""
+Pipeline em etapas ligadas por filas limitadas. Cada etapa roda numa thread própria,
+então a espera de rede de uma (ex.: download no Gmail) se sobrepõe à de outra
+(ex.: gravação no Sheets) e o ciclo leva perto do tempo da etapa mais lenta.
+Filas cheias bloqueiam a etapa anterior (contrapressão). O tempo de cada item em
+cada etapa vai para o histograma botana_etapa_segundos.
+"""
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from metricas import metricas
+
+logger = logging.getLogger("bot.pipeline")
+
+# Lotes em espera entre duas etapas
+CAPACIDADE_FILA_PIPELINE = 2
+
+_FIM = object()
+
+class Pipeline:
+    """
+    fonte → etapa 1 → etapa 2 → ... Cada etapa é (nome, função); a função recebe o item
+    da etapa anterior e devolve o da próxima (None descarta o item). Uma exceção numa
+    etapa descarta só aquele item e fica registrada em `erros`.
+    """
+
+    def __init__(self, etapas: List[Tuple[str, Callable[[Any], Any]]], capacidade: int = CAPACIDADE_FILA_PIPELINE):
+        self.etapas = etapas
+        self.capacidade = capacidade
+        self.erros: List[Tuple[str, Exception]] = []
+        self._erros_lock = threading.Lock()
+
+    def _rodar_etapa(self, nome: str, func: Callable[[Any], Any], entrada: queue.Queue, saida):
+        while True:
+            item = entrada.get()
+            if item is _FIM:
+                if saida is not None:
+                    saida.put(_FIM)
+                return
+            try:
+                with metricas.medir("botana_etapa_segundos", etapa=nome):
+                    resultado = func(item)
+            except Exception as e:
+                logger.exception("Erro na etapa %s do pipeline: %s", nome, e)
+                with self._erros_lock:
+                    self.erros.append((nome, e))
+                continue
+            if saida is not None and resultado is not None:
+                saida.put(resultado)
+
+    def executar(self, fonte: Iterable[Any], nome_fonte: str = "fonte") -> List[Tuple[str, Exception]]:
+        """
+        Alimenta o pipeline com os itens da fonte (nesta thread) e espera todas as etapas
+        terminarem. O tempo para obter cada item da fonte é medido como a etapa `nome_fonte`.
+        """
+        filas = [queue.Queue(maxsize=self.capacidade) for _ in self.etapas]
+        threads = []
+        for i, (nome, func) in enumerate(self.etapas):
+            saida = filas[i + 1] if i + 1 < len(filas) else None
+            t = threading.Thread(target=self._rodar_etapa, args=(nome, func, filas[i], saida),
+                                 name=f"pipeline-{nome}", daemon=True)
+            t.start()
+            threads.append(t)
+        try:
+            itens = iter(fonte)
+            while True:
+                inicio = time.perf_counter()
+                try:
+                    item = next(itens)
+                except StopIteration:
+                    break
+                metricas.observar("botana_etapa_segundos", time.perf_counter() - inicio, etapa=nome_fonte)
+                filas[0].put(item)
+        except Exception as e:
+            logger.exception("Erro na fonte do pipeline: %s", e)
+            self.erros.append(("fonte", e))
+        finally:
+            filas[0].put(_FIM)
+            for t in threads:
+                t.join()
+        return self.erros
+
+class EtapaCompartilhada:
+    """
+    Etapa única (uma thread) alimentada por vários pipelines — ex.: a gravação no Sheets
+    recebendo os lotes de todas as contas do Gmail. Usada como última etapa de cada
+    pipeline via `enviar`, que bloqueia com a fila cheia. `origem(item)` identifica de
+    onde veio o item, para separar os erros por origem.
+    """
+
+    def __init__(self, nome: str, func: Callable[[Any], Any], origem: Callable[[Any], Any],
+                 capacidade: int = CAPACIDADE_FILA_PIPELINE):
+        self.nome = nome
+        self.func = func
+        self.origem = origem
+        self.erros: Dict[Any, List[Exception]] = {}
+        self._fila: queue.Queue = queue.Queue(maxsize=capacidade)
+        self._thread = threading.Thread(target=self._rodar, name=f"pipeline-{nome}", daemon=True)
+        self._thread.start()
+
+    def enviar(self, item: Any):
+        self._fila.put(item)
+
+    def _rodar(self):
+        while True:
+            item = self._fila.get()
+            if item is _FIM:
+                return
+            try:
+                with metricas.medir("botana_etapa_segundos", etapa=self.nome):
+                    self.func(item)
+            except Exception as e:
+                logger.exception("Erro na etapa %s do pipeline: %s", self.nome, e)
+                self.erros.setdefault(self.origem(item), []).append(e)
+
+    def encerrar(self) -> Dict[Any, List[Exception]]:
+        """Espera os itens já enviados e encerra a thread. Retorna os erros por origem."""
+        self._fila.put(_FIM)
+        self._thread.join()
+        return self.erros
@@ -0,0 +1,207 @@
+# push_gmail.py
+"""
+Modo push: em vez de consultar o Gmail a cada intervalo, o bot registra users.watch
+em cada conta e recebe as notificações do Pub/Sub num servidor HTTP local. Cada
+notificação acorda o loop principal só para a conta afetada, que busca pelo
+history.list apenas o trecho entre o historyId já confirmado e o notificado.
+O polling continua, com intervalo longo, como rede de segurança.
+
+Teste local (sem Pub/Sub): com o bot rodando,
+    python push_gmail.py voce@empresa.com 123456 [--porta 8085] [--token xyz]
+envia uma notificação sintética no mesmo formato do Pub/Sub.
+"""
+import json
+import time
+import base64
+import logging
+import argparse
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from config import GMAIL_PUSH_TOPICO, GMAIL_PUSH_HOST, GMAIL_PUSH_PORTA, GMAIL_PUSH_TOKEN
+from gmail_service import getGmailService, emailDaConta, registrarWatch, historyIdConfirmado
+
+logger = logging.getLogger("bot.push_gmail")
+
+# O watch expira em 7 dias; renova quando falta menos de 1 dia
+RENOVAR_WATCH_ANTES = 24 * 3600
+TAMANHO_MAXIMO_NOTIFICACAO = 64 * 1024
+
+def ler_notificacao(corpo: bytes) -> Tuple[str, int]:
+    """
+    Corpo de um push do Pub/Sub -> (emailAddress, historyId). O payload do Gmail vem
+    em message.data, JSON em base64. ValueError se o corpo não for uma notificação válida.
+    """
+    try:
+        envelope = json.loads(corpo)
+        dados = json.loads(base64.b64decode(envelope["message"]["data"]))
+        return str(dados["emailAddress"]).lower(), int(dados["historyId"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"notificação inválida: {e}") from e
+
+def montar_notificacao(email: str, history_id: int) -> bytes:
+    """Corpo no formato do push do Pub/Sub (usado pelo teste local)."""
+    dados = base64.b64encode(json.dumps({"emailAddress": email, "historyId": history_id}).encode()).decode()
+    return json.dumps({"message": {"data": dados, "messageId": str(time.time_ns())},
+                       "subscription": "local/teste"}).encode()
+
+class ReceptorPush:
+    """
+    Servidor HTTP local que recebe os POSTs do Pub/Sub e repassa (email, historyId)
+    para `ao_notificar`. Com `token`, exige ?token=... na URL (configurado na assinatura).
+    Responde 204 a tudo que foi aceito, para o Pub/Sub não reenviar. A porta só é
+    aberta em iniciar() (OSError se estiver ocupada).
+    """
+
+    def __init__(self, ao_notificar: Callable[[str, int], None], host: str = GMAIL_PUSH_HOST,
+                 porta: int = GMAIL_PUSH_PORTA, token: str = GMAIL_PUSH_TOKEN):
+        self.ao_notificar = ao_notificar
+        self.token = token
+        self.host = host
+        self._porta = porta
+        self._servidor: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def porta(self) -> int:
+        return self._servidor.server_address[1] if self._servidor is not None else self._porta
+
+    def _criar_servidor(self) -> ThreadingHTTPServer:
+        receptor = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                receptor._tratar(self)
+
+            def log_message(self, fmt, *args):
+                logger.debug("push %s - " + fmt, self.client_address[0], *args)
+
+        servidor = ThreadingHTTPServer((self.host, self._porta), _Handler)
+        servidor.daemon_threads = True
+        return servidor
+
+    def _tratar(self, req: BaseHTTPRequestHandler):
+        if self.token and parse_qs(urlsplit(req.path).query).get("token", [""])[0] != self.token:
+            req.send_response(403)
+            req.end_headers()
+            return
+        tamanho = int(req.headers.get("Content-Length") or 0)
+        if not 0 < tamanho <= TAMANHO_MAXIMO_NOTIFICACAO:
+            req.send_response(400)
+            req.end_headers()
+            return
+        try:
+            email, history_id = ler_notificacao(req.rfile.read(tamanho))
+        except ValueError as e:
+            logger.warning("⚠️ Push recebido e descartado: %s", e)
+            req.send_response(400)
+            req.end_headers()
+            return
+        req.send_response(204)
+        req.end_headers()
+        self.ao_notificar(email, history_id)
+
+    def iniciar(self):
+        self._servidor = self._criar_servidor()
+        self._thread = threading.Thread(target=self._servidor.serve_forever, name="push-gmail", daemon=True)
+        self._thread.start()
+        logger.info("📡 Receptor de push ouvindo em %s:%d", *self._servidor.server_address[:2])
+
+    def parar(self):
+        if self._servidor is None:
+            return
+        self._servidor.shutdown()
+        self._servidor.server_close()
+        self._servidor = None
+
+class PushGmail:
+    """
+    Liga o receptor às contas: registra/renova o watch de cada conta e guarda o maior
+    historyId notificado por conta até o loop principal retirá-lo.
+    """
+
+    def __init__(self, contas: List[str], acordar: Callable[[], None], topico: str = GMAIL_PUSH_TOPICO,
+                 receptor: Optional[ReceptorPush] = None):
+        self.contas = contas
+        self.acordar = acordar
+        self.topico = topico
+        self.receptor = receptor or ReceptorPush(self._ao_notificar)
+        self._por_email: Dict[str, str] = {}
+        self._expira: Dict[str, float] = {}
+        self._pendentes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def iniciar(self) -> bool:
+        """Registra os watches e sobe o receptor. False se nenhuma conta aceitou o watch."""
+        for cred in self.contas:
+            try:
+                service = getGmailService(cred)
+                self._por_email[emailDaConta(service).lower()] = cred
+            except Exception as e:
+                logger.error("❌ Não foi possível identificar a conta %s para o push: %s", cred, e)
+        self.renovar_watches()
+        if not self._expira:
+            logger.warning("⚠️ Nenhum watch registrado; seguindo só com polling.")
+            return False
+        self.receptor.iniciar()
+        return True
+
+    def renovar_watches(self):
+        """Registra o watch das contas sem watch ou perto de expirar."""
+        agora = time.time()
+        for email, cred in self._por_email.items():
+            if self._expira.get(cred, 0) - agora > RENOVAR_WATCH_ANTES:
+                continue
+            try:
+                resp = registrarWatch(getGmailService(cred), self.topico)
+                self._expira[cred] = int(resp["expiration"]) / 1000
+                logger.info("📡 Watch do Gmail ativo para %s (historyId %s)", email, resp.get("historyId"))
+            except Exception as e:
+                logger.error("❌ Falha ao registrar watch para %s: %s", email, e)
+
+    def _ao_notificar(self, email: str, history_id: int):
+        cred = self._por_email.get(email)
+        if cred is None:
+            logger.warning("⚠️ Push de conta desconhecida (%s) ignorado.", email)
+            return
+        with self._lock:
+            self._pendentes[cred] = max(history_id, self._pendentes.get(cred, 0))
+        self.acordar()
+
+    def retirar_pendentes(self) -> Tuple[bool, List[str]]:
+        """
+        (houve notificação, contas a verificar). Notificações cujo historyId não passa
+        do já confirmado (ex.: reenvio do Pub/Sub) não geram ciclo.
+        """
+        with self._lock:
+            pendentes, self._pendentes = self._pendentes, {}
+        contas = []
+        for cred, history_id in pendentes.items():
+            confirmado = historyIdConfirmado(getGmailService(cred))
+            if confirmado is None or history_id > int(confirmado):
+                contas.append(cred)
+        return bool(pendentes), contas
+
+    def parar(self):
+        self.receptor.parar()
+
+def enviar_notificacao_teste(email: str, history_id: int, porta: int = GMAIL_PUSH_PORTA,
+                             token: str = GMAIL_PUSH_TOKEN, host: str = "127.0.0.1") -> int:
+    """Faz o papel do Pub/Sub: envia uma notificação sintética ao receptor local. Retorna o status HTTP."""
+    url = f"http://{host}:{porta}/" + (f"?token={token}" if token else "")
+    req = urllib.request.Request(url, data=montar_notificacao(email, history_id),
+                                 headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return resp.status
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Envia uma notificação push sintética ao bot.")
+    parser.add_argument("email", help="emailAddress da conta notificada")
+    parser.add_argument("history_id", type=int, help="historyId informado na notificação")
+    parser.add_argument("--porta", type=int, default=GMAIL_PUSH_PORTA)
+    parser.add_argument("--token", default=GMAIL_PUSH_TOKEN)
+    args = parser.parse_args()
+    print(enviar_notificacao_teste(args.email, args.history_id, args.porta, args.token))
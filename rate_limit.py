@@ -0,0 +1,226 @@
+# rate_limit.py
+"""
+Limitadores de taxa e política de retry compartilhados entre as threads do bot.
+"""
+import time
+import random
+import logging
+import threading
+from typing import Optional, Callable, Any, Dict
+
+from metricas import metricas
+
+logger = logging.getLogger("bot.rate_limit")
+
+
+class TokenBucket:
+    """
+    Balde de fichas: acumula `taxa` fichas por segundo até `capacidade`.
+    consumir() bloqueia até haver fichas suficientes, espalhando as chamadas
+    dentro da cota em vez de dormir um tempo fixo entre elas.
+    """
+
+    def __init__(self, taxa: float, capacidade: Optional[float] = None):
+        if taxa <= 0:
+            raise ValueError("taxa deve ser positiva")
+        self.taxa = float(taxa)
+        self.capacidade = float(capacidade if capacidade is not None else taxa)
+        self._fichas = self.capacidade
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _repor(self):
+        agora = time.monotonic()
+        self._fichas = min(self.capacidade, self._fichas + (agora - self._ultimo) * self.taxa)
+        self._ultimo = agora
+
+    def consumir(self, fichas: float = 1, timeout: Optional[float] = None) -> bool:
+        """
+        Retira `fichas` do balde, esperando se preciso. Retorna False se estourar o timeout.
+        Pedidos maiores que a capacidade (ex.: um lote inteiro da Gmail API) são retirados
+        em parcelas do tamanho do balde, então custam o tempo de reposição completo; as
+        parcelas já retiradas quando o timeout estoura não são devolvidas.
+        """
+        limite = None if timeout is None else time.monotonic() + timeout
+        restante = float(fichas)
+        while restante > 0:
+            parcela = min(restante, self.capacidade)
+            if not self._retirar(parcela, limite):
+                return False
+            restante -= parcela
+        return True
+
+    def _retirar(self, fichas: float, limite: Optional[float]) -> bool:
+        if fichas > self.capacidade:
+            # nunca seria atendido de uma vez; consumir() já parcela, isto é só uma salvaguarda
+            logger.warning("Pedido de %.1f fichas acima da capacidade do balde (%.1f); limitado à capacidade",
+                           fichas, self.capacidade)
+            fichas = self.capacidade
+        while True:
+            with self._lock:
+                self._repor()
+                if self._fichas >= fichas:
+                    self._fichas -= fichas
+                    return True
+                espera = (fichas - self._fichas) / self.taxa
+            if limite is not None:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return False
+                espera = min(espera, restante)
+            time.sleep(espera)
+
+
+# =========================
+# POLÍTICA DE RETRY
+# =========================
+
+# Status HTTP que valem nova tentativa (limite de cota e falhas temporárias do servidor)
+STATUS_RETENTAVEIS = (429, 500, 502, 503, 504)
+
+
+def nome_endpoint(func: Callable[..., Any]) -> str:
+    """
+    Nome do endpoint para as métricas: o methodId das requisições do googleapiclient
+    (ex.: gmail.users.threads.get), senão o nome do método do gspread (ex.: append_rows).
+    """
+    dono = getattr(func, "__self__", None)
+    metodo = getattr(dono, "methodId", None)
+    if metodo:
+        return metodo
+    nome = getattr(func, "__name__", "desconhecido")
+    # batch.execute do googleapiclient -> "BatchHttpRequest"
+    return type(dono).__name__ if nome == "execute" and dono is not None else nome
+
+
+def _status_e_retry_after(erro: Exception):
+    """
+    Extrai (status HTTP, Retry-After em segundos) de erros do gspread (APIError.response)
+    e do googleapiclient (HttpError.resp). Retorna (None, None) se não for erro HTTP.
+    """
+    status, headers = None, {}
+    resposta = getattr(erro, "response", None)  # gspread.exceptions.APIError -> requests.Response
+    if resposta is not None and hasattr(resposta, "status_code"):
+        status, headers = resposta.status_code, resposta.headers or {}
+    else:
+        resp = getattr(erro, "resp", None)  # googleapiclient.errors.HttpError -> httplib2.Response (dict)
+        if resp is not None:
+            status, headers = getattr(resp, "status", None), resp
+    if status is None and "429" in str(erro):
+        status = 429
+    # A Gmail API sinaliza limite por usuário também como 403 rateLimitExceeded
+    if status == 403 and "ratelimitexceeded" in str(erro).lower():
+        status = 429
+    retry_after = None
+    valor = headers.get("Retry-After") or headers.get("retry-after")
+    if valor:
+        try:
+            retry_after = max(0.0, float(valor))
+        except (TypeError, ValueError):
+            retry_after = None
+    return status, retry_after
+
+
+def status_http(erro: Exception) -> Optional[int]:
+    """Status HTTP do erro (403 rateLimitExceeded conta como 429); None se não for erro HTTP."""
+    return _status_e_retry_after(erro)[0]
+
+
+class PoliticaRetry:
+    """
+    Política de retry compartilhada pelos clientes do Sheets e do Gmail:
+      • orçamento por minuto (TokenBucket) consumido antes de cada chamada,
+        para desacelerar antes de receber 429;
+      • backoff exponencial com jitter ("full jitter"), respeitando Retry-After;
+      • contadores de chamadas, retries, esperas e 429, espelhados em `metricas`
+        (botana_api_<contador>_total, com rótulo api e, quando conhecido, endpoint).
+    """
+
+    def __init__(self, nome: str, max_tentativas: int = 6, base: float = 1.0, teto: float = 64.0,
+                 requisicoes_por_minuto: Optional[float] = None):
+        self.nome = nome
+        self.max_tentativas = max_tentativas
+        self.base = base
+        self.teto = teto
+        self.orcamento = TokenBucket(requisicoes_por_minuto / 60.0, requisicoes_por_minuto) if requisicoes_por_minuto else None
+        self._lock = threading.Lock()
+        self._contadores = {
+            "chamadas": 0,
+            "retries": 0,
+            "erros_429": 0,
+            "desistencias": 0,
+            "esperas_orcamento": 0,
+            "segundos_espera": 0.0,
+        }
+
+    def _somar(self, chave: str, valor: float = 1, endpoint: Optional[str] = None):
+        with self._lock:
+            self._contadores[chave] += valor
+        rotulos = {"api": self.nome, "endpoint": endpoint} if endpoint else {"api": self.nome}
+        metricas.contar(f"botana_api_{chave}_total", valor, **rotulos)
+
+    def contadores(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._contadores)
+
+    def retentavel(self, erro: Exception, status_retentaveis=STATUS_RETENTAVEIS) -> bool:
+        return _status_e_retry_after(erro)[0] in status_retentaveis
+
+    def aguardar_orcamento(self, custo: float = 1):
+        """Consome do orçamento por minuto, esperando se ele estiver esgotado."""
+        if self.orcamento is None:
+            return
+        inicio = time.monotonic()
+        self.orcamento.consumir(custo)
+        espera = time.monotonic() - inicio
+        if espera > 0.01:
+            self._somar("esperas_orcamento")
+            self._somar("segundos_espera", espera)
+
+    def espera(self, tentativa: int, erro: Optional[Exception] = None) -> float:
+        """Tempo antes da próxima tentativa: Retry-After do servidor ou backoff exponencial com jitter."""
+        retry_after = _status_e_retry_after(erro)[1] if erro is not None else None
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base)
+        return random.uniform(0, min(self.teto, self.base * (2 ** tentativa)))
+
+    def registrar_falha(self, tentativa: int, erro: Exception, endpoint: Optional[str] = None,
+                        status_retentaveis=STATUS_RETENTAVEIS) -> bool:
+        """
+        Contabiliza uma falha e, se ainda couber retry, dorme o backoff.
+        Retorna True se o chamador deve tentar de novo.
+        """
+        status, _ = _status_e_retry_after(erro)
+        if status == 429:
+            self._somar("erros_429", endpoint=endpoint)
+        if status not in status_retentaveis or tentativa + 1 >= self.max_tentativas:
+            if status in status_retentaveis:
+                self._somar("desistencias")
+            return False
+        espera = self.espera(tentativa, erro)
+        logger.warning("⏳ %s: HTTP %s, nova tentativa em %.1fs (%d/%d)",
+                       self.nome, status, espera, tentativa + 1, self.max_tentativas - 1)
+        self._somar("retries")
+        self._somar("segundos_espera", espera)
+        time.sleep(espera)
+        return True
+
+    def executar(self, func: Callable[..., Any], *args, custo: float = 1,
+                 status_retentaveis=STATUS_RETENTAVEIS, **kwargs) -> Any:
+        """
+        Executa func(*args, **kwargs) dentro do orçamento, repetindo em erros retentáveis.
+        Chamadas não idempotentes (ex.: append) restringem `status_retentaveis` aos
+        erros em que o servidor com certeza não aplicou a chamada (429).
+        """
+        endpoint = nome_endpoint(func)
+        tentativa = 0
+        while True:
+            self.aguardar_orcamento(custo)
+            self._somar("chamadas", endpoint=endpoint)
+            try:
+                with metricas.medir("botana_api_segundos", api=self.nome, endpoint=endpoint):
+                    return func(*args, **kwargs)
+            except Exception as e:
+                if not self.registrar_falha(tentativa, e, endpoint, status_retentaveis):
+                    raise
+                tentativa += 1
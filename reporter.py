@@ -1,10 +1,16 @@
 # reporter.py
 import os
+import re
 import time
-from pathlib import Path
-from datetime import datetime
+import queue
+import atexit
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
 
-from config import RELATORIO_DIR as relatorioDir
+from config import BASE_DIR, RELATORIO_DIR as relatorioDir
 
 # Variáveis de relatório de sessão
 eventosProcessados = []
@@ -15,27 +21,297 @@ RELATORIO_TXT = "relatorio_status.txt"
 RELATORIO_TEMP = "relatorio_temp.tmp"
 ultimoRelatorio = {"Conta Principal": None}
 
+# =========================
+# LOG DE EVENTOS (SQLite)
+# =========================
+# Cada linha do relatório vira um evento estruturado (tipo, NF, CNPJ, conta, dia) num
+# SQLite indexado. Uma thread grava os eventos em lote a cada INTERVALO_FLUSH_EVENTOS
+# (um commit com fsync por lote) e, em seguida, acrescenta as linhas novas ao
+# relatorio_YYYY-MM-DD.txt, que passa a ser só uma visão legível do log.
+
+EVENTOS_DB = os.path.join(BASE_DIR, "botana_eventos.sqlite3")
+INTERVALO_FLUSH_EVENTOS = 2.0     # segundos entre gravações do lote
+LOTE_FLUSH_EVENTOS = 200          # acorda a gravação antes do tempo com esta fila
+DIAS_RETENCAO_EVENTOS = 90        # rotação por idade do log
+LIMITE_EVENTOS = 200000           # rotação por tamanho do log (eventos)
+DIAS_RETENCAO_RELATORIOS = 7      # relatórios .txt mantidos na pasta
+
+logger = logging.getLogger("bot.reporter")
+
+class _LogEventos:
+    def __init__(self, caminho: str):
+        self.caminho = caminho
+        self._fila: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._acordar = threading.Event()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._thread: Optional[threading.Thread] = None
+        self._dias_pendentes = set()   # dias com linhas ainda não renderizadas no .txt
+        self._ultima_limpeza = None
+
+    def conexao(self) -> sqlite3.Connection:
+        """Conexão única do processo (usar com self._lock)."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.caminho, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS eventos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    dia TEXT NOT NULL,
+                    tipo TEXT NOT NULL,
+                    nf TEXT,
+                    cnpj TEXT,
+                    conta TEXT,
+                    texto TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_eventos_dia ON eventos (dia, tipo);
+                CREATE INDEX IF NOT EXISTS idx_eventos_nf ON eventos (nf);
+                CREATE INDEX IF NOT EXISTS idx_eventos_cnpj ON eventos (cnpj, dia);
+                CREATE TABLE IF NOT EXISTS relatorios_renderizados (
+                    dia TEXT PRIMARY KEY,
+                    ate_id INTEGER NOT NULL
+                );
+            """)
+            self._conn = conn
+        return self._conn
+
+    def enfileirar(self, evento: Dict[str, Any]):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._loop, name="log-eventos", daemon=True)
+                    self._thread.start()
+        self._fila.put(evento)
+        if self._fila.qsize() >= LOTE_FLUSH_EVENTOS:
+            self._acordar.set()
+
+    def _loop(self):
+        while True:
+            self._acordar.wait(INTERVALO_FLUSH_EVENTOS)
+            self._acordar.clear()
+            try:
+                self.descarregar()
+            except Exception as e:
+                logger.warning("⚠️ Falha gravando o log de eventos: %s", e)
+
+    def descarregar(self):
+        """Grava os eventos da fila num único commit e atualiza os relatórios .txt."""
+        lote = []
+        while True:
+            try:
+                lote.append(self._fila.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            conn = self.conexao()
+            if lote:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO eventos (ts, dia, tipo, nf, cnpj, conta, texto) "
+                    "VALUES (:ts, :dia, :tipo, :nf, :cnpj, :conta, :texto)",
+                    lote,
+                )
+                conn.execute("COMMIT")
+                self._dias_pendentes.update(e["dia"] for e in lote)
+            for dia in sorted(self._dias_pendentes):
+                if self._renderizar_pendentes(conn, dia):
+                    self._dias_pendentes.discard(dia)
+            hoje = datetime.now().strftime("%Y-%m-%d")
+            if self._ultima_limpeza != hoje:
+                self._ultima_limpeza = hoje
+                self._rotacionar(conn)
+
+    def _renderizar_pendentes(self, conn: sqlite3.Connection, dia: str) -> bool:
+        """
+        Acrescenta ao .txt do dia os eventos ainda não renderizados. A transação IMMEDIATE
+        serializa com outros processos (ex.: importar_lote) para não duplicar linhas.
+        Retorna False se o arquivo estiver bloqueado (tenta de novo no próximo lote).
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT ate_id FROM relatorios_renderizados WHERE dia = ?", (dia,)).fetchone()
+            ate_id = row[0] if row else 0
+            novos = conn.execute(
+                "SELECT id, texto FROM eventos WHERE dia = ? AND id > ? ORDER BY id", (dia, ate_id)
+            ).fetchall()
+            if novos:
+                with open(_arquivo_relatorio_do_dia(dia), "a", encoding="utf-8") as f:
+                    f.write("".join(texto + "\n" for _, texto in novos))
+                conn.execute(
+                    "INSERT INTO relatorios_renderizados (dia, ate_id) VALUES (?, ?) "
+                    "ON CONFLICT(dia) DO UPDATE SET ate_id = excluded.ate_id",
+                    (dia, novos[-1][0]),
+                )
+            conn.execute("COMMIT")
+            return True
+        except PermissionError:
+            # arquivo aberto em outro programa: as linhas continuam no log e entram depois
+            conn.execute("ROLLBACK")
+            logger.warning("⚠️ Relatório de %s bloqueado; as linhas serão gravadas no próximo lote.", dia)
+            return False
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _rotacionar(self, conn: sqlite3.Connection):
+        """Descarta eventos antigos (por idade e por tamanho) e os relatórios .txt vencidos."""
+        corte = (datetime.now() - timedelta(days=DIAS_RETENCAO_EVENTOS)).strftime("%Y-%m-%d")
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM eventos WHERE dia < ?", (corte,))
+        excedente = conn.execute("SELECT COUNT(*) FROM eventos").fetchone()[0] - LIMITE_EVENTOS
+        if excedente > 0:
+            conn.execute("DELETE FROM eventos WHERE id IN (SELECT id FROM eventos ORDER BY id LIMIT ?)", (excedente,))
+        conn.execute("DELETE FROM relatorios_renderizados WHERE dia < ?", (corte,))
+        conn.execute("COMMIT")
+        limparRelatoriosAntigos()
+
+    def consultar(self, sql: str, params=()) -> List[sqlite3.Row]:
+        self.descarregar()
+        with self._lock:
+            return self.conexao().execute(sql, params).fetchall()
+
+_log = _LogEventos(EVENTOS_DB)
+
+def descarregarEventos():
+    """Grava imediatamente os eventos pendentes (chamado também na saída do processo)."""
+    try:
+        _log.descarregar()
+    except Exception as e:
+        logger.warning("⚠️ Falha gravando o log de eventos: %s", e)
+
+atexit.register(descarregarEventos)
+
+_RE_RELATORIO = re.compile(r"relatorio_(\d{4}-\d{2}-\d{2})\.txt(?:\.tmp)?$")
+
 def limparRelatoriosAntigos():
-    agora = datetime.now()
+    """Remove os relatórios .txt mais antigos que DIAS_RETENCAO_RELATORIOS (pela data do nome)."""
+    corte = (datetime.now() - timedelta(days=DIAS_RETENCAO_RELATORIOS)).strftime("%Y-%m-%d")
     for arquivo in os.listdir(relatorioDir):
-        caminho = os.path.join(relatorioDir, arquivo)
-        if os.path.isfile(caminho):
-            modificacao = datetime.fromtimestamp(os.path.getmtime(caminho))
-            if (agora - modificacao).days > 7:
-                os.remove(caminho)
+        m = _RE_RELATORIO.match(arquivo)
+        if m and m.group(1) < corte:
+            try:
+                os.remove(os.path.join(relatorioDir, arquivo))
+            except OSError:
+                pass
+
+def _arquivo_relatorio_do_dia(dia: str) -> str:
+    return os.path.join(relatorioDir, f"relatorio_{dia}.txt")
 
 def obterArquivoRelatorio():
     dataHoje = datetime.now().strftime("%Y-%m-%d")
-    return os.path.join(relatorioDir, f"relatorio_{dataHoje}.txt")
+    return _arquivo_relatorio_do_dia(dataHoje)
 
-def escreverRelatorio(texto):
-    arquivoRelatorio = obterArquivoRelatorio()
-    try:
-        with open(arquivoRelatorio, "a", encoding="utf-8") as f:
-            f.write(texto + "\n")
-    except PermissionError:
-        with open(arquivoRelatorio + ".tmp", "a", encoding="utf-8") as f:
-            f.write(texto + "\n")
+# =========================
+# ÍNDICE DE NFs DO RELATÓRIO DO DIA
+# =========================
+# Conjunto em memória das NFs já citadas no relatório de hoje. É carregado do log
+# uma vez e depois só busca os eventos novos (id maior que o último lido), o que
+# inclui os gravados por outro processo.
+_indice_lock = threading.Lock()
+_indice = {"dia": None, "ultimo_id": 0, "nfs": set()}
+
+def _nfs_da_linha(linha):
+    """Número da NF citada na linha (o que vem logo depois de 'NF'), ou None."""
+    if "NF" not in linha:
+        return None
+    partes = linha.split("NF")[1].split()
+    return partes[0].strip() if partes else None
+
+def _sincronizar_indice():
+    """Lê só os eventos novos do dia (chamar com _indice_lock)."""
+    dia = datetime.now().strftime("%Y-%m-%d")
+    if _indice["dia"] != dia:
+        # virou o dia: recomeça o conjunto
+        _indice.update(dia=dia, ultimo_id=0, nfs=set())
+    with _log._lock:
+        rows = _log.conexao().execute(
+            "SELECT id, nf FROM eventos WHERE id > ? AND dia = ? AND nf IS NOT NULL",
+            (_indice["ultimo_id"], dia),
+        ).fetchall()
+    for id_evento, nf in rows:
+        _indice["nfs"].add(nf)
+        _indice["ultimo_id"] = max(_indice["ultimo_id"], id_evento)
+
+def nfJaRelatada(nf) -> bool:
+    """True se a NF já aparece no relatório de hoje (consulta O(1) no índice em memória)."""
+    with _indice_lock:
+        _sincronizar_indice()
+        return str(nf) in _indice["nfs"]
+
+def escreverRelatorio(texto, tipo="info", nf=None, cnpj=None, conta=None):
+    """
+    Registra uma linha no log de eventos (gravada em lote pela thread do log).
+    `tipo`, `nf` e `cnpj` permitem consultas sem varrer texto; linhas sem tipo
+    usam a NF citada no texto, como o relatório antigo.
+    """
+    agora = datetime.now()
+    nf = str(nf) if nf else (_nfs_da_linha(texto) if tipo == "info" else None)
+    _log.enfileirar({
+        "ts": agora.timestamp(),
+        "dia": agora.strftime("%Y-%m-%d"),
+        "tipo": tipo,
+        "nf": nf,
+        "cnpj": re.sub(r"\D", "", cnpj) if cnpj else None,
+        "conta": conta,
+        "texto": texto,
+    })
+    if nf:
+        with _indice_lock:
+            if _indice["dia"] == agora.strftime("%Y-%m-%d"):
+                _indice["nfs"].add(nf)
+
+def consultarEventos(tipos=None, nf=None, cnpj=None, desde=None, ate=None) -> List[Dict[str, Any]]:
+    """
+    Consulta o log pelos índices. `tipos` é um tipo ou uma lista; `desde`/`ate`
+    são dias (date ou 'YYYY-MM-DD', inclusivos). Ex.: NFs ignoradas na semana:
+        consultarEventos(tipos=["ignorada_vista", "ignorada_destinatario"], desde=date.today() - timedelta(days=7))
+    """
+    filtros, params = [], []
+    if tipos:
+        tipos = [tipos] if isinstance(tipos, str) else list(tipos)
+        filtros.append(f"tipo IN ({','.join('?' * len(tipos))})")
+        params.extend(tipos)
+    if nf:
+        filtros.append("nf = ?")
+        params.append(str(nf))
+    if cnpj:
+        filtros.append("cnpj = ?")
+        params.append(re.sub(r"\D", "", cnpj))
+    if desde:
+        filtros.append("dia >= ?")
+        params.append(str(desde))
+    if ate:
+        filtros.append("dia <= ?")
+        params.append(str(ate))
+    where = f"WHERE {' AND '.join(filtros)}" if filtros else ""
+    rows = _log.consultar(f"SELECT id, ts, dia, tipo, nf, cnpj, conta, texto FROM eventos {where} ORDER BY id", params)
+    colunas = ("id", "ts", "dia", "tipo", "nf", "cnpj", "conta", "texto")
+    return [dict(zip(colunas, r)) for r in rows]
+
+def renderizarRelatorio(dia) -> str:
+    """Regera do zero o relatorio_YYYY-MM-DD.txt do dia a partir do log. Retorna o caminho."""
+    dia = str(dia)
+    eventos = consultarEventos(desde=dia, ate=dia)
+    caminho = _arquivo_relatorio_do_dia(dia)
+    with _log._lock:
+        conn = _log.conexao()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            with open(caminho, "w", encoding="utf-8") as f:
+                f.write("".join(e["texto"] + "\n" for e in eventos))
+            if eventos:
+                conn.execute(
+                    "INSERT INTO relatorios_renderizados (dia, ate_id) VALUES (?, ?) "
+                    "ON CONFLICT(dia) DO UPDATE SET ate_id = excluded.ate_id",
+                    (dia, eventos[-1]["id"]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return caminho
 
 def registrarEvento(tipo, fornecedor, conta):
     if fornecedor.strip() in ["-", ""]:
@@ -53,21 +329,9 @@ def registrarEvento(tipo, fornecedor, conta):
 
 def consolidarRelatorioTMP():
     """
-    Lê o relatório atual e retorna um conjunto de NFs já registradas.
+    Retorna o conjunto de NFs já registradas no relatório atual.
+    Para checar uma NF só, prefira nfJaRelatada().
     """
-    relatorio_path = Path(relatorioDir) / f"relatorio_{datetime.now():%Y-%m-%d}.txt"
-
-    if not relatorio_path.exists():
-        return set()  # se não existe, ainda não há nada registrado
-
-    nfs_existentes = set()
-    with open(relatorio_path, "r", encoding="utf-8") as f:
-        for linha in f:
-            if "NF" in linha:
-                # extrai o número da NF (qualquer sequência numérica após 'NF')
-                partes = linha.split("NF")
-                if len(partes) > 1:
-                    nf_num = partes[1].split()[0]  # pega o que vem logo depois
-                    nfs_existentes.add(nf_num.strip())
-
-    return nfs_existentes
+    with _indice_lock:
+        _sincronizar_indice()
+        return set(_indice["nfs"])
@@ -0,0 +1,62 @@
+# roteamento.py
+"""
+Escolha da planilha de destino e montagem das parcelas de cada NF-e.
+Compartilhado pelo ciclo do Gmail (main.py) e pela importação offline (importar_lote.py).
+"""
+import logging
+from typing import Any, Dict, List
+
+from config import PLANILHAS, CNPJ_MVA, CNPJ_EH
+
+logger = logging.getLogger("bot.roteamento")
+
+def escolher_planilha_por_cnpj_e_ano(cnpj: str, ano: str):
+    if cnpj == CNPJ_MVA:
+        return PLANILHAS["MVA"].get(ano)
+    if cnpj == CNPJ_EH:
+        return PLANILHAS["EH"].get(ano)
+    return None
+
+def planejar_parcelas(dados_xml: Dict[str, Any], planilha_id: str, boletos: List[str], plano) -> List[int]:
+    """
+    Planeja uma linha por parcela da NF no `plano` (PlanoEscrita), associando os boletos
+    em ordem. Retorna os nºs das linhas no plano para conferência após a gravação.
+    """
+    cnpj_emit = dados_xml.get("cnpjEmitente") or ""
+    parcelas = dados_xml.get("parcelas", [])
+    n_parcelas = len(parcelas)
+    n_boletos = len(boletos)
+
+    # monta lista de boletos por parcela (mesmo tamanho de parcelas)
+    if n_boletos == 0:
+        boletos_map = [None] * n_parcelas
+    else:
+        # Se tiver igual, mapeia 1:1; se menor, preenche em ordem; se maior, usa só os primeiros N
+        boletos_map = [boletos[i] if i < n_boletos else None for i in range(n_parcelas)]
+        if n_boletos > n_parcelas:
+            logger.info("⚠️ Mais boletos (%d) que parcelas (%d). Sobraram: %s", n_boletos, n_parcelas, boletos[n_parcelas:])
+
+    # Agora processa 1 vez por parcela, usando o boleto mapeado (ou None)
+    linhas_planejadas = []
+    for idx, parcela in enumerate(parcelas):
+        num_boleto = boletos_map[idx]
+        dados_parcela = dados_xml.copy()
+        dados_parcela.update({
+            "vencimento": parcela["vencimento"],
+            "numParcela": parcela["numParcela"],
+            "valorParcela": parcela["valor"],
+            "boleto": num_boleto  # adiciona campo explícito (opcional)
+        })
+
+        # Ajusta descrição com o boleto mapeado (se houver)
+        if num_boleto:
+            dados_parcela["descricao"] = f"{dados_parcela['destinatario']} BLT {num_boleto} (Bot)"
+        else:
+            if "18471209000107" in cnpj_emit.upper():
+                dados_parcela["descricao"] = f"{dados_parcela['destinatario']} DEP BR (Bot)"
+            else:
+                dados_parcela["descricao"] = f"{dados_parcela['destinatario']} DEP CX (Bot)"
+
+        # Planeja a linha; a gravação acontece em lote no plano.executar()
+        linhas_planejadas.append(plano.adicionar(planilha_id, dados_parcela))
+    return linhas_planejadas
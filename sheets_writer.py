@@ -1,9 +1,20 @@
 import gspread
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import locale, os
 import time
+import re
+import random
+import threading
+from typing import Dict, Tuple, Optional, List, Any
 from googleapiclient.errors import HttpError
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+from config import GOOGLE_CREDENTIALS_SHEETS, SHEETS_REQ_POR_MINUTO
+from rate_limit import PoliticaRetry, status_http
+from datas import parse_data
+from metricas import metricas
+from reporter import escreverRelatorio
 
 # Garante que os meses saiam em português (ex: Fev/2025)
 os.environ["LANG"] = "pt_BR.UTF-8"
@@ -14,49 +25,208 @@ except locale.Error:
 
 logger = logging.getLogger("bot.sheets_writer")
 
-def apiCooldown():
-    logger.warning("⏳ Limite da API atingido, aguardando 30 segundos...")
-    time.sleep(30)
+SCOPES_SHEETS = ["https://www.googleapis.com/auth/spreadsheets"]
+# Renova o token de acesso quando faltar menos que isso (segundos) para expirar
+MARGEM_RENOVACAO_TOKEN = 300
+# Validade (segundos) do índice de duplicados de cada aba
+TTL_INDICE_ABA = 900
 
-def _parse_date_any(date_str):
-    """Tenta vários formatos e retorna datetime ou None."""
-    if not date_str:
-        return None
-    formats = (
-        "%d/%m/%Y",
-        "%Y-%m-%d",
-        "%Y-%m-%dT%H:%M:%S%z",
-        "%Y-%m-%dT%H:%M:%S",
-        "%d-%m-%Y",
-        "%d.%m.%Y"
-    )
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_str, fmt)
-        except Exception:
-            continue
-    # tentativa final com fromisoformat (aceita Z -> +00:00)
-    try:
-        return datetime.fromisoformat(date_str.replace("Z", "+00:00"))
-    except Exception:
+CABECALHO_ABA = [
+    "Vencimento", "Descrição", "NF", "Valor Total", "Qtd Parcelas",
+    "Parcela", "Valor Parcela", "Valor Pago", "Status"
+]
+
+# Retry/backoff e orçamento por minuto de todas as chamadas ao Sheets
+politica_sheets = PoliticaRetry("Sheets", requisicoes_por_minuto=SHEETS_REQ_POR_MINUTO)
+# Append não é idempotente: um 5xx pode chegar depois de as linhas já terem sido gravadas.
+# Só o 429 (recusado antes de gravar) é repetido na hora; o resto volta no próximo ciclo,
+# depois de a aba ser relida para o índice de duplicados.
+STATUS_RETENTAVEIS_APPEND = (429,)
+
+def _chave_linha(linha) -> Optional[Tuple[str, str, str, str]]:
+    """Chave de duplicidade de uma linha: (Vencimento, Descrição, NF, Parcela)."""
+    if len(linha) < 6:
         return None
+    return (linha[0], linha[1], linha[2], linha[5])
 
-def atualizarPlanilha(planilha, dados):
+class IndiceAba:
     """
-    Atualiza a planilha Google Sheets com os dados extraídos do XML.
-    Cria automaticamente a aba do mês/ano caso não exista.
-    Aceita datas em vários formatos; usa DD/MM/YYYY internamente.
+    Índice em memória das chaves de duplicidade de uma aba, montado com uma única
+    leitura. É atualizado localmente a cada append e refeito quando expira o TTL
+    ou quando um append cai numa linha diferente da esperada (a aba mudou por fora).
+    """
+
+    def __init__(self, linhas: List[List[str]]):
+        self.chaves = {c for c in map(_chave_linha, linhas) if c}
+        self.n_linhas = len(linhas)
+        self.criado_em = time.monotonic()
+        self.valido = True
+
+    def expirado(self) -> bool:
+        return not self.valido or time.monotonic() - self.criado_em > TTL_INDICE_ABA
+
+    def __contains__(self, chave) -> bool:
+        return chave in self.chaves
+
+    def registrar_append(self, chaves, resposta: Optional[Dict[str, Any]]):
+        """Inclui as chaves gravadas e confere, pelo updatedRange da resposta, se a aba mudou por fora."""
+        self.chaves.update(chaves)
+        esperado = self.n_linhas + 1
+        self.n_linhas += len(chaves)
+        intervalo = ((resposta or {}).get("updates") or {}).get("updatedRange", "")
+        m = re.search(r"![A-Z]+(\d+)", intervalo)
+        if m and int(m.group(1)) != esperado:
+            logger.debug("Aba alterada por fora (linha %s, esperada %d); índice será refeito.", m.group(1), esperado)
+            self.valido = False
+
+class SheetsSession:
     """
+    Sessão única com o Google Sheets: autoriza o gspread uma vez (a sessão HTTP
+    mantém as conexões keep-alive), guarda Spreadsheet e Worksheet por id/título
+    e renova o token antes de expirar, em vez de reautorizar a cada parcela.
+    Os metadados (lista de abas) de cada planilha são buscados uma única vez;
+    localizar a aba de uma linha não faz chamada à API.
+    """
+
+    def __init__(self, cred_file: str = GOOGLE_CREDENTIALS_SHEETS):
+        self.cred_file = cred_file
+        self._lock = threading.RLock()
+        self._creds = None
+        self._client: Optional[gspread.Client] = None
+        self._planilhas: Dict[str, gspread.Spreadsheet] = {}
+        # planilha_id -> {título: Worksheet}, a partir dos metadados da planilha
+        self._abas: Dict[str, Dict[str, gspread.Worksheet]] = {}
+        self._indices: Dict[Tuple[str, str], IndiceAba] = {}
+
+    def _garantir_token(self):
+        if self._client is None:
+            self._creds = Credentials.from_service_account_file(self.cred_file, scopes=SCOPES_SHEETS)
+            self._client = gspread.authorize(self._creds)
+        expiry = self._creds.expiry  # UTC sem fuso (padrão do google-auth)
+        agora = datetime.now(timezone.utc).replace(tzinfo=None)
+        if not self._creds.valid or expiry is None or expiry - agora < timedelta(seconds=MARGEM_RENOVACAO_TOKEN):
+            self._creds.refresh(Request())
+            logger.debug("Token do Sheets renovado (expira em %s).", self._creds.expiry)
+
+    @property
+    def client(self) -> gspread.Client:
+        with self._lock:
+            self._garantir_token()
+            return self._client
+
+    def planilha(self, planilha_id: str) -> gspread.Spreadsheet:
+        with self._lock:
+            self._garantir_token()
+            if planilha_id not in self._planilhas:
+                self._planilhas[planilha_id] = politica_sheets.executar(self._client.open_by_key, planilha_id)
+            return self._planilhas[planilha_id]
 
+    def abas(self, planilha_id: str) -> Dict[str, gspread.Worksheet]:
+        """Abas da planilha por título (metadados buscados uma vez e mantidos em cache)."""
+        with self._lock:
+            if planilha_id not in self._abas:
+                planilha = self.planilha(planilha_id)
+                self._abas[planilha_id] = {ws.title: ws for ws in politica_sheets.executar(planilha.worksheets)}
+            return self._abas[planilha_id]
+
+    def aba(self, planilha_id: str, titulo: str) -> gspread.Worksheet:
+        """Retorna a aba pelo título (lança WorksheetNotFound se não existir)."""
+        with self._lock:
+            aba = self.abas(planilha_id).get(titulo)
+            if aba is None:
+                raise gspread.exceptions.WorksheetNotFound(titulo)
+            return aba
+
+    def registrar_aba(self, planilha_id: str, aba: gspread.Worksheet):
+        with self._lock:
+            self.abas(planilha_id)[aba.title] = aba
+
+    def esquecer_aba(self, planilha_id: str, titulo: str):
+        """
+        Descarta a aba e os metadados da planilha (ex.: aba apagada ou renomeada);
+        o próximo acesso relê a lista de abas.
+        """
+        with self._lock:
+            self._abas.pop(planilha_id, None)
+            self._indices.pop((planilha_id, titulo), None)
+
+    def garantir_abas(self, planilha_id: str, titulos) -> Dict[str, gspread.Worksheet]:
+        """
+        Cria, num único batch_update, todas as abas de `titulos` que ainda não existem,
+        já com a linha de cabeçalho. Retorna {título: Worksheet} das abas pedidas.
+        """
+        with self._lock:
+            existentes = self.abas(planilha_id)
+            faltando = [t for t in dict.fromkeys(titulos) if t not in existentes]
+            if faltando:
+                planilha = self.planilha(planilha_id)
+                ids_usados = {ws.id for ws in existentes.values()}
+                requests = []
+                for titulo in faltando:
+                    sheet_id = random.randint(1, 2**31 - 1)
+                    while sheet_id in ids_usados:
+                        sheet_id = random.randint(1, 2**31 - 1)
+                    ids_usados.add(sheet_id)
+                    requests.append({"addSheet": {"properties": {
+                        "sheetId": sheet_id,
+                        "title": titulo,
+                        "gridProperties": {"rowCount": 100, "columnCount": len(CABECALHO_ABA)},
+                    }}})
+                    requests.append({"appendCells": {
+                        "sheetId": sheet_id,
+                        "rows": [{"values": [{"userEnteredValue": {"stringValue": h}} for h in CABECALHO_ABA]}],
+                        "fields": "userEnteredValue",
+                    }})
+                logger.warning(f"🆕 Criando novas abas: {', '.join(faltando)}")
+                resposta = politica_sheets.executar(planilha.batch_update, {"requests": requests})
+                for reply in resposta.get("replies", []):
+                    props = (reply.get("addSheet") or {}).get("properties")
+                    if props:
+                        aba = gspread.Worksheet(planilha, props, planilha.id, planilha.client)
+                        existentes[aba.title] = aba
+                        # aba nova: o índice de duplicados é só o cabeçalho, sem precisar ler
+                        self._indices[(planilha_id, aba.title)] = IndiceAba([CABECALHO_ABA])
+            return {t: existentes[t] for t in titulos if t in existentes}
+
+    def indice(self, planilha_id: str, aba: gspread.Worksheet) -> IndiceAba:
+        """Índice de duplicados da aba; só lê a aba inteira quando não existe ou expirou."""
+        with self._lock:
+            chave = (planilha_id, aba.title)
+            indice = self._indices.get(chave)
+            if indice is None or indice.expirado():
+                indice = IndiceAba(_ler_linhas(aba))
+                self._indices[chave] = indice
+            return indice
+
+_sessao: Optional[SheetsSession] = None
+_sessao_lock = threading.Lock()
+
+def obterSessaoSheets() -> SheetsSession:
+    """Sessão do Sheets compartilhada por todo o processo."""
+    global _sessao
+    with _sessao_lock:
+        if _sessao is None:
+            _sessao = SheetsSession()
+        return _sessao
+
+def _ler_linhas(aba) -> List[List[str]]:
+    """Lê todas as linhas da aba (com retry por API limit)."""
+    return politica_sheets.executar(aba.get_all_values)
+
+def _preparar_linha(planilha, dados) -> Optional[Dict[str, Any]]:
+    """
+    Monta a linha da parcela: aba de destino, chave de duplicidade e valores.
+    Retorna None (com aviso no log) se a data de vencimento faltar ou for inválida.
+    """
     vencimento_raw = dados.get("vencimento")
     if not vencimento_raw:
         logger.warning("⚠️ XML sem data de vencimento — ignorado.")
-        return
+        return None
 
-    dataVenc = _parse_date_any(vencimento_raw)
+    dataVenc = parse_data(vencimento_raw)
     if not dataVenc:
         logger.warning(f"⚠️ Data inválida no XML: {vencimento_raw}")
-        return
+        return None
 
     # padroniza para DD/MM/YYYY
     venc_str = dataVenc.strftime("%d/%m/%Y")
@@ -71,70 +241,218 @@ def atualizarPlanilha(planilha, dados):
         if "(BOT)" not in descricao.upper():
             descricao = f"{descricao} (Bot)"
 
-    # Tenta acessar a aba, se não existir cria
+    return {
+        "aba": nomeAba,
+        "venc_str": venc_str,
+        # Evita duplicados — compara Vencimento + NF + Parcela + Descrição
+        "chave": (venc_str, descricao, str(dados.get("nf", "")), dados.get("numParcela", "1ª Parcela")),
+        # Nova linha com todos os campos
+        "valores": [
+            venc_str,
+            descricao,
+            dados.get("nf", ""),
+            f"R$ {float(dados.get('valorTotal', 0)):.2f}",
+            dados.get("qtdParcelas", 1),
+            dados.get("numParcela", "1ª Parcela"),
+            f"R$ {float(dados.get('valorParcela', 0)):.2f}",
+            "",
+            ""
+        ],
+    }
+
+def _obter_ou_criar_aba(planilha, nomeAba, sessao: Optional[SheetsSession] = None):
+    """Tenta acessar a aba, se não existir cria (com o cabeçalho)."""
     try:
-        aba = planilha.worksheet(nomeAba)
+        return sessao.aba(planilha.id, nomeAba) if sessao else planilha.worksheet(nomeAba)
     except gspread.exceptions.WorksheetNotFound:
         logger.warning(f"🆕 Criando nova aba: {nomeAba}")
-        aba = planilha.add_worksheet(title=nomeAba, rows="100", cols="9")
-        aba.append_row([
-            "Vencimento", "Descrição", "NF", "Valor Total", "Qtd Parcelas",
-            "Parcela", "Valor Parcela", "Valor Pago", "Status"
-        ])
-
-    # Tenta obter todas as linhas (com retry por API limit)
-    for _ in range(3):
-        try:
-            linhas = aba.get_all_values()
-            break
-        except gspread.exceptions.APIError as e:
-            if "429" in str(e):
-                apiCooldown()
-                continue
-            else:
-                raise e
-
-    # Evita duplicados — compara Vencimento + NF + Parcela + Descrição
-    duplicado = any(
-        len(linha) >= 6 and
-        linha[0] == venc_str and
-        linha[2] == str(dados.get("nf", "")) and
-        linha[5] == dados.get("numParcela", "1ª Parcela") and
-        linha[1] == descricao
-        for linha in linhas
-    )
+        aba = politica_sheets.executar(planilha.add_worksheet, title=nomeAba, rows="100", cols="9")
+        politica_sheets.executar(aba.append_row, CABECALHO_ABA, status_retentaveis=STATUS_RETENTAVEIS_APPEND)
+        if sessao:
+            sessao.registrar_aba(planilha.id, aba)
+        return aba
+
+def atualizarPlanilha(planilha, dados, sessao: Optional[SheetsSession] = None):
+    """
+    Atualiza a planilha Google Sheets com os dados extraídos do XML.
+    Cria automaticamente a aba do mês/ano caso não exista.
+    Aceita datas em vários formatos; usa DD/MM/YYYY internamente.
+    Com `sessao`, a aba vem do cache da SheetsSession em vez de ser buscada a cada chamada.
+    Para gravar várias parcelas de uma vez, use PlanoEscrita.
+    """
+    linha = _preparar_linha(planilha, dados)
+    if not linha:
+        return
+    nomeAba, chave = linha["aba"], linha["chave"]
+
+    aba = _obter_ou_criar_aba(planilha, nomeAba, sessao)
+
+    try:
+        if sessao:
+            # índice em memória da aba: O(1) e sem chamada à API na maioria das vezes
+            indice = sessao.indice(planilha.id, aba)
+            duplicado = chave in indice
+        else:
+            indice = None
+            duplicado = any(_chave_linha(l) == chave for l in _ler_linhas(aba))
+    except gspread.exceptions.APIError:
+        if sessao:
+            sessao.esquecer_aba(planilha.id, nomeAba)
+        raise
 
     if duplicado:
         # reduz "spam" no log: usar INFO aqui; se preferir WARNING, troque.
-        logger.warning(f"⚠️ NF {dados.get('nf')} ({venc_str}) já existe em {nomeAba}.")
+        logger.warning(f"⚠️ NF {dados.get('nf')} ({linha['venc_str']}) já existe em {nomeAba}.")
         return
 
-    # Nova linha com todos os campos
-    novaLinha = [
-        venc_str,
-        descricao,
-        dados.get("nf", ""),
-        f"R$ {float(dados.get('valorTotal', 0)):.2f}",
-        dados.get("qtdParcelas", 1),
-        dados.get("numParcela", "1ª Parcela"),
-        f"R$ {float(dados.get('valorParcela', 0)):.2f}",
-        "",
-        ""
-    ]
-
-    # Insere no Google Sheets (retry simples)
-    for _ in range(3):
-        try:
-            aba.append_row(novaLinha, value_input_option="USER_ENTERED")
+    # Insere no Google Sheets (retry com backoff da política compartilhada, só em 429)
+    try:
+        resposta = politica_sheets.executar(aba.append_row, linha["valores"], value_input_option="USER_ENTERED",
+                                            status_retentaveis=STATUS_RETENTAVEIS_APPEND)
+    except gspread.exceptions.APIError:
+        if sessao:
+            sessao.esquecer_aba(planilha.id, nomeAba)
+        raise
+    if indice is not None:
+        indice.registrar_append([chave], resposta)
+
+    logger.info(f"✅ NF {dados.get('nf')} registrada em '{planilha.title}' / aba '{nomeAba}'")
+
+# =========================
+# PLANO DE ESCRITA (lote por aba)
+# =========================
 
-            nome_planilha = planilha.title
-            nome_aba = nomeAba
+# Situação final de cada linha planejada
+GRAVADA = "gravada"
+DUPLICADA = "duplicada"
+IGNORADA = "ignorada"
+ERRO = "erro"
 
-            logger.info(f"✅ NF {dados.get('nf')} registrada em '{nome_planilha}' / aba '{nome_aba}'")
-            break
-        except gspread.exceptions.APIError as e:
-            if "429" in str(e):
-                apiCooldown()
+class ResultadoLinha:
+    def __init__(self, status: str, planilha_id: str = "", aba: str = "", erro: Optional[Exception] = None):
+        self.status = status
+        self.planilha_id = planilha_id
+        self.aba = aba
+        self.erro = erro
+
+    @property
+    def ok(self) -> bool:
+        """Linha tratada: gravada agora, já existente ou descartada por dado inválido."""
+        return self.status != ERRO
+
+    def __repr__(self):
+        return f"ResultadoLinha({self.status!r}, aba={self.aba!r})"
+
+class PlanoEscrita:
+    """
+    Coleta as linhas de todas as parcelas do ciclo e grava agrupando por
+    planilha e aba do mês: uma única chamada append_rows por aba, em vez de
+    um append_row por parcela. Cada linha recebe seu próprio ResultadoLinha.
+    """
+
+    def __init__(self, sessao: Optional[SheetsSession] = None):
+        self.sessao = sessao or obterSessaoSheets()
+        self._itens: List[Tuple[str, Dict[str, Any]]] = []
+
+    def __len__(self):
+        return len(self._itens)
+
+    def adicionar(self, planilha_id: str, dados: Dict[str, Any]) -> int:
+        """Planeja a gravação da parcela; retorna o número da linha no plano."""
+        self._itens.append((planilha_id, dados))
+        return len(self._itens) - 1
+
+    def executar(self) -> Dict[int, ResultadoLinha]:
+        resultados: Dict[int, ResultadoLinha] = {}
+        # (planilha_id, aba) -> [(nº no plano, dados, linha preparada)] — mantém a ordem de chegada
+        grupos: Dict[Tuple[str, str], List[Tuple[int, Dict[str, Any], Dict[str, Any]]]] = {}
+
+        for n, (planilha_id, dados) in enumerate(self._itens):
+            try:
+                planilha = self.sessao.planilha(planilha_id)
+                linha = _preparar_linha(planilha, dados)
+            except Exception as e:
+                logger.exception("Falha ao abrir planilha %s: %s", planilha_id, e)
+                resultados[n] = ResultadoLinha(ERRO, planilha_id, erro=e)
                 continue
+            if not linha:
+                resultados[n] = ResultadoLinha(IGNORADA, planilha_id)
+                continue
+            grupos.setdefault((planilha_id, linha["aba"]), []).append((n, dados, linha))
+
+        # Abas que faltam são criadas antes, numa única chamada por planilha
+        abas_por_planilha: Dict[str, List[str]] = {}
+        for planilha_id, nomeAba in grupos:
+            abas_por_planilha.setdefault(planilha_id, []).append(nomeAba)
+        for planilha_id, titulos in abas_por_planilha.items():
+            try:
+                self.sessao.garantir_abas(planilha_id, titulos)
+            except Exception as e:
+                logger.exception("Falha ao criar abas %s: %s", titulos, e)
+
+        for (planilha_id, nomeAba), itens in grupos.items():
+            resultados.update(self._gravar_grupo(planilha_id, nomeAba, itens))
+
+        for n, r in resultados.items():
+            metricas.contar("botana_sheets_linhas_total", situacao=r.status)
+            if r.status == ERRO:
+                _relatar_erro_gravacao(self._itens[n][1], r)
+        self._itens = []
+        return resultados
+
+    def _gravar_grupo(self, planilha_id, nomeAba, itens) -> Dict[int, ResultadoLinha]:
+        resultados: Dict[int, ResultadoLinha] = {}
+        planilha = self.sessao.planilha(planilha_id)
+        try:
+            aba = _obter_ou_criar_aba(planilha, nomeAba, self.sessao)
+            indice = self.sessao.indice(planilha_id, aba)
+        except Exception as e:
+            logger.exception("Falha ao preparar aba %s: %s", nomeAba, e)
+            self.sessao.esquecer_aba(planilha_id, nomeAba)
+            return {n: ResultadoLinha(ERRO, planilha_id, nomeAba, e) for n, _, _ in itens}
+
+        novas = []
+        chaves_novas = set()
+        for n, dados, linha in itens:
+            if linha["chave"] in indice or linha["chave"] in chaves_novas:
+                logger.warning(f"⚠️ NF {dados.get('nf')} ({linha['venc_str']}) já existe em {nomeAba}.")
+                resultados[n] = ResultadoLinha(DUPLICADA, planilha_id, nomeAba)
+                continue
+            chaves_novas.add(linha["chave"])
+            novas.append((n, dados, linha))
+
+        if not novas:
+            return resultados
+
+        # Insere no Google Sheets (retry com backoff da política compartilhada, só em 429)
+        erro: Optional[Exception] = None
+        try:
+            resposta = politica_sheets.executar(
+                aba.append_rows, [l["valores"] for _, _, l in novas], value_input_option="USER_ENTERED",
+                status_retentaveis=STATUS_RETENTAVEIS_APPEND,
+            )
+            indice.registrar_append([l["chave"] for _, _, l in novas], resposta)
+        except Exception as e:
+            erro = e
+            # Fora o 429, as linhas podem ter sido gravadas: a aba é relida antes da próxima tentativa
+            if status_http(e) != 429:
+                self.sessao.esquecer_aba(planilha_id, nomeAba)
+
+        for n, dados, _ in novas:
+            if erro is None:
+                logger.info(f"✅ NF {dados.get('nf')} registrada em '{planilha.title}' / aba '{nomeAba}'")
+                resultados[n] = ResultadoLinha(GRAVADA, planilha_id, nomeAba)
             else:
-                raise e  
+                resultados[n] = ResultadoLinha(ERRO, planilha_id, nomeAba, erro)
+        if erro is not None:
+            logger.error("❌ Falha ao gravar %d linhas em '%s' / aba '%s': %s", len(novas), planilha.title, nomeAba, erro)
+        return resultados
+
+def _relatar_erro_gravacao(dados: Dict[str, Any], resultado: ResultadoLinha):
+    """Evento no relatório para a parcela que não foi gravada (será tentada de novo no próximo ciclo)."""
+    destino = f"{resultado.planilha_id} / aba '{resultado.aba}'" if resultado.aba else resultado.planilha_id
+    escreverRelatorio(
+        f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - ❌ NF {dados.get('nf')} "
+        f"({dados.get('numParcela', '1ª Parcela')}) não gravada em {destino}: {resultado.erro}",
+        tipo="erro_gravacao", nf=dados.get("nf"), cnpj=dados.get("cnpjEmitente"),
+    )
@@ -0,0 +1,226 @@
+# tests/test_ciclo.py
+"""
+Regressões do ciclo completo (main.processar_emails_enviados) sobre o Gmail e o
+Sheets falsos do bench/: uma falha no meio de um ciclo não pode perder NFs — o
+ciclo seguinte tem de retomá-las, sem duplicar linhas.
+
+Uso (na raiz do projeto):
+    python -m unittest discover -s tests -t .
+"""
+import shutil
+import logging
+import tempfile
+import unittest
+from collections import Counter
+
+from bench.executar import _preparar_ambiente, _isolar_estado, CNPJ_MVA_BENCH, PLANILHA_BENCH, ABA_MODELO_BENCH
+
+_preparar_ambiente(1)
+
+import main
+import ledger
+import reporter
+import gmail_service
+import sheets_writer
+from metricas import metricas
+from bench.fakes import GmailFalso, SheetsFalso, ClienteSheetsFalso, CredenciaisSheetsFalsas
+from bench.sintetico import anexos_da_thread
+
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+    # sem esperas: backoff zerado, cotas folgadas
+    gmail_service.politica_gmail.base = sheets_writer.politica_sheets.base = 0
+    sheets_writer.politica_sheets.orcamento = None
+    gmail_service.GMAIL_QUOTA_UNIDADES_POR_SEGUNDO = 10 ** 6
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    # a pasta do último teste já foi apagada; o descarregamento na saída do processo não tem o que gravar
+    reporter._log.caminho = ":memory:"
+
+class CicloFalsoTestCase(unittest.TestCase):
+    """Uma conta do Gmail falsa e a planilha do bench, com todo o estado local numa pasta temporária."""
+
+    def setUp(self):
+        self.pasta = tempfile.mkdtemp(prefix="botana_teste_")
+        self._fechar_bancos()
+        _isolar_estado(self.pasta)
+        for cache in (ledger.cache_anexos, ledger.cache_nfes):
+            cache._memoria.clear()
+        for estado in (gmail_service._servicos, gmail_service._label_ids, gmail_service._limitadores,
+                       gmail_service._history_pendente, gmail_service._sync_incompleta):
+            estado.clear()
+        reporter._indice.update(dia=None, ultimo_id=0, nfs=set())
+        metricas.limpar()
+
+        self.gmail = GmailFalso("bench_gmail_1.json", "teste@exemplo.com.br")
+        gmail_service._servicos[main.CONTAS_GMAIL[0]] = self.gmail
+
+        self.sheets = SheetsFalso()
+        self.sheets.criar_planilha(PLANILHA_BENCH, "Contas a Receber MVA 2026",
+                                   {ABA_MODELO_BENCH: [list(sheets_writer.CABECALHO_ABA)]})
+        sessao = sheets_writer.SheetsSession("bench_sheets.json")
+        sessao._client = ClienteSheetsFalso(self.sheets)
+        sessao._creds = CredenciaisSheetsFalsas()
+        sheets_writer._sessao = sessao
+        self.proximo_numero = 1
+
+    def tearDown(self):
+        self._fechar_bancos()
+        shutil.rmtree(self.pasta, ignore_errors=True)
+
+    def _fechar_bancos(self):
+        reporter.descarregarEventos()
+        with reporter._log._lock:
+            if reporter._log._conn is not None:
+                reporter._log._conn.close()
+                reporter._log._conn = None
+        with ledger._lock:
+            if ledger._conn is not None:
+                ledger._conn.close()
+                ledger._conn = None
+
+    # ---------- apoio ----------
+    def enviar(self, threads: int, anexos: int = 1, parcelas: int = 1) -> range:
+        """Simula `threads` e-mails enviados; retorna os números das NFs criadas."""
+        inicio = self.proximo_numero
+        for _ in range(threads):
+            numero = self.proximo_numero
+            self.gmail.adicionar_thread(f"t{numero}", anexos_da_thread(numero, CNPJ_MVA_BENCH, anexos, parcelas, 1))
+            self.proximo_numero += anexos
+        return range(inicio, self.proximo_numero)
+
+    def ciclo(self, falha: bool = False) -> int:
+        if falha:
+            with self.assertRaises(RuntimeError):
+                main.processar_emails_enviados()
+            return 0
+        return main.processar_emails_enviados()
+
+    def linhas(self) -> Counter:
+        """(NF, parcela) de cada linha gravada pelo bot, com a contagem de repetições."""
+        contagem = Counter()
+        for aba in self.sheets.abas(PLANILHA_BENCH):
+            for linha in self.sheets.linhas(PLANILHA_BENCH, aba):
+                if linha != sheets_writer.CABECALHO_ABA:
+                    contagem[(int(linha[2]), linha[5])] += 1
+        return contagem
+
+    def assertNfsGravadas(self, numeros):
+        linhas = self.linhas()
+        self.assertEqual(sorted(nf for nf, _ in linhas), sorted(numeros))
+        self.assertEqual([l for l, n in linhas.items() if n > 1], [], "linhas duplicadas")
+
+class TestSincronizacao(CicloFalsoTestCase):
+
+    def test_rajada_de_mais_de_100_threads_no_modo_incremental(self):
+        primeiras = self.enviar(5)
+        self.assertEqual(self.ciclo(), 5)
+        rajada = self.enviar(150)
+        self.assertEqual(self.ciclo(), 150)
+        self.assertNfsGravadas([*primeiras, *rajada])
+        self.assertEqual(self.ciclo(), 0)
+
+    def test_busca_completa_com_mais_de_uma_pagina(self):
+        nfs = self.enviar(150)
+        self.assertEqual(self.ciclo(), 150)
+        self.assertNfsGravadas(nfs)
+
+    def test_thread_que_falhou_volta_no_ciclo_seguinte(self):
+        primeiras = self.enviar(3)
+        self.ciclo()
+        historico = gmail_service.historyIdConfirmado(self.gmail)
+        novas = self.enviar(3)
+        self.gmail.perturbacao.programar_falha("gmail.users.threads.get", 503,
+                                               vezes=gmail_service.politica_gmail.max_tentativas,
+                                               id=f"t{novas[1]}")
+        self.ciclo()
+        self.assertNotIn(novas[1], {nf for nf, _ in self.linhas()})
+        self.assertEqual(gmail_service.historyIdConfirmado(self.gmail), historico)
+
+        self.assertEqual(self.ciclo(), 1)
+        self.assertNfsGravadas([*primeiras, *novas])
+        self.assertNotEqual(gmail_service.historyIdConfirmado(self.gmail), historico)
+
+    def test_mensagem_nova_em_thread_rotulada_nao_rebaixa_as_antigas(self):
+        # thread já rotulada por uma instalação anterior: o ledger local não a conhece
+        rotulada, avulsa = self.enviar(2)
+        label_id = gmail_service.ensure_label(self.gmail)
+        self.gmail.users().messages().modify(userId="me", id=f"mt{rotulada}",
+                                             body={"addLabelIds": [label_id]}).execute()
+        self.assertEqual(self.ciclo(), 1)
+
+        nova = self.proximo_numero
+        anexos = anexos_da_thread(nova, CNPJ_MVA_BENCH, 1, 1, 1)
+        self.gmail.responder_thread(f"t{rotulada}", anexos)
+        self.proximo_numero += 1
+        downloads = self.gmail.contador.por_endpoint["gmail.users.messages.attachments.get"]
+        self.assertEqual(self.ciclo(), 1)
+        self.assertEqual(self.gmail.contador.por_endpoint["gmail.users.messages.attachments.get"] - downloads,
+                         len(anexos))
+        self.assertNfsGravadas([avulsa, nova])
+        self.assertEqual(ledger.mensagensJaProcessadas("bench_gmail_1.json", [f"mt{rotulada}"]), {f"mt{rotulada}"})
+
+class TestDownloads(CicloFalsoTestCase):
+
+    def _falhar_anexo(self, numero: int):
+        self.gmail.perturbacao.programar_falha("gmail.users.messages.attachments.get", 503,
+                                               vezes=gmail_service.politica_gmail.max_tentativas,
+                                               messageId=f"mt{numero}")
+
+    def test_anexo_que_falhou_volta_no_ciclo_seguinte(self):
+        primeiras = self.enviar(3)
+        self.ciclo()
+        novas = self.enviar(3)
+        self._falhar_anexo(novas[1])
+        self.ciclo(falha=True)
+        self.assertNotIn(novas[1], {nf for nf, _ in self.linhas()})
+
+        self.assertEqual(self.ciclo(), 1)
+        self.assertNfsGravadas([*primeiras, *novas])
+
+    def test_anexo_que_falhou_na_busca_completa_fica_sem_rotulo(self):
+        nfs = self.enviar(3)
+        self._falhar_anexo(nfs[0])
+        self.ciclo(falha=True)
+
+        self.assertEqual(self.ciclo(), 1)
+        self.assertNfsGravadas(nfs)
+
+class TestGravacao(CicloFalsoTestCase):
+
+    def test_append_que_falhou_volta_no_ciclo_seguinte(self):
+        primeiras = self.enviar(3)
+        self.ciclo()
+        novas = self.enviar(3)
+        # cota do Sheets esgotada em todas as tentativas do primeiro append do lote
+        self.sheets.perturbacao.programar_falha("spreadsheets.values.append", 429,
+                                                vezes=sheets_writer.politica_sheets.max_tentativas)
+        self.ciclo(falha=True)
+        self.assertLess(len(self.linhas()), 6)
+        self.assertEqual(len(ledger.mensagensJaProcessadas("bench_gmail_1.json", [f"mt{n}" for n in novas])),
+                         len({nf for nf, _ in self.linhas()} & set(novas)))
+
+        self.assertGreater(self.ciclo(), 0)
+        self.assertNfsGravadas([*primeiras, *novas])
+        self.assertEqual(self.ciclo(), 0)
+
+    def test_append_com_5xx_depois_de_gravar_nao_duplica(self):
+        primeiras = self.enviar(3)
+        self.ciclo()
+        novas = self.enviar(3)
+        # as linhas entram na aba, mas a resposta se perde num 502
+        self.sheets.perturbacao.programar_falha("spreadsheets.values.append", 502, depois=True)
+        self.ciclo(falha=True)
+
+        reporter.descarregarEventos()
+        erros = reporter.consultarEventos(tipos="erro_gravacao")
+        self.assertEqual(len(erros), 1)
+        self.assertIn(int(erros[0]["nf"]), novas)
+        self.assertEqual(erros[0]["cnpj"], CNPJ_MVA_BENCH)
+
+        self.ciclo()
+        self.assertNfsGravadas([*primeiras, *novas])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# tests/test_push.py
+"""
+Início do modo push (main._iniciar_push): porta ocupada ou nenhum watch aceito
+caem no polling sem derrubar o loop e sem deixar a porta aberta.
+
+Uso (na raiz do projeto):
+    python -m unittest discover -s tests -t .
+"""
+import socket
+import functools
+import logging
+import unittest
+from unittest import mock
+
+from bench.executar import _preparar_ambiente
+
+_preparar_ambiente(1)
+
+import main
+import push_gmail
+import gmail_service
+from bench.fakes import GmailFalso
+
+def _porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class TestIniciarPush(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        gmail_service._servicos[main.CONTAS_GMAIL[0]] = GmailFalso("bench_gmail_1.json", "teste@exemplo.com.br")
+        self.addCleanup(gmail_service._servicos.clear)
+        self.porta = _porta_livre()
+        patch = mock.patch.object(main, "GMAIL_PUSH_TOPICO", "projects/teste/topics/gmail")
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch.object(push_gmail, "ReceptorPush",
+                                  functools.partial(push_gmail.ReceptorPush, host="127.0.0.1", porta=self.porta))
+        patch.start()
+        self.addCleanup(patch.stop)
+        agendador = main.agendador
+        self.addCleanup(setattr, main, "agendador", agendador)
+
+    def assertPortaLivre(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", self.porta))
+
+    def test_porta_ocupada_segue_com_polling(self):
+        with socket.socket() as ocupada:
+            ocupada.bind(("127.0.0.1", self.porta))
+            ocupada.listen()
+            self.assertIsNone(main._iniciar_push())
+        self.assertPortaLivre()
+
+    def test_sem_watch_fecha_a_porta(self):
+        with mock.patch.object(push_gmail, "registrarWatch", side_effect=RuntimeError("sem permissão no tópico")):
+            self.assertIsNone(main._iniciar_push())
+        self.assertPortaLivre()
+
+    def test_push_ativo_ouve_na_porta(self):
+        push = main._iniciar_push()
+        self.assertIsNotNone(push)
+        self.addCleanup(push.parar)
+        self.assertEqual(push.receptor.porta, self.porta)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# tests/test_rate_limit.py
+"""
+TokenBucket: pedidos acima da capacidade (lotes inteiros da Gmail API) têm de
+custar o tempo de reposição completo, não só uma capacidade.
+
+Uso (na raiz do projeto):
+    python -m unittest discover -s tests -t .
+"""
+import unittest
+from unittest import mock
+
+from bench.executar import _preparar_ambiente
+
+_preparar_ambiente(1)
+
+import rate_limit
+from rate_limit import TokenBucket
+
+class RelogioFalso:
+    """Substitui time.monotonic/time.sleep: dormir só avança o relógio."""
+
+    def __init__(self):
+        self.agora = 0.0
+
+    def monotonic(self) -> float:
+        return self.agora
+
+    def sleep(self, segundos: float):
+        self.agora += segundos
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.relogio = RelogioFalso()
+        patch = mock.patch.object(rate_limit, "time", self.relogio)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_pedido_acima_da_capacidade_espera_a_reposicao_completa(self):
+        balde = TokenBucket(taxa=250)
+        # lote de 50 threads.get: 500 unidades, o dobro do balde cheio
+        self.assertTrue(balde.consumir(500))
+        self.assertAlmostEqual(self.relogio.agora, 1.0)
+        self.assertTrue(balde.consumir(250))
+        self.assertAlmostEqual(self.relogio.agora, 2.0)
+
+    def test_timeout_no_meio_de_um_pedido_grande(self):
+        balde = TokenBucket(taxa=10)
+        self.assertFalse(balde.consumir(30, timeout=1.5))
+        self.assertAlmostEqual(self.relogio.agora, 1.5)
+
+if __name__ == "__main__":
+    unittest.main()
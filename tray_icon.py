@@ -24,6 +24,10 @@ from plyer import notification
 from config import RELATORIO_DIR
 from reporter import escreverRelatorio
 from gmail_service import buscarMessagesEnviados
+from metricas import resumo_tooltip
+
+# Segundos entre as atualizações do resumo no tooltip do ícone
+INTERVALO_TOOLTIP = 15
 
 # =========================
 # ÍCONE DINÂMICO
@@ -90,7 +94,7 @@ def run_tray(on_quit_callback, start_callback=None):
             msg = f"Erro durante verificação: {e}"
             print(f"[Tray] {msg}")
             traceback.print_exc()
-            escreverRelatorio(f"[Tray] {msg}")
+            escreverRelatorio(f"[Tray] {msg}", tipo="tray")
             atualizar_cor("red")
             notificar("Botana", f"❌ {msg}")
             time.sleep(10)
@@ -117,6 +121,15 @@ def run_tray(on_quit_callback, start_callback=None):
         else:
             os.system(f"xdg-open '{caminho}'")
 
+    def atualizar_tooltip():
+        """Mantém no tooltip o resumo do último ciclo e das chamadas à API."""
+        while True:
+            try:
+                icon.title = resumo_tooltip()
+            except Exception as e:
+                print(f"[Tray] Falha ao atualizar tooltip: {e}")
+            time.sleep(INTERVALO_TOOLTIP)
+
     def sair(icon, item):
         notificar("Botana", "Encerrando o aplicativo...")
         icon.visible = False
@@ -132,6 +145,7 @@ def run_tray(on_quit_callback, start_callback=None):
 
     icon.icon = create_icon("blue")
     icon.menu = menu
+    threading.Thread(target=atualizar_tooltip, daemon=True).start()
     print("[Tray] Ícone iniciado. Clique com o botão direito para opções.")
     icon.run()
 
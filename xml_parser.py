@@ -1,60 +1,97 @@
-import xml.etree.ElementTree as ET
-import datetime, re
-from config import CNPJ_MVA, CNPJ_EH
-
-def _normalize_date_to_ddmmyyyy(date_raw):
-    """Tenta normalizar várias entradas de data para 'DD/MM/YYYY'. Retorna '' se falhar."""
-    if not date_raw:
-        return ""
-    # já no formato DD/MM/YYYY?
-    candidates = [
-        date_raw.strip(),
-        date_raw.strip().replace(".", "/"),
-        date_raw.strip().replace("-", "/")
-    ]
-    formats = ("%d/%m/%Y", "%Y-%m-%d", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M:%S", "%d-%m-%Y", "%d.%m.%Y")
-    for cand in candidates:
-        for fmt in formats:
-            try:
-                dt = datetime.datetime.strptime(cand, fmt)
-                return dt.strftime("%d/%m/%Y")
-            except Exception:
-                continue
-    # última tentativa com fromisoformat
-    try:
-        dt = datetime.datetime.fromisoformat(date_raw.replace("Z", "+00:00"))
-        return dt.strftime("%d/%m/%Y")
-    except Exception:
-        return ""
+from lxml import etree as ET
+import datetime, re, io, threading, logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Tuple, Optional, Dict, Any
+from config import CNPJ_MVA, CNPJ_EH, XML_PROCESSOS
+from datas import parse_data, data_ddmmyyyy
+from metricas import metricas
+
+logger = logging.getLogger("bot.xml_parser")
+
+# =========================
+# LEITURA DIRETA (lxml)
+# =========================
+
+NS_NFE = "{http://www.portalfiscal.inf.br/nfe}"
+
+def _t(*nomes):
+    """Caminho filho-a-filho no namespace da NF-e (sem busca em todos os descendentes)."""
+    return "/".join(NS_NFE + n for n in nomes)
+
+# Caminhos pré-montados: cada find() olha só os filhos diretos, sem percorrer os <det>
+_INFNFE_EM_PROC, _INFNFE_EM_NFE = _t("NFe", "infNFe"), _t("infNFe")
+_IDE, _EMIT, _DEST, _ICMSTOT, _COBR = _t("ide"), _t("emit"), _t("dest"), _t("total", "ICMSTot"), _t("cobr")
+_NNF, _NATOP, _DHEMI = _t("nNF"), _t("natOp"), _t("dhEmi")
+_XNOME, _CNPJ, _VNF = _t("xNome"), _t("CNPJ"), _t("vNF")
+_DUP, _FAT, _DVENC, _VDUP, _VLIQ = _t("dup"), _t("fat"), _t("dVenc"), _t("vDup"), _t("vLiq")
+
+# Um parser por thread (parsers do lxml não devem ser compartilhados entre threads)
+_parsers = threading.local()
+
+def _parser():
+    parser = getattr(_parsers, "parser", None)
+    if parser is None:
+        parser = ET.XMLParser(resolve_entities=False, no_network=True, collect_ids=False)
+        _parsers.parser = parser
+    return parser
+
+def _ler_campos(origem):
+    """
+    Faz um único parse do XML e devolve só os campos usados por extrairDadosXML.
+    Os grupos são lidos pelos caminhos fixos do leiaute (nfeProc/NFe/infNFe/...),
+    então a lista de itens (<det>) nunca é percorrida.
+    """
+    root = ET.parse(origem, _parser()).getroot()
+    if root.tag == NS_NFE + "infNFe":
+        inf_nfe = root
+    else:
+        inf_nfe = root.find(_INFNFE_EM_PROC if root.tag.endswith("nfeProc") else _INFNFE_EM_NFE)
+    if inf_nfe is None:
+        raise ValueError("XML sem o grupo <infNFe>: não parece uma NF-e")
+
+    ide, emit, dest, total = (inf_nfe.find(p) for p in (_IDE, _EMIT, _DEST, _ICMSTOT))
+    for nome, grupo in (("ide", ide), ("emit", emit), ("dest", dest), ("ICMSTot", total)):
+        if grupo is None:
+            raise ValueError(f"XML sem o grupo <{nome}>: não parece uma NF-e")
+
+    cobr = inf_nfe.find(_COBR)
+    fat = cobr.find(_FAT) if cobr is not None else None
+    return {
+        "chave": re.sub(r"\D", "", inf_nfe.get("Id", "")),
+        "ide": (ide.findtext(_NNF, default=""), ide.findtext(_NATOP, default=""), ide.findtext(_DHEMI, default="")),
+        "emit": (emit.findtext(_XNOME, default=""), emit.findtext(_CNPJ, default="")),
+        "dest": (dest.findtext(_XNOME, default=""), dest.findtext(_CNPJ, default="")),
+        "vNF": total.findtext(_VNF, default="0"),
+        "dups": [(d.findtext(_DVENC, default=""), d.findtext(_VDUP, default="0"))
+                 for d in cobr.iterfind(_DUP)] if cobr is not None else [],
+        "vLiq": fat.findtext(_VLIQ, default="0") if fat is not None else None,
+    }
 
 def extrairDadosXML(caminhoXML):
-    tree = ET.parse(caminhoXML)
-    root = tree.getroot()
-    # Corrige se for um nfeProc (envolve a NFe dentro)
-    if root.tag.endswith("nfeProc"):
-        root = root.find(".//ns:NFe", {"ns": "http://www.portalfiscal.inf.br/nfe"})
-    ns = {"ns": "http://www.portalfiscal.inf.br/nfe"}
-
-    ide = root.find(".//ns:ide", ns)
-    emit = root.find(".//ns:emit", ns)
-    dest = root.find(".//ns:dest", ns)
-    total = root.find(".//ns:ICMSTot", ns)
+    """Extrai os dados da NF-e. Aceita caminho de arquivo, bytes ou buffer binário (ex.: Anexo.abrir())."""
+    if isinstance(caminhoXML, (bytes, bytearray)):
+        caminhoXML = io.BytesIO(caminhoXML)
+    campos = _ler_campos(caminhoXML)
+    nNF, natOp, dhEmi = campos["ide"]
+    emit_nome, emit_cnpj = campos["emit"]
+    dest_nome, dest_cnpj = campos["dest"]
 
+    nat_op = natOp.strip().upper()
     dados = {
-        "nf": ide.findtext("ns:nNF", default="", namespaces=ns),
-        "emitente": emit.findtext("ns:xNome", default="", namespaces=ns),
-        "cnpjEmitente": re.sub(r"\D", "", emit.findtext("ns:CNPJ", default="", namespaces=ns) or ""),
-        "destinatario": dest.findtext("ns:xNome", default="", namespaces=ns),
-        "valorTotal": float(total.findtext("ns:vNF", default="0", namespaces=ns) or 0),
+        "nf": nNF,
+        "emitente": emit_nome,
+        "cnpjEmitente": re.sub(r"\D", "", emit_cnpj or ""),
+        "destinatario": dest_nome,
+        "valorTotal": float(campos["vNF"] or 0),
         "parcelas": [],
-        "naturezaOperacao": ide.findtext("ns:natOp", default="", namespaces=ns).strip().upper(),
+        "naturezaOperacao": nat_op,
+        # Chave de acesso (44 dígitos) — Id de infNFe sem o prefixo "NFe"
+        "chaveAcesso": campos["chave"],
     }
 
-    nat_op = ide.findtext("ns:natOp", default="", namespaces=ns).strip().upper()
-
     # Ignora se o destinatário for nossa própria empresa (pelo CNPJ)
-    cnpj_dest = dest.findtext("ns:CNPJ", default="", namespaces=ns)
-    cnpj_dest = re.sub(r"\D", "", cnpj_dest or "")  # 👈 ajuste: evita erro se None
+    cnpj_dest = re.sub(r"\D", "", dest_cnpj or "")  # 👈 ajuste: evita erro se None
 
     forma_pag = str(dados.get("formaPagamento", "")).strip()
     if ( "VISTA" in nat_op or "VENDA A VISTA" in nat_op or forma_pag in ["01", "03", "04"]):
@@ -63,15 +100,11 @@ def extrairDadosXML(caminhoXML):
     if cnpj_dest in (re.sub(r"\D", "", CNPJ_MVA), re.sub(r"\D", "", CNPJ_EH)):
         return dados
 
-    fat = root.findall(".//ns:dup", ns)
-    fat_fatura = root.find(".//ns:fat", ns)
-
-    if fat:
+    if campos["dups"]:
         # Caso normal — há duplicatas
-        for i, dup in enumerate(fat, start=1):
-            venc_raw = dup.findtext("ns:dVenc", default="", namespaces=ns)
-            venc = _normalize_date_to_ddmmyyyy(venc_raw)
-            valor = float(dup.findtext("ns:vDup", default="0", namespaces=ns) or 0)
+        for i, (venc_raw, v_dup) in enumerate(campos["dups"], start=1):
+            venc = data_ddmmyyyy(venc_raw)
+            valor = float(v_dup or 0)
             dados["parcelas"].append({
                 "numero": i,
                 "numParcela": f"{i}ª Parcela",
@@ -80,18 +113,10 @@ def extrairDadosXML(caminhoXML):
             })
     else:
         # ⚠️ Fallback: usa <fat> se não houver <dup>
-        if fat_fatura is not None:
-            valor = float(fat_fatura.findtext("ns:vLiq", default="0", namespaces=ns) or 0)
-            emissao = ide.findtext("ns:dhEmi", default="", namespaces=ns)
-            venc = ""
-            try:
-                data_emissao = datetime.datetime.fromisoformat(emissao.replace("Z", "+00:00"))
-                venc = (data_emissao + datetime.timedelta(days=30)).strftime("%d/%m/%Y")
-            except Exception:
-                # tenta normalizar emissao mesmo que não tenha Z
-                venc = _normalize_date_to_ddmmyyyy(emissao)
-                if not venc:
-                    venc = ""
+        if campos["vLiq"] is not None:
+            valor = float(campos["vLiq"] or 0)
+            data_emissao = parse_data(dhEmi)
+            venc = (data_emissao + datetime.timedelta(days=30)).strftime("%d/%m/%Y") if data_emissao else ""
             dados["parcelas"].append({
                 "numero": 1,
                 "numParcela": "1ª Parcela",
@@ -103,13 +128,8 @@ def extrairDadosXML(caminhoXML):
     dados["qtdParcelas"] = len(dados["parcelas"]) or 1
 
     # Ano de vencimento (para definir planilha) — pega o ano da primeira parcela quando possível
-    if dados["parcelas"]:
-        try:
-            ano = datetime.datetime.strptime(dados["parcelas"][0]["vencimento"], "%d/%m/%Y").year
-        except Exception:
-            ano = datetime.datetime.now().year
-    else:
-        ano = datetime.datetime.now().year
+    data_venc = parse_data(dados["parcelas"][0]["vencimento"]) if dados["parcelas"] else None
+    ano = data_venc.year if data_venc else datetime.datetime.now().year
     dados["anoVencimento"] = str(ano)
 
     # Descrição default = nome do destinatário + número da NF
@@ -127,3 +147,63 @@ def extrairDadosXML(caminhoXML):
         dados["valorParcela"] = dados["valorTotal"]
 
     return dados
+
+# =========================
+# LOTE EM VÁRIOS PROCESSOS
+# =========================
+
+# Abaixo disso subir os processos custa mais do que analisar na própria thread
+MINIMO_LOTE_PROCESSOS = 16
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def _obter_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=XML_PROCESSOS)
+        return _pool
+
+def _descartar_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _extrair_item(origem) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Versão do extrairDadosXML que devolve o erro em vez de lançar (roda nos processos do pool)."""
+    try:
+        return extrairDadosXML(origem), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def extrairDadosXMLBatch(origens, chunksize: Optional[int] = None) -> List[Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+    """
+    Extrai os dados de vários XMLs (caminhos, bytes ou buffers) distribuindo a análise
+    num pool de processos. Retorna [(dados, erro)] na mesma ordem da entrada: um XML
+    inválido vira (None, "mensagem") e não interrompe o lote.
+    """
+    # buffers abertos não atravessam processos: lê o conteúdo antes
+    itens = [o.read() if hasattr(o, "read") else o for o in origens]
+    modo = "processos" if len(itens) >= MINIMO_LOTE_PROCESSOS and XML_PROCESSOS > 1 else "thread"
+    with metricas.medir("botana_xml_lote_segundos", modo=modo):
+        resultados = _extrair_lote(itens, modo, chunksize)
+    erros = sum(1 for _, erro in resultados if erro)
+    metricas.contar("botana_xml_analisados_total", len(resultados) - erros, resultado="ok")
+    metricas.contar("botana_xml_analisados_total", erros, resultado="erro")
+    return resultados
+
+def _extrair_lote(itens, modo: str, chunksize: Optional[int]):
+    if modo == "thread":
+        return [_extrair_item(o) for o in itens]
+
+    # Blocos de tarefas: poucos envios por processo, mas ainda com balanceamento
+    chunksize = chunksize or max(1, len(itens) // (XML_PROCESSOS * 4))
+    try:
+        return list(_obter_pool().map(_extrair_item, itens, chunksize=chunksize))
+    except BrokenProcessPool as e:
+        logger.warning("⚠️ Pool de processos do XML caiu (%s); analisando o lote nesta thread.", e)
+        _descartar_pool()
+        return [_extrair_item(o) for o in itens]